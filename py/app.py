@@ -1,51 +1,712 @@
 #run it:
-#./uwsgi -s /tmp/web.py.socket -w testapp
+#./uwsgi -s /tmp/web.py.socket -w app
+#or, without uwsgi:
+#WEBGLPTO_PRODUCTION=1 python app.py [port]
 import web
 import json
 import parse_pto 
 import os
+import sys
+import zlib
+import math
+import hashlib
+import calendar
+import datetime
+import threading
+import time
+import timeit
+from cache import lru_cache, file_stamp
+from pool import worker_pool, pool_full
+import pyramid
+import preview
+import atlas
+import payload
+import geometry
+from catalog import project_catalog
+from metrics import registry, scan_recorder, describe_scan_metrics
 
 PROJECT_ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 PTO_DIR = os.path.join(PROJECT_ROOT, 'pto')
 IMG_DIR = os.path.join(PROJECT_ROOT, 'img')
 
+# Parsed projects and the JSON built from them are kept in memory, keyed by
+# path and invalidated when the file's mtime or size changes. The byte budget
+# is measured in source file size; unset means entries are the only limit.
+CACHE_ENTRIES = int(os.environ.get('WEBGLPTO_CACHE_ENTRIES', 32))
+CACHE_BYTES = os.environ.get('WEBGLPTO_CACHE_BYTES')
+CACHE_BYTES = int(CACHE_BYTES) if CACHE_BYTES else None
+
+scan_cache = lru_cache(CACHE_ENTRIES, CACHE_BYTES)
+load_cache = lru_cache(CACHE_ENTRIES)
+# compressed response bodies, keyed by (etag, encoding); the etag already
+# identifies the version, so these need no stamp
+encoded_cache = lru_cache(CACHE_ENTRIES)
+# the footprint_index of each project, for /visible
+footprint_cache = lru_cache(CACHE_ENTRIES)
+
+# Production mode turns off web.py's debugging and reloading, and serves with
+# SERVER_THREADS request threads. Parsing is done on a separate pool of
+# PARSE_WORKERS threads (or processes, with WEBGLPTO_PARSE_POOL=process), with
+# room for PARSE_QUEUE more waiting parses before requests get a 503.
+# With no parse workers, requests parse in their own thread.
+# A pool of parse processes keeps the scans it makes to itself: only the /load
+# documents come back, and they are cached here as their JSON (load_cache).
+# Handlers which need the scan itself (/points, /graph, /visible, ...) scan the
+# project again in the server's process, into scan_cache - from the sidecar the
+# worker wrote, which is much quicker than the first scan.
+PRODUCTION = bool(os.environ.get('WEBGLPTO_PRODUCTION'))
+SERVER_THREADS = int(os.environ.get('WEBGLPTO_SERVER_THREADS', 10))
+PARSE_WORKERS = int(os.environ.get('WEBGLPTO_PARSE_WORKERS', 4 if PRODUCTION else 0))
+PARSE_QUEUE = int(os.environ.get('WEBGLPTO_PARSE_QUEUE', 32))
+PARSE_PROCESSES = os.environ.get('WEBGLPTO_PARSE_POOL') == 'process'
+
+parse_pool = worker_pool(PARSE_WORKERS, PARSE_QUEUE, PARSE_PROCESSES)
+
+# Image pyramids (see pyramid.py) are built on a pool of IMAGE_WORKERS
+# processes. Loading a project starts building the pyramids of its images in
+# the background; /pyramid builds whatever is still missing when it's asked
+# for. With no image workers, nothing is built ahead and /pyramid builds in
+# the request's thread.
+IMAGE_WORKERS = int(os.environ.get('WEBGLPTO_IMAGE_WORKERS', 2 if PRODUCTION else 0))
+IMAGE_QUEUE = int(os.environ.get('WEBGLPTO_IMAGE_QUEUE', 256))
+
+image_pool = worker_pool(IMAGE_WORKERS, IMAGE_QUEUE, processes=True)
+pyramid_jobs = {}
+pyramid_lock = threading.Lock()
+
+# /preview and /atlas depend on the stamps of a project's images, which are
+# looked at again at most every SOURCE_INTERVAL seconds (and whenever the
+# project file changes), so their 304s don't stat every image. A project's
+# previews and atlas are made by one request at a time; the others wait for
+# it and then use what it made.
+SOURCE_INTERVAL = float(os.environ.get('WEBGLPTO_SOURCE_INTERVAL', 2 if PRODUCTION else 0))
+
+source_cache = lru_cache(CACHE_ENTRIES)
+render_locks = {}
+render_locks_lock = threading.Lock()
+
+# /list is served from an index of PTO_DIR (see catalog.py), which looks for
+# changes at most every CATALOG_INTERVAL seconds.
+CATALOG_INTERVAL = float(os.environ.get('WEBGLPTO_CATALOG_INTERVAL', 2 if PRODUCTION else 0))
+
+catalogs = {}
+
+# What the server does and how long it takes can be counted in stats and
+# served by /metrics: the requests by handler and status, the phases of /load
+# and what the pto scans report (see parse_pto.scan_observer). Scans made on
+# a pool of parse processes are not counted. It's off unless WEBGLPTO_METRICS=1
+# (or enable_metrics() is called); while it is off, it costs nothing.
+METRICS = os.environ.get('WEBGLPTO_METRICS', '0') not in ('', '0')
+
+stats = registry('webglpto_', enabled=False)
+stats.describe('http_request_seconds', 'histogram',
+               'Time taken to answer requests, by handler and status')
+stats.describe('load_phase_seconds', 'histogram',
+               'Time spent in each phase of answering /load and /load_many')
+describe_scan_metrics(stats)
+
+def enable_metrics(enabled=True):
+    """Start (or stop) counting in stats, and having the scans report there."""
+    stats.enabled = enabled
+    parse_pto.scan_observer = scan_recorder(stats) if enabled else None
+
 urls = (
     '/load/(.*)', 'load',
+    '/load_many', 'load_many',
     '/list', 'list',
+    '/pyramid/([^/]+)/([0-9]+)\.jpg', 'pyramid_level',
+    '/points/(.*)', 'points',
+    '/graph/(.*)', 'graph',
+    '/visible/(.*)', 'visible',
+    '/preview/(.*)', 'preview_image',
+    '/atlas/([^/]+)/([0-9]+)\.jpg', 'atlas_page',
+    '/metrics', 'metrics',
 #    '/upload', 'upload',
 )
 
+web.config.debug = not PRODUCTION
 app = web.application(urls, globals())
 
+# the first part of the path of each url, which names the handler in stats
+HANDLERS = set(pattern.split('/')[1] for pattern in urls[::2])
+
+def measure_request(handler):
+    """web.py processor: time every request and count it by handler and status."""
+    if not stats.enabled:
+        return handler()
+    started = timeit.default_timer()
+    status = None
+    try:
+        return handler()
+    except web.HTTPError:
+        raise # web.ctx.status has been set
+    except Exception:
+        status = '500'
+        raise
+    finally:
+        name = web.ctx.path.split('/')[1]
+        stats.observe('http_request_seconds', timeit.default_timer() - started,
+                      handler=name if name in HANDLERS else 'other',
+                      status=status or web.ctx.status[:3])
+
+app.add_processor(measure_request)
+enable_metrics(METRICS)
+
 def load_pto(filename):
-    file = open(filename, 'r')
-    pto = parse_pto.pto_scan(file)
+    stamp = file_stamp(filename)
+    pto = scan_cache.get(filename, stamp)
+    if pto is None:
+        pto = parse_pto.pto_scan(filename, fast_scan=True, keep_source=False, lazy=True,
+                                 sidecar=True)
+        scan_cache.put(filename, pto, stamp, cost=stamp[1])
     return pto
 
+def pto_path(filename):
+    if '/' in filename or filename.startswith('.'):
+        raise ValueError("Illegal character in filename")
+    # web.py hands us unicode, parse_pto wants a plain str path
+    return os.path.join(PTO_DIR, str(filename))
+
+def load_data(path, fields=payload.DEFAULT_FIELDS, format='records'):
+    """
+    The names of a project's images and its /load data (see payload.py),
+    with the given fields, as records or columnar.
+    """
+    with stats.time('load_phase_seconds', phase='project'):
+        images = load_pto(path).images()
+    with stats.time('load_phase_seconds', phase='build'):
+        data = payload.build(images, fields, format, os.path.basename(path))
+    return images.column('n'), data
+
+def pyramid_job(name):
+    """The (possibly finished) build of an image's pyramid, started if need be."""
+    key = pyramid.image_key(name)
+    with pyramid_lock:
+        job = pyramid_jobs.get(key)
+        if job is None or job.ready():
+            job = pyramid_jobs[key] = image_pool.submit(pyramid.build_pyramid, IMG_DIR, key)
+        return job
+
+def source_stamps(path):
+    """
+    The stamps of a project's file and of its images (see
+    pyramid.source_stamps), and the time of the latest change to any of them.
+    """
+    stamp = file_stamp(path)
+    sources = source_cache.get(path, stamp)
+    now = time.time()
+    if sources is None or now - sources[0] >= SOURCE_INTERVAL:
+        stamps = pyramid.source_stamps(IMG_DIR, load_pto(path).images().column('n'))
+        if sources is not None and sources[1][1] == stamps:
+            stamps = sources[1][1] # the same, so what was made from them still holds
+        mtime = max([stamp[0]] + [image[0] for image in stamps if image is not None])
+        sources = source_cache.put(path, (now, (stamp, stamps), mtime), stamp)
+    return sources[1], sources[2]
+
+def render_lock(path):
+    """The lock held while a project's preview or atlas is being made."""
+    with render_locks_lock:
+        lock = render_locks.get(path)
+        if lock is None:
+            lock = render_locks[path] = threading.Lock()
+        return lock
+
+def prebuild_pyramids(names):
+    """Start building the pyramids of a freshly loaded project's images."""
+    if not IMAGE_WORKERS:
+        return
+    for name in names:
+        if not name:
+            continue
+        try:
+            if pyramid.current_manifest(IMG_DIR, name) is None:
+                pyramid_job(name)
+        except (ValueError, EnvironmentError):
+            pass # no such image, /pyramid will say so
+        except pool_full:
+            break
+
+def load_documents(paths, stamps, fields, format):
+    """
+    The cache keys of the /load documents of paths, and the documents, in
+    order: the JSON if it's cached, else the data to encode. Whatever isn't
+    cached is parsed on the parse pool, all at the same time; the caller
+    caches the documents in load_cache (on a pool of processes, the scans
+    don't make it to scan_cache).
+    """
+    keys = [(path, fields, format) for path in paths]
+    results = [load_cache.get(key, stamp) for key, stamp in zip(keys, stamps)]
+    try:
+        jobs = [(k, parse_pool.submit(load_data, paths[k], fields, format))
+                for k in range(len(paths)) if results[k] is None]
+    except pool_full:
+        raise web.HTTPError('503 Service Unavailable',
+                            {'Content-Type': 'text/plain', 'Retry-After': '1'},
+                            'Too many projects waiting to be parsed')
+    for k, job in jobs:
+        names, results[k] = job.get()
+        prebuild_pyramids(names)
+    return keys, results
+
+def load_json(paths, stamps=None, fields=payload.DEFAULT_FIELDS, format='records'):
+    """The /load JSON for each of paths, in order."""
+    if stamps is None:
+        stamps = [file_stamp(path) for path in paths]
+    keys, results = load_documents(paths, stamps, fields, format)
+    for k, result in enumerate(results):
+        if not isinstance(result, basestring):
+            with stats.time('load_phase_seconds', phase='json'):
+                text = json.dumps(result)
+            results[k] = load_cache.put(keys[k], text, stamps[k])
+    return results
+
+def stream_json(path, stamp, fields=payload.DEFAULT_FIELDS, format='records'):
+    """
+    The /load JSON of a project: the text, if it's cached, or else an iterator
+    over its chunks, which caches the whole text once it's all been sent.
+    """
+    keys, results = load_documents([path], [stamp], fields, format)
+    if isinstance(results[0], basestring):
+        return results[0]
+    return caching_chunks(payload.iter_json(results[0]), 'json',
+                          lambda text: load_cache.put(keys[0], text, stamp))
+
+def caching_chunks(chunks, phase, store, transform=None):
+    """
+    Pass on the chunks, through transform(chunk, last) if given, timing the
+    work as phase, and store() the whole output when it's done.
+    """
+    sent = []
+    spent = 0.0
+    chunks = iter(chunks)
+    while True:
+        started = timeit.default_timer()
+        chunk = next(chunks, None)
+        last = chunk is None
+        if transform is not None:
+            chunk = transform(chunk or '', last)
+        spent += timeit.default_timer() - started
+        if chunk:
+            sent.append(chunk)
+            yield chunk
+        if last:
+            break
+    stats.observe('load_phase_seconds', spent, phase=phase)
+    store(''.join(sent))
+
+def accepted_encoding():
+    """The compression to use for this request's response, if any."""
+    accepted = {}
+    for item in web.ctx.env.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = item.split(';')
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].strip().lower()] = q
+    for encoding in ('gzip', 'deflate'):
+        if accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+def compressor(encoding):
+    if encoding == 'gzip':
+        # wbits 31 writes a gzip header; its mtime is 0, so the output only
+        # depends on the body, as a strong etag requires
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    return zlib.compressobj(6)
+
+def encode(body, encoding):
+    compress = compressor(encoding)
+    return compress.compress(body) + compress.flush()
+
+def is_fresh(etag, mtime):
+    """Does the client's cached copy, going by the request headers, match?"""
+    env = web.ctx.env
+    if 'HTTP_IF_NONE_MATCH' in env:
+        # If-None-Match wins over If-Modified-Since when both are sent
+        tags = [tag.strip() for tag in env['HTTP_IF_NONE_MATCH'].split(',')]
+        return '*' in tags or '"%s"' % etag in [
+            tag[2:] if tag.startswith('W/') else tag for tag in tags]
+    since = web.parsehttpdate(env.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+    return since is not None and int(mtime) <= calendar.timegm(since.timetuple())
+
+def respond(etag, mtime, body, compress=True):
+    """
+    Send the result of body() with validators for etag and mtime, compressed
+    if the client accepts it - or a 304, without calling body(), when the
+    client already has this version. body() can return the response as a
+    string, or as an iterator over its chunks, which are sent as they come.
+    """
+    encoding = accepted_encoding() if compress else None
+    tag = etag + '-' + encoding if encoding else etag
+    web.header('ETag', '"%s"' % tag)
+    web.header('Last-Modified',
+               web.httpdate(datetime.datetime.utcfromtimestamp(int(mtime))))
+    web.header('Cache-Control', 'no-cache')
+    web.header('Vary', 'Accept-Encoding')
+    if is_fresh(tag, mtime):
+        raise web.notmodified()
+    if not encoding:
+        return body()
+    web.header('Content-Encoding', encoding)
+    data = encoded_cache.get((etag, encoding))
+    if data is not None:
+        return data
+    data = body()
+    if not isinstance(data, basestring):
+        # the body comes in chunks, so it's compressed as it goes out
+        compress = compressor(encoding)
+        return caching_chunks(
+            data, 'compress', lambda data: encoded_cache.put((etag, encoding), data),
+            lambda chunk, last: compress.compress(chunk) + (compress.flush() if last else ''))
+    with stats.time('load_phase_seconds', phase='compress'):
+        data = encode(data, encoding)
+    return encoded_cache.put((etag, encoding), data)
+
+def project_etag(filenames, stamps, *options):
+    """A strong etag for the /load data of projects, from their files' stamps."""
+    key = repr(([(f, stamp) for f, stamp in zip(filenames, stamps)], options))
+    return hashlib.sha1(key).hexdigest()[:20]
+
+def get_catalog():
+    catalog = catalogs.get(PTO_DIR)
+    if catalog is None:
+        catalog = catalogs.setdefault(PTO_DIR, project_catalog(PTO_DIR, CATALOG_INTERVAL))
+    return catalog
+
 class list:
+    """
+    /list - the names of the projects in PTO_DIR. Takes sort (one of
+    catalog.SORT_KEYS, default name), order=desc, offset and limit; with
+    details=1 the projects' metadata is sent instead of just their names.
+    The total number of projects is in the X-Total-Count header.
+    """
     def GET(self):
-        x = os.walk(PTO_DIR).next()
-        filelist = x[2]
-        ptolist = [file for file in filelist if os.path.splitext(file)[1].lower() == '.pto' ]
-        return json.dumps(ptolist)
+        params = web.input(sort='name', order='asc', offset='0', limit='', details='')
+        try:
+            offset = max(int(params.offset), 0)
+            limit = max(int(params.limit), 0) if params.limit else None
+            catalog = get_catalog()
+            catalog.update()
+            page, total = catalog.listing(params.sort, params.order == 'desc', offset, limit)
+        except ValueError:
+            raise web.badrequest()
+        details = params.details not in ('', '0')
+        web.header('X-Total-Count', str(total))
+        etag = hashlib.sha1(repr((catalog.signature, params.sort, params.order,
+                                  offset, limit, details))).hexdigest()[:20]
+        def body():
+            if details:
+                return json.dumps(page)
+            return json.dumps([entry['name'] for entry in page])
+        return respond(etag, catalog.changed, body)
+
+def load_options():
+    """
+    The fields and format asked for by a /load or /load_many request, with
+    fields= (see payload.FIELDS), format=columnar, transforms=1, which adds
+    the transform field, and atlas=1, which adds the atlas field.
+    """
+    params = web.input(fields='', format='records', transforms='', atlas='')
+    if params.format not in payload.FORMATS:
+        raise web.badrequest()
+    try:
+        fields = payload.parse_fields(params.fields, params.transforms not in ('', '0'),
+                                      params.atlas not in ('', '0'))
+    except ValueError:
+        raise web.badrequest()
+    return fields, params.format
 
 class load:
+    """
+    /load/<project> - the images of a project, with their orientation; see
+    load_options for what can be asked for.
+    """
+    def GET(self, filename):
+        path = pto_path(filename)
+        stamp = file_stamp(path)
+        fields, format = load_options()
+        return respond(project_etag([filename], [stamp], fields, format), stamp[0],
+                       lambda: stream_json(path, stamp, fields, format))
+
+class load_many:
+    """
+    /load_many?files=a.pto,b.pto - the /load data of several projects, as one
+    JSON object keyed by file name.
+    """
+    def GET(self):
+        filenames = [f for f in web.input(files='').files.split(',') if f]
+        paths = [pto_path(f) for f in filenames]
+        stamps = [file_stamp(path) for path in paths]
+        fields, format = load_options()
+        def body():
+            results = load_json(paths, stamps, fields, format)
+            return '{%s}' % ', '.join('%s: %s' % (json.dumps(f), r)
+                                      for f, r in zip(filenames, results))
+        return respond(project_etag(filenames, stamps, fields, format),
+                       max([stamp[0] for stamp in stamps] or [0]), body)
+
+def finite(text):
+    """The number in text; ValueError for anything else, nan and inf included."""
+    value = float(text)
+    if math.isnan(value) or math.isinf(value):
+        raise ValueError(text)
+    return value
+
+def point_query(params):
+    """
+    The control_point_index query a /points request asks for, as the name of
+    the method and its arguments: with image and other, the points linking
+    two images; with image, x, y and radius, those around a pixel; with
+    image, x0, y0, x1 and y1, those in a rectangle; with just image, all of
+    an image's points. Raises ValueError for missing, malformed or infinite
+    numbers.
+    """
+    image = int(params.image)
+    if params.other:
+        return 'between', (image, int(params.other))
+    if params.radius:
+        return 'near', (image, finite(params.x), finite(params.y), finite(params.radius))
+    if params.x0:
+        return 'within', (image, finite(params.x0), finite(params.y0),
+                          finite(params.x1), finite(params.y1))
+    return 'of_image', (image,)
+
+class points:
+    """
+    /points/<project>?image=3&... - control points of a project, found with
+    the scan's control_point_index (see point_query for the queries), as one
+    array per field: their positions in the project's c-lines ('index') and
+    n, N, x, y, X, Y and t.
+    """
+    def GET(self, filename):
+        params = web.input(image='', other='', x='', y='', radius='',
+                           x0='', y0='', x1='', y1='')
+        try:
+            method, args = point_query(params)
+        except ValueError:
+            raise web.badrequest()
+        try:
+            path = pto_path(filename)
+            stamp = file_stamp(path)
+        except (ValueError, EnvironmentError):
+            raise web.notfound()
+        def body():
+            index = load_pto(path).control_point_index()
+            found = getattr(index, method)(*args)
+            result = {'index': found.tolist()}
+            for field in parse_pto.control_point_fields:
+                result[field] = index.columns[field][found].tolist()
+            return json.dumps(result)
+        web.header('Content-Type', 'application/json')
+        return respond(project_etag([filename], [stamp], method, args), stamp[0], body)
+
+class graph:
+    """
+    /graph/<project>?start=3 - which images of a project overlap: the number
+    of images, the edges as [a, b, number of control points] and the order to
+    load the images in, breadth first from image start (default 0).
+    """
+    def GET(self, filename):
+        try:
+            start = int(web.input(start='0').start)
+            path = pto_path(filename)
+            stamp = file_stamp(path)
+        except ValueError:
+            raise web.badrequest()
+        except EnvironmentError:
+            raise web.notfound()
+        # start is checked before respond() sets the headers of a response
+        image_graph = load_pto(path).image_graph()
+        if not 0 <= start < len(image_graph):
+            raise web.badrequest()
+        def body():
+            return json.dumps({'images': len(image_graph),
+                               'edges': image_graph.edges(),
+                               'order': image_graph.load_order(start)})
+        web.header('Content-Type', 'application/json')
+        return respond(project_etag([filename], [stamp], 'graph', start), stamp[0], body)
+
+def footprints(path, stamp):
+    """The geometry.footprint_index of a project, kept in footprint_cache."""
+    index = footprint_cache.get(path, stamp)
+    if index is None:
+        index = geometry.footprint_index.from_images(load_pto(path).images())
+        footprint_cache.put(path, index, stamp)
+    return index
+
+class visible:
+    """
+    /visible/<project>?yaw=10&pitch=5&fov=50&aspect=1.5 - the images of a
+    project which a view in direction yaw and pitch, with a vertical field of
+    view of fov degrees and a width / height aspect (default 1), overlaps.
+    Sent as {"images": [...]}, the image numbers in ascending order.
+    """
     def GET(self, filename):
-        if '/' in filename or filename.startswith('.'):
-            raise ValueError("Illegal character in filename")
-        pto = load_pto(os.path.join(PTO_DIR, filename))
-        pto_data = []
-        for i in pto.i:
-            pto_data.append({ 
-                          'name': i.n.value,
-                          'yaw': i.y.value,
-                          'pitch': i.p.value,
-                          'roll': i.r.value,
-                          'view': i.v.value,
-                        })
-        return json.dumps(pto_data) 
-
-#application = app.wsgifunc()
-
-web.webapi.internalerror = web.debugerror
-if __name__ == "__main__": app.run()
+        params = web.input(yaw='', pitch='', fov='', aspect='1')
+        try:
+            yaw, pitch, fov, aspect = [finite(v) for v in
+                                       (params.yaw, params.pitch, params.fov, params.aspect)]
+            if not -90 <= pitch <= 90 or not 0 < fov < 180 or not 0 < aspect:
+                raise ValueError((yaw, pitch, fov, aspect))
+            path = pto_path(filename)
+            stamp = file_stamp(path)
+        except ValueError:
+            raise web.badrequest()
+        except EnvironmentError:
+            raise web.notfound()
+        def body():
+            found = footprints(path, stamp).visible(yaw, pitch, fov, aspect)
+            return json.dumps({'images': found.tolist()})
+        web.header('Content-Type', 'application/json')
+        # the answers are small and asked for all the time, they go out as they are
+        return respond(project_etag([filename], [stamp], 'visible', yaw, pitch, fov, aspect),
+                       stamp[0], body, compress=False)
+
+class pyramid_level:
+    """
+    /pyramid/<image>/<size>.jpg - the smallest level of the image's pyramid
+    that is at least size pixels big, built first if it is missing or stale.
+    """
+    def GET(self, name, size):
+        try:
+            manifest = pyramid.current_manifest(IMG_DIR, name)
+            if manifest is None:
+                manifest = pyramid_job(name).get()
+        except (ValueError, EnvironmentError):
+            raise web.notfound()
+        except pool_full:
+            raise web.HTTPError('503 Service Unavailable',
+                                {'Content-Type': 'text/plain', 'Retry-After': '1'},
+                                'Too many images waiting to be processed')
+        path = pyramid.level_path(IMG_DIR, name, manifest, int(size))
+        etag = hashlib.sha1(repr((path, manifest['stamp']))).hexdigest()[:20]
+        web.header('Content-Type', 'image/jpeg')
+        def body():
+            with open(path, 'rb') as f:
+                return f.read()
+        return respond(etag, manifest['stamp'][0], body, compress=False)
+
+# the widest preview /preview renders
+PREVIEW_MAX_WIDTH = 4096
+
+preview_cache = lru_cache(CACHE_ENTRIES)
+
+def preview_target(path, width, stamps):
+    """Where the project's preview for width goes, for its sources' stamps."""
+    rendered = preview_cache.get((path, width), stamps)
+    if rendered is None:
+        rendered = preview_cache.put((path, width), preview.preview_target(
+            path, IMG_DIR, width, load_pto(path), stamps[1])[0], stamps)
+    return rendered
+
+class preview_image:
+    """
+    /preview/<project>?width=1024 - an equirectangular preview of the whole
+    project (see preview.py), rendered on the image pool if there's no current
+    one, to show while the images' own textures load.
+    """
+    def GET(self, filename):
+        try:
+            width = int(web.input(width=str(preview.PREVIEW_WIDTH)).width)
+            if not 2 <= width <= PREVIEW_MAX_WIDTH:
+                raise ValueError(width)
+            path = pto_path(filename)
+        except ValueError:
+            raise web.badrequest()
+        try:
+            stamps, mtime = source_stamps(path)
+            rendered = preview_target(path, width, stamps)
+            # the file name holds the hash of everything the preview depends on
+            etag = os.path.basename(rendered).rsplit('-', 1)[1][:-4]
+            if not os.path.exists(rendered) and not is_fresh(etag, mtime):
+                with render_lock(path):
+                    preview.render_preview(path, IMG_DIR, width, pool=image_pool,
+                                           scan=load_pto(path), stamps=stamps[1])
+        except EnvironmentError:
+            raise web.notfound()
+        except pool_full:
+            raise web.HTTPError('503 Service Unavailable',
+                                {'Content-Type': 'text/plain', 'Retry-After': '1'},
+                                'Too many images waiting to be processed')
+        web.header('Content-Type', 'image/jpeg')
+        def body():
+            with open(rendered, 'rb') as f:
+                return f.read()
+        return respond(etag, mtime, body, compress=False)
+
+atlas_cache = lru_cache(CACHE_ENTRIES)
+
+def atlas_manifest(path, stamps):
+    """The manifest of the project's atlas (see atlas.py), for its sources' stamps."""
+    manifest = atlas_cache.get(path, stamps)
+    if manifest is None:
+        layout = atlas.atlas_layout(load_pto(path).images())
+        manifest = atlas_cache.put(path, atlas.atlas_manifest(path, IMG_DIR, layout,
+                                                              stamps[1]), stamps)
+    return manifest
+
+class atlas_page:
+    """
+    /atlas/<project>/<page>.jpg - a page of the project's texture atlas (see
+    atlas.py), built on the image pool first if it is missing or stale.
+    """
+    def GET(self, filename, page):
+        page = int(page)
+        try:
+            path = pto_path(filename)
+            stamps, mtime = source_stamps(path)
+            manifest = atlas_manifest(path, stamps)
+            if page >= len(manifest['pages']):
+                raise web.notfound()
+            etag = '%s-%d' % (manifest['key'], page)
+            if not os.path.isdir(manifest['directory']) and not is_fresh(etag, mtime):
+                with render_lock(path):
+                    atlas.build_atlas(path, IMG_DIR, load_pto(path).images(),
+                                      pool=image_pool, stamps=stamps[1])
+        except (ValueError, EnvironmentError):
+            raise web.notfound()
+        except pool_full:
+            raise web.HTTPError('503 Service Unavailable',
+                                {'Content-Type': 'text/plain', 'Retry-After': '1'},
+                                'Too many images waiting to be processed')
+        page_path = atlas.page_path(manifest, page)
+        web.header('Content-Type', 'image/jpeg')
+        def body():
+            with open(page_path, 'rb') as f:
+                return f.read()
+        return respond(etag, mtime, body, compress=False)
+
+class metrics:
+    """/metrics - the server's counters and histograms, in the Prometheus text format."""
+    def GET(self):
+        if not stats.enabled:
+            raise web.notfound()
+        web.header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        web.header('Cache-Control', 'no-cache')
+        return stats.render()
+
+def serve(port=8080):
+    from cheroot import wsgi
+    func = web.httpserver.StaticMiddleware(app.wsgifunc())
+    server = wsgi.Server(('0.0.0.0', port), func,
+                         numthreads=SERVER_THREADS, server_name='localhost')
+    try:
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        server.stop()
+
+application = app.wsgifunc()
+
+if not PRODUCTION:
+    web.webapi.internalerror = web.debugerror
+if __name__ == "__main__":
+    if PRODUCTION:
+        serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
+    else:
+        app.run()
@@ -0,0 +1,262 @@
+"""
+Texture atlases: the small versions of a project's images packed into a few
+big images, so the viewer can show every image after a handful of requests
+and texture uploads instead of one per image.
+
+Every image goes into the atlas at the size of the smallest level of its
+pyramid (see pyramid.py), ATLAS_TILE pixels on the long side, with PADDING
+pixels of its edges repeated around it so that texture filtering doesn't
+pick up its neighbours. The images are packed onto pages of up to ATLAS_PAGE
+pixels square, in shelves, tallest first; each page is cut down to the power
+of two sizes it needs.
+
+The layout only depends on the i-lines, so /load can tell where each image
+is without looking at the images. The pages are written to img/.atlas/ in a
+directory whose name includes a hash of the project file's and its images'
+stamps, so they are made again when any of them change.
+"""
+import os
+import shutil
+import urllib
+import hashlib
+import tempfile
+import collections
+import multiprocessing
+import parse_pto
+import pyramid
+from cache import file_stamp
+from pool import worker_pool
+
+ATLAS_TILE = pyramid.LEVEL_SIZES[0]
+ATLAS_PAGE = 2048
+PADDING = 2
+ATLAS_DIR = '.atlas'
+ATLAS_VERSION = 1
+QUALITY = pyramid.QUALITY
+
+def tile_size(width, height, tile=ATLAS_TILE):
+    """The size of an image in the atlas, rounded the way pyramid.fit does."""
+    scale = float(tile) / max(width, height)
+    if scale >= 1:
+        return int(width), int(height)
+    return max(1, int(round(width * scale))), max(1, int(round(height * scale)))
+
+def _power_of_two(n):
+    size = 1
+    while size < n:
+        size *= 2
+    return size
+
+class atlas_layout(object):
+    """
+    Where the images of an image_table go in the atlas. slots has one entry
+    per image, (page, x, y, width, height) or None for images without a name
+    or size; images with the same name and size share a slot. pages holds the
+    (width, height) of each page.
+    """
+
+    def __init__(self, images, tile=ATLAS_TILE, page_size=ATLAS_PAGE, padding=PADDING):
+        self.tile = tile
+        self.padding = padding
+        keys = []
+        for name, width, height in zip(images.column('n'), images.column('w'),
+                                       images.column('h')):
+            if name and width and height:
+                keys.append((name, width, height))
+            else:
+                keys.append(None)
+        unique = sorted(set(key for key in keys if key is not None))
+        sizes = dict((key, tile_size(key[1], key[2], tile)) for key in unique)
+        # tallest first, then widest, so the shelves fill up evenly
+        unique.sort(key=lambda key: (-sizes[key][1], -sizes[key][0], key))
+
+        placed = {}
+        pages = []      # [used width, used height, [[y, height, used width], ...]]
+        cell = lambda key: (sizes[key][0] + 2 * padding, sizes[key][1] + 2 * padding)
+        for key in unique:
+            width, height = cell(key)
+            if width > page_size or height > page_size:
+                raise ValueError("%s doesn't fit on an atlas page" % key[0])
+            spot = None
+            for number, page in enumerate(pages):
+                for shelf in page[2]:
+                    if height <= shelf[1] and shelf[2] + width <= page_size:
+                        spot = number, shelf
+                        break
+                if spot is None and page[1] + height <= page_size:
+                    page[2].append([page[1], height, 0])
+                    page[1] += height
+                    spot = number, page[2][-1]
+                if spot is not None:
+                    break
+            if spot is None:
+                pages.append([0, height, [[0, height, 0]]])
+                spot = len(pages) - 1, pages[-1][2][0]
+            number, shelf = spot
+            placed[key] = (number, shelf[2] + padding, shelf[0] + padding) + sizes[key]
+            shelf[2] += width
+            pages[number][0] = max(pages[number][0], shelf[2])
+
+        self.slots = [placed[key] if key is not None else None for key in keys]
+        self.pages = [(_power_of_two(page[0]), _power_of_two(page[1])) for page in pages]
+        self.keys = keys
+
+    def uv(self, image):
+        """
+        The image's rectangle on its page as (left, top, right, bottom), in
+        fractions of the page's size, from its top left corner.
+        """
+        slot = self.slots[image]
+        if slot is None:
+            return None
+        page, x, y, width, height = slot
+        page_width, page_height = self.pages[page]
+        return [float(x) / page_width, float(y) / page_height,
+                float(x + width) / page_width, float(y + height) / page_height]
+
+def page_url(project, page):
+    return '/atlas/%s/%d.jpg' % (urllib.quote(project), page)
+
+def image_entries(images, project=None):
+    """
+    The atlas field of /load for each image of an image_table: its page's
+    number (and URL, for a project's file name) and its rectangle there, see
+    atlas_layout.uv - None for images which aren't in the atlas.
+    """
+    layout = atlas_layout(images)
+    entries = []
+    for image, slot in enumerate(layout.slots):
+        if slot is None:
+            entries.append(None)
+            continue
+        entry = {'page': slot[0], 'uv': layout.uv(image)}
+        if project is not None:
+            entry['url'] = page_url(project, slot[0])
+        entries.append(entry)
+    return entries
+
+def atlas_directory(img_dir, pto_path, key):
+    return os.path.join(img_dir, ATLAS_DIR, '%s-%s' % (os.path.basename(pto_path), key))
+
+def page_path(manifest, page):
+    return os.path.join(manifest['directory'], '%d.jpg' % page)
+
+def tile_pixels(img_dir, name, width, height):
+    """
+    An image at its atlas size, from its pyramid, as (size, RGB bytes), or
+    None if there's no such image.
+    """
+    try:
+        manifest = pyramid.build_pyramid(img_dir, name)
+    except (EnvironmentError, ValueError):
+        return None
+    size = tile_size(width, height)
+    tile = pyramid.Image.open(pyramid.level_path(img_dir, name, manifest, max(size)))
+    tile = tile.convert('RGB')
+    if tile.size != size:
+        tile = tile.resize(size, pyramid.Image.ANTIALIAS)
+    return size, tile.tobytes()
+
+def paste(page, tile, x, y, padding=PADDING):
+    """Paste tile onto page at x, y, with its edges repeated padding pixels out."""
+    page.paste(tile, (x, y))
+    width, height = tile.size
+    top, bottom = tile.crop((0, 0, width, 1)), tile.crop((0, height - 1, width, height))
+    for k in range(1, padding + 1):
+        page.paste(top, (x, y - k))
+        page.paste(bottom, (x, y + height - 1 + k))
+    # the columns include the rows just made, which fills the corners
+    left = page.crop((x, y - padding, x + 1, y + height + padding))
+    right = page.crop((x + width - 1, y - padding, x + width, y + height + padding))
+    for k in range(1, padding + 1):
+        page.paste(left, (x - k, y - padding))
+        page.paste(right, (x + width - 1 + k, y - padding))
+
+def atlas_manifest(pto_path, img_dir, layout, stamps):
+    """
+    The manifest of the project's atlas (its key, directory and page sizes)
+    for its layout and its images' stamps (see pyramid.source_stamps).
+    """
+    key = hashlib.sha1(repr((ATLAS_VERSION, layout.tile, layout.padding,
+                             file_stamp(pto_path), stamps))).hexdigest()[:20]
+    return {'key': key, 'directory': atlas_directory(img_dir, pto_path, key),
+            'pages': layout.pages}
+
+def build_atlas(pto_path, img_dir, images=None, pool=None, workers=None, force=False,
+                stamps=None):
+    """
+    The manifest of the project's atlas (see atlas_manifest), made first
+    unless it is up to date. images is the project's image_table, read from
+    pto_path if not given, and stamps its images' stamps, looked up if not
+    given. The images are read on pool, or on a pool of workers processes
+    (default: one per CPU); missing ones leave a gap.
+    """
+    if pyramid.Image is None:
+        raise RuntimeError("Pillow is needed to build texture atlases")
+    if images is None:
+        images = parse_pto.pto_scan(pto_path, fast_scan=True, keep_source=False,
+                                    lazy=True).images()
+    layout = atlas_layout(images)
+    if stamps is None:
+        stamps = pyramid.source_stamps(img_dir, images.column('n'))
+    manifest = atlas_manifest(pto_path, img_dir, layout, stamps)
+    directory = manifest['directory']
+    if not force and os.path.isdir(directory):
+        return manifest
+
+    parent = os.path.dirname(directory)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    slots = {}
+    for image, slot in zip(layout.keys, layout.slots):
+        if image is not None:
+            slots[image] = slot
+    own_pool = pool is None
+    if own_pool:
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(slots)))
+        pool = worker_pool(workers, len(slots), processes=workers > 1)
+    pages = [pyramid.Image.new('RGB', size) for size in layout.pages]
+    def add(slot, job):
+        result = job.get()
+        if result is not None:
+            size, pixels = result
+            paste(pages[slot[0]], pyramid.Image.frombytes('RGB', size, pixels),
+                  slot[1], slot[2], layout.padding)
+    # like pyramid.build_pyramid, the pages go to a fresh directory which
+    # then takes the place of the old atlas
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+    try:
+        try:
+            # a few images at a time, so a big project doesn't fill a shared pool
+            window = max(pool.workers, 1) * 2
+            jobs = collections.deque()
+            for (name, width, height), slot in sorted(slots.items()):
+                if len(jobs) >= window:
+                    add(*jobs.popleft())
+                jobs.append((slot, pool.submit(tile_pixels, img_dir, name, width, height)))
+            while jobs:
+                add(*jobs.popleft())
+        finally:
+            if own_pool:
+                pool.close()
+        for number, page in enumerate(pages):
+            page.save(os.path.join(tmp, '%d.jpg' % number), quality=QUALITY)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            # someone else built the same atlas at the same time
+            shutil.rmtree(tmp, ignore_errors=True)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    for name in os.listdir(parent):
+        if (name.rsplit('-', 1)[0] == os.path.basename(pto_path) and
+                name != os.path.basename(directory)):
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+    return manifest
@@ -0,0 +1,11 @@
+"""
+Benchmarks for parse_pto and the web app.
+
+    python -m bench                      # from py/, writes bench-<time>.json
+    python -m bench --images 200 --control-points 50000 -o new.json
+    python -m bench.compare old.json new.json
+
+generate.py makes synthetic, hugin-like pto files, run.py times the scanner,
+the writer and the /load handler on them, and compare.py reports what got
+slower between two result files.
+"""
@@ -0,0 +1,57 @@
+"""
+Compares two benchmark result files and reports what got slower (by minimum
+time) or bigger (by peak memory) than the threshold allows:
+
+    python -m bench.compare old.json new.json [--threshold 1.15]
+
+The exit status is 1 if anything regressed, so it can gate a build.
+"""
+import sys
+import json
+import argparse
+
+def compare(old, new, threshold=1.15, memory_threshold=1.25):
+    """
+    Pairs up the results of two result documents by name. Returns a list of
+    (name, old result, new result, time ratio, memory ratio, regressed).
+    """
+    before = dict((r['name'], r) for r in old['results'] if 'min' in r)
+    rows = []
+    for result in new['results']:
+        previous = before.get(result['name'])
+        if previous is None or 'min' not in result:
+            continue
+        ratio = result['min'] / previous['min'] if previous['min'] else 1.0
+        memory = (float(result['peak_rss_kb']) / previous['peak_rss_kb']
+                  if previous['peak_rss_kb'] else 1.0)
+        # memory figures of a few hundred kB are mostly noise
+        regressed = ratio > threshold or (
+            memory > memory_threshold and result['peak_rss_kb'] - previous['peak_rss_kb'] > 1024)
+        rows.append((result['name'], previous, result, ratio, memory, regressed))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('-t', '--threshold', type=float, default=1.15,
+                        help='time ratio above which a benchmark counts as slower')
+    parser.add_argument('-m', '--memory-threshold', type=float, default=1.25,
+                        help='peak memory ratio above which a benchmark counts as bigger')
+    args = parser.parse_args(argv)
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    if old.get('params') != new.get('params'):
+        print('warning: the runs used different parameters')
+    rows = compare(old, new, args.threshold, args.memory_threshold)
+    for name, previous, result, ratio, memory, regressed in rows:
+        print('%-20s %9.4fs -> %9.4fs  x%.2f  memory x%.2f%s' % (
+            name, previous['min'], result['min'], ratio, memory,
+            '  REGRESSION' if regressed else ''))
+    return 1 if any(row[-1] for row in rows) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+A generator of synthetic pto files that look like what hugin writes: a p- and
+an m-line, an i-line with its #-hugin line for every image (the images after
+the first one sharing the lens by back-references), v-lines for the optimizer,
+k-lines (masks), control points between neighbouring images and the #hugin_
+settings at the end. The same seed always gives the same file.
+"""
+import random
+
+def _number(x, digits=6):
+    # the way hugin writes floats: no more digits than needed
+    text = '%.*f' % (digits, x)
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+def generate_pto(images=20, control_points=1000, masks=None, seed=0,
+                 width=4000, height=3000):
+    """The text of a pto file with the given numbers of images and control points."""
+    rnd = random.Random(seed)
+    if masks is None:
+        masks = images // 10
+    lines = [
+        '# hugin project file',
+        '#hugin_ptoversion 2',
+        'p f2 w%d h%d v360  E13.1 R0 n"TIFF_m c:LZW r:CROP"' % (images * 600, images * 300),
+        'm g1 i0 f0 m2 p0.00784314',
+        '',
+        '# image lines',
+    ]
+    for image in range(images):
+        lines.append('#-hugin  cropFactor=1 autoCenterCrop=1 cropFactor=1 enabled=true')
+        yaw = _number(360.0 * image / images - 180 + rnd.uniform(-2, 2))
+        pitch = _number(rnd.uniform(-10, 10))
+        roll = _number(rnd.uniform(-1, 1))
+        name = 'img%04d.jpg' % image
+        if image == 0:
+            lines.append(
+                'i w%d h%d f0 v50 Ra0 Rb0 Rc0 Rd0 Re0 Eev13.1 Er1 Eb1 r%s p%s y%s '
+                'TrX0 TrY0 TrZ0 Tpy0 Tpp0 j0 a0 b-0.0123 c0 d0 e0 g0 t0 '
+                'Va1 Vb0 Vc0 Vd0 Vx0 Vy0  Vm5 n"%s"' % (width, height, roll, pitch, yaw, name))
+        else:
+            lines.append(
+                'i w%d h%d f0 v=0 Ra=0 Rb=0 Rc=0 Rd=0 Re=0 Eev13.1 Er1 Eb1 r%s p%s y%s '
+                'TrX0 TrY0 TrZ0 Tpy0 Tpp0 j0 a=0 b=0 c=0 d0 e0 g0 t0 '
+                'Va=0 Vb=0 Vc=0 Vd=0 Vx=0 Vy=0  Vm5 n"%s"' % (width, height, roll, pitch, yaw, name))
+    lines += ['', '# specify variables that should be optimized', 'v v0', 'v b0']
+    for image in range(1, images):
+        lines += ['v r%d' % image, 'v p%d' % image, 'v y%d' % image]
+    lines.append('v')
+    if masks:
+        lines += ['', '# masks']
+        for k in range(masks):
+            points = ' '.join('%s %s' % (_number(rnd.uniform(0, width), 2),
+                                         _number(rnd.uniform(0, height), 2))
+                              for p in range(rnd.randint(3, 8)))
+            lines.append('k i%d t0 p"%s"' % (rnd.randrange(images), points))
+    lines += ['', '# control points']
+    for k in range(control_points):
+        n = rnd.randrange(images)
+        N = (n + 1) % images if images > 1 else n
+        lines.append('c n%d N%d x%s y%s X%s Y%s t0' % (
+            n, N,
+            _number(rnd.uniform(0, width)), _number(rnd.uniform(0, height)),
+            _number(rnd.uniform(0, width)), _number(rnd.uniform(0, height))))
+    lines += [
+        '',
+        '#hugin_optimizeReferenceImage 0',
+        '#hugin_blender enblend',
+        '#hugin_remapper nona',
+        '#hugin_enblendOptions ',
+        '#hugin_outputLDRBlended true',
+        '#hugin_outputLDRLayers false',
+        '#hugin_outputImageType tif',
+    ]
+    return '\n'.join(lines) + '\n'
+
+def write_pto(path, **options):
+    with open(path, 'w') as f:
+        f.write(generate_pto(**options))
+    return path
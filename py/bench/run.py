@@ -0,0 +1,230 @@
+"""
+Runs the benchmarks on a generated project and writes the results as JSON.
+
+Every benchmark runs in a process of its own, so that the peak memory it
+reports (the growth of the process's maximum resident set size) is its own,
+and is timed `repeat` times; the minimum is the number to compare, the median
+shows how noisy it was. A benchmark whose process dies, or which takes
+longer than the timeout, is reported as failed.
+"""
+import os
+import re
+import sys
+import gc
+import json
+import time
+import shutil
+import timeit
+import platform
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from Queue import Empty
+from StringIO import StringIO
+
+from bench.generate import write_pto
+
+RESULTS_VERSION = 1
+TIMEOUT = 600 # seconds a benchmark may take, all repeats included
+
+def _peak_rss_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak # bytes there
+
+# The benchmarks: name -> (setup, run). setup(path) is not timed and returns
+# whatever run needs; run(state) is what gets timed.
+
+def _scan(**options):
+    import parse_pto
+    return (lambda path: path,
+            lambda path: parse_pto.pto_scan(path, **options))
+
+def _member_access():
+    import parse_pto
+    def setup(path):
+        return path
+    def run(path):
+        # the scan has to be fresh each time, make_member_access only works once
+        scan = parse_pto.pto_scan(path, member_access=False)
+        start = timeit.default_timer()
+        scan.make_member_access()
+        return timeit.default_timer() - start
+    return setup, run
+
+def _lines_like():
+    import parse_pto
+    return (lambda path: parse_pto.pto_scan(path, fast_scan=True),
+            lambda scan: scan.get_lines_like('c'))
+
+def _write(**options):
+    import parse_pto
+    def setup(path):
+        return path, parse_pto.pto_scan(path, **options)
+    def run(state):
+        path, scan = state
+        if options.get('lazy'):
+            # a lazy scan changes as it's written, so it's made again every time
+            scan = parse_pto.pto_scan(path, **options)
+        start = timeit.default_timer()
+        scan.pto(StringIO())
+        return timeit.default_timer() - start
+    return setup, run
+
+def _load(mode):
+    def setup(path):
+        import app
+        app.PTO_DIR = os.path.dirname(path)
+        name = os.path.basename(path)
+        first = app.app.request('/load/' + name)
+        return app, name, first.headers['ETag']
+    def run(state):
+        app, name, etag = state
+        if mode in ('cold', 'sidecar'):
+            for cache in (app.scan_cache, app.load_cache, app.encoded_cache):
+                cache.clear()
+        if mode == 'cold':
+            shutil.rmtree(os.path.join(app.PTO_DIR, '.ptocache'), ignore_errors=True)
+        headers = {'If-None-Match': etag} if mode == '304' else {}
+        start = timeit.default_timer()
+        response = app.app.request('/load/' + name, headers=headers)
+        elapsed = timeit.default_timer() - start
+        assert response.status[:3] in ('200', '304'), response.status
+        return elapsed
+    return setup, run
+
+BENCHMARKS = [
+    ('scan', lambda: _scan()),
+    ('scan_fast', lambda: _scan(fast_scan=True)),
+    ('scan_lazy', lambda: _scan(fast_scan=True, lazy=True)),
+    ('scan_compact', lambda: _scan(fast_scan=True, lazy=True, keep_source=False)),
+    ('scan_mapped', lambda: _scan(mapped=True)),
+    ('make_member_access', _member_access),
+    ('get_lines_like', _lines_like),
+    ('pto_write', lambda: _write(fast_scan=True)),
+    ('pto_write_lazy', lambda: _write(fast_scan=True, lazy=True)),
+    ('load_cold', lambda: _load('cold')),
+    ('load_sidecar', lambda: _load('sidecar')),
+    ('load_cached', lambda: _load('cached')),
+    ('load_304', lambda: _load('304')),
+]
+
+def _measure(name, path, repeat, queue):
+    try:
+        setup, run = dict(BENCHMARKS)[name]()
+        state = setup(path)
+        gc.collect()
+        before = _peak_rss_kb()
+        times = []
+        for k in range(repeat):
+            gc.collect()
+            start = timeit.default_timer()
+            result = run(state)
+            elapsed = timeit.default_timer() - start
+            # runs which have to prepare something time themselves
+            times.append(result if isinstance(result, float) else elapsed)
+            del result
+        queue.put({'name': name, 'times': times,
+                   'peak_rss_kb': max(_peak_rss_kb() - before, 0)})
+    except Exception as e:
+        queue.put({'name': name, 'error': '%s: %s' % (type(e).__name__, e)})
+
+def run_benchmark(name, path, repeat, timeout=TIMEOUT):
+    """Time one benchmark, in a process of its own, and return its result dict."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(name, path, repeat, queue))
+    process.start()
+    deadline = time.time() + timeout
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                # it may have sent its result just before it ended
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    result = {'name': name, 'error': 'process exited with code %s'
+                              % process.exitcode}
+            elif time.time() > deadline:
+                process.terminate()
+                result = {'name': name, 'error': 'timed out after %gs' % timeout}
+    process.join()
+    if 'times' in result:
+        times = sorted(result['times'])
+        result['min'] = times[0]
+        result['median'] = times[len(times) // 2]
+    return result
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(images=20, control_points=10000, repeat=5, seed=0, only=None,
+                   report=None, timeout=TIMEOUT):
+    """
+    Generate a project and run the benchmarks (those whose name matches the
+    regular expression only, if given) on it. Returns the results document.
+    """
+    params = {'images': images, 'control_points': control_points,
+              'repeat': repeat, 'seed': seed}
+    tmpdir = tempfile.mkdtemp(prefix='ptobench-')
+    try:
+        path = write_pto(os.path.join(tmpdir, 'bench.pto'), images=images,
+                         control_points=control_points, seed=seed)
+        params['file_size'] = os.path.getsize(path)
+        results = []
+        for name, make in BENCHMARKS:
+            if only and not re.search(only, name):
+                continue
+            result = run_benchmark(name, path, repeat, timeout)
+            results.append(result)
+            if report:
+                report(result)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return {
+        'version': RESULTS_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': _revision(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'params': params,
+        'results': results,
+    }
+
+def _print_result(result):
+    if 'error' in result:
+        print('%-20s failed: %s' % (result['name'], result['error']))
+    else:
+        print('%-20s min %9.4fs  median %9.4fs  peak +%d kB' % (
+            result['name'], result['min'], result['median'], result['peak_rss_kb']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark parse_pto and the web app.')
+    parser.add_argument('-i', '--images', type=int, default=20)
+    parser.add_argument('-c', '--control-points', type=int, default=10000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('-k', '--only', metavar='REGEX',
+                        help='only run the benchmarks whose name matches')
+    parser.add_argument('-o', '--output', help='results file (default: bench-<time>.json)')
+    parser.add_argument('-t', '--timeout', type=float, default=TIMEOUT,
+                        help='seconds a benchmark may take (default: %d)' % TIMEOUT)
+    args = parser.parse_args(argv)
+
+    document = run_benchmarks(args.images, args.control_points, args.repeat,
+                              args.seed, args.only, report=_print_result,
+                              timeout=args.timeout)
+    output = args.output or 'bench-%s.json' % time.strftime('%Y%m%d-%H%M%S')
+    with open(output, 'w') as f:
+        json.dump(document, f, indent=1, sort_keys=True)
+    print('results written to %s' % output)
+    return 1 if any('error' in r for r in document['results']) else 0
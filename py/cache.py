@@ -0,0 +1,88 @@
+import os
+import threading
+from collections import OrderedDict
+
+def file_stamp(filename):
+    """Return a (mtime, size) pair identifying the current version of a file."""
+    st = os.stat(filename)
+    return (st.st_mtime, st.st_size)
+
+class lru_cache(object):
+    """
+    Thread-safe LRU mapping for parsed projects and the payloads built from them.
+
+    Every entry is stored together with a stamp (usually ``file_stamp()`` of the
+    source pto file); a lookup with a different stamp counts as a miss and drops
+    the stale entry. The cache is bounded by ``max_entries`` and, optionally, by
+    ``max_cost``, where the cost of an entry is whatever the caller passes to
+    ``put()`` (the app uses the size of the source file in bytes).
+    """
+
+    def __init__(self, max_entries=32, max_cost=None):
+        self.max_entries = max_entries
+        self.max_cost = max_cost
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.cost = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, stamp=None, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] != stamp:
+                self.cost -= entry[2]
+                self.misses += 1
+                return default
+            self._entries[key] = entry # re-insert as most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, stamp=None, cost=0):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.cost -= old[2]
+            self._entries[key] = (stamp, value, cost)
+            self.cost += cost
+            self._evict()
+        return value
+
+    def discard(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.cost -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.cost = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'cost': self.cost,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def _evict(self):
+        # always keep the entry that was just added, even if it is over budget
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or
+                (self.max_cost is not None and self.cost > self.max_cost)):
+            key, entry = self._entries.popitem(last=False)
+            self.cost -= entry[2]
+            self.evictions += 1
@@ -0,0 +1,162 @@
+"""
+An in-memory index of the projects in a directory, for /list.
+
+The catalog polls the directory at most every `interval` seconds: a changed
+directory mtime means files came or went, and a changed file stamp (mtime,
+size) means a project has to be summarized again. A summary is cheap to make -
+the file is read once, counting i- and c-lines and scanning only the p-line -
+and is kept until the file changes. Listings are served from orderings that
+are sorted once per change, so a page costs the same no matter how many
+projects there are.
+"""
+import os
+import time
+import hashlib
+import threading
+import parse_pto
+from cache import file_stamp
+
+# the panorama projections of the p-line's f member
+PROJECTIONS = {
+    0: 'rectilinear', 1: 'cylindrical', 2: 'equirectangular', 3: 'fisheye',
+    4: 'stereographic', 5: 'mercator', 6: 'transverse mercator', 7: 'sinusoidal',
+    8: 'lambert cylindrical equal area', 9: 'lambert azimuthal equal area',
+    10: 'albers equal area conic', 11: 'miller cylindrical', 12: 'panini',
+    13: 'architectural', 14: 'orthographic', 15: 'equisolid',
+    16: 'equirectangular panini', 17: 'biplane', 18: 'triplane',
+    19: 'panini general', 20: 'thoby', 21: 'hammer',
+}
+
+SORT_KEYS = ('name', 'mtime', 'size', 'images', 'control_points')
+
+def summarize(path):
+    """Cheap metadata of a pto file, as a dict."""
+    stamp = file_stamp(path)
+    images = control_points = 0
+    p_line = None
+    with open(path) as f:
+        for line in parse_pto.iter_pto(f, headers='pic', fast_scan=True, lazy=True,
+                                       keep_source=False):
+            if line.header == 'i':
+                images += 1
+            elif line.header == 'c':
+                control_points += 1
+            elif p_line is None:
+                p_line = line
+    entry = {
+        'name': os.path.basename(path),
+        'mtime': stamp[0],
+        'size': stamp[1],
+        'images': images,
+        'control_points': control_points,
+        'width': None,
+        'height': None,
+        'fov': None,
+        'projection': None,
+    }
+    if p_line is not None:
+        projection = p_line.extract('f')
+        entry.update({
+            'width': p_line.extract('w'),
+            'height': p_line.extract('h'),
+            'fov': p_line.extract('v'),
+            'projection': PROJECTIONS.get(projection, projection),
+        })
+    return entry
+
+class project_catalog(object):
+    """
+    The summaries of all files with one of `extensions` in `directory`, kept
+    up to date by polling every `interval` seconds (0 checks on every call).
+    `version` goes up whenever anything in the listing changes, `signature`
+    is a hash of the names and stamps of the files listed.
+    """
+
+    def __init__(self, directory, interval=2.0, extensions=('.pto',)):
+        self.directory = directory
+        self.interval = interval
+        self.extensions = extensions
+        self.version = 0
+        self.signature = None
+        self.changed = 0.0
+        self._entries = {}
+        self._orders = {}
+        self._dir_mtime = None
+        self._checked = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self.update()
+        return len(self._entries)
+
+    def get(self, name):
+        self.update()
+        return self._entries.get(name)
+
+    def update(self, force=False):
+        """Bring the index up to date, if the polling interval has passed."""
+        now = time.time()
+        if not force and self._checked is not None and now - self._checked < self.interval:
+            return
+        with self._lock:
+            if not force and self._checked is not None and now - self._checked < self.interval:
+                return
+            self._refresh()
+            self._checked = time.time()
+
+    def _refresh(self):
+        dir_mtime = os.stat(self.directory).st_mtime
+        if dir_mtime != self._dir_mtime:
+            names = [name for name in os.listdir(self.directory)
+                     if os.path.splitext(name)[1].lower() in self.extensions]
+        else:
+            names = self._entries.keys()
+        entries = {}
+        changed = self._checked is None or (
+            dir_mtime != self._dir_mtime and set(names) != set(self._entries))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            old = self._entries.get(name)
+            try:
+                stamp = file_stamp(path)
+                if old is not None and (old['mtime'], old['size']) == stamp:
+                    entries[name] = old
+                    continue
+                entries[name] = summarize(path)
+            except EnvironmentError:
+                # gone since the listing, the next poll will notice
+                continue
+            changed = True
+        if len(entries) != len(names):
+            changed = True
+        self._dir_mtime = dir_mtime
+        if changed:
+            self._entries = entries
+            self._orders = {}
+            self.version += 1
+            self.signature = hashlib.sha1(repr(sorted(
+                (e['name'], e['mtime'], e['size']) for e in entries.values()))).hexdigest()
+            self.changed = max(dir_mtime, max([e['mtime'] for e in entries.values()] or [0]))
+
+    def _order(self, key, reverse):
+        order = self._orders.get((key, reverse))
+        if order is None:
+            entries = self._entries.values()
+            if key == 'name':
+                order = sorted(entries, key=lambda e: e['name'], reverse=reverse)
+            else:
+                order = sorted(entries, key=lambda e: (e[key], e['name']), reverse=reverse)
+            self._orders[(key, reverse)] = order
+        return order
+
+    def listing(self, sort='name', reverse=False, offset=0, limit=None):
+        """
+        A page of the catalog's entries, ordered by one of SORT_KEYS, together
+        with the total number of entries: (entries, total).
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError("Can't sort by %r" % sort)
+        self.update()
+        with self._lock:
+            order = self._order(sort, bool(reverse))
+        return order[offset:None if limit is None else offset + limit], len(order)
@@ -0,0 +1,186 @@
+"""
+Placement of the source images in the viewer's 3D scene, computed for all
+images of a project at once with numpy.
+
+The renderer shows every image as a flat, mirrored plane of PLANE_SIZE units
+facing the viewer. placement() reproduces renderer.js's addImage(): the plane
+is pushed out until it spans the image's field of view, turned by the Euler
+angles (in three.js's XYZ order) that addImage() uses and moved to its yaw and
+pitch on the sphere around the camera.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the imgsize of renderer.js
+PLANE_SIZE = 800
+
+def placement(yaw, pitch, roll, view, size=PLANE_SIZE):
+    """
+    The planes' geometry for arrays of yaw, pitch, roll and field of view (in
+    degrees), as a dict of arrays: 'distance' (n), 'position' (n x 3),
+    'rotation' (n x 3, Euler angles in radians) and 'quaternion' (n x 4,
+    x y z w, the same rotation). Images with a NaN input get NaN rows.
+    """
+    if numpy is None:
+        raise ImportError("numpy is needed for placement geometry")
+    yaw, pitch, roll, view = [numpy.asarray(a, dtype=numpy.float64)
+                              for a in (yaw, pitch, roll, view)]
+    radians = numpy.pi / 180
+    distance = (size / 2.0) / numpy.cos((180 - view) / 2 * radians)
+
+    # addImage() adds 90 to the yaw after converting it to radians; it's kept
+    # here so that both ways of placing the images agree
+    rotation = numpy.empty(yaw.shape + (3,))
+    rotation[..., 0] = pitch * radians
+    rotation[..., 1] = 90 - yaw * radians
+    rotation[..., 2] = roll * radians
+
+    phi = (90 - pitch) * radians
+    theta = yaw * radians
+    position = numpy.empty(yaw.shape + (3,))
+    position[..., 0] = distance * numpy.sin(phi) * numpy.cos(theta)
+    position[..., 1] = distance * numpy.cos(phi)
+    position[..., 2] = distance * numpy.sin(phi) * numpy.sin(theta)
+
+    return {
+        'distance': distance,
+        'position': position,
+        'rotation': rotation,
+        'quaternion': euler_quaternion(rotation),
+    }
+
+def euler_quaternion(rotation):
+    """Quaternions (x y z w) for rows of XYZ Euler angles."""
+    half = numpy.asarray(rotation, dtype=numpy.float64) / 2
+    c = numpy.cos(half)
+    s = numpy.sin(half)
+    c1, c2, c3 = c[..., 0], c[..., 1], c[..., 2]
+    s1, s2, s3 = s[..., 0], s[..., 1], s[..., 2]
+    quaternion = numpy.empty(half.shape[:-1] + (4,))
+    quaternion[..., 0] = s1 * c2 * c3 + c1 * s2 * s3
+    quaternion[..., 1] = c1 * s2 * c3 - s1 * c2 * s3
+    quaternion[..., 2] = c1 * c2 * s3 + s1 * s2 * c3
+    quaternion[..., 3] = c1 * c2 * c3 - s1 * s2 * s3
+    return quaternion
+
+def euler_matrix(rotation):
+    """3x3 rotation matrices for rows of XYZ Euler angles, as three.js makes them."""
+    rotation = numpy.asarray(rotation, dtype=numpy.float64)
+    c = numpy.cos(rotation)
+    s = numpy.sin(rotation)
+    a, c_y, e = c[..., 0], c[..., 1], c[..., 2]
+    b, d, f = s[..., 0], s[..., 1], s[..., 2]
+    matrix = numpy.empty(rotation.shape[:-1] + (3, 3))
+    matrix[..., 0, 0] = c_y * e
+    matrix[..., 0, 1] = -c_y * f
+    matrix[..., 0, 2] = d
+    matrix[..., 1, 0] = a * f + b * e * d
+    matrix[..., 1, 1] = a * e - b * f * d
+    matrix[..., 1, 2] = -b * c_y
+    matrix[..., 2, 0] = b * f - a * e * d
+    matrix[..., 2, 1] = b * e + a * f * d
+    matrix[..., 2, 2] = a * c_y
+    return matrix
+
+def image_transforms(images, size=PLANE_SIZE):
+    """
+    The placement of every image of an image_table (with back-references
+    resolved) as JSON-ready dicts with 'position' and 'quaternion', or None for
+    images lacking any of y, p, r and v.
+    """
+    geometry = placement(images.array('y'), images.array('p'), images.array('r'),
+                         images.array('v'), size)
+    rows = numpy.hstack([geometry['position'], geometry['quaternion']])
+    valid = numpy.isfinite(rows).all(axis=1)
+    return [{'position': row[:3].tolist(), 'quaternion': row[3:].tolist()} if ok else None
+            for row, ok in zip(rows, valid)]
+
+def directions(yaw, pitch):
+    """
+    Unit vectors (n x 3) pointing at yaw and pitch (in degrees), the way the
+    renderer places images and aims its camera (lon and lat in render()).
+    """
+    radians = numpy.pi / 180
+    phi = (90 - numpy.asarray(pitch, dtype=numpy.float64)) * radians
+    theta = numpy.asarray(yaw, dtype=numpy.float64) * radians
+    sin_phi = numpy.sin(phi)
+    return numpy.stack([sin_phi * numpy.cos(theta), numpy.cos(phi),
+                        sin_phi * numpy.sin(theta)], axis=-1)
+
+# the i-line projections (f) in which the angle grows with the distance from
+# the centre, rather than its tangent; rectilinear (0) is the other kind
+RECTILINEAR = 0
+
+def footprint_radius(view, width, height, projection=RECTILINEAR):
+    """
+    The angular radius (in radians) of the smallest cap around an image's
+    centre that holds all of it, for arrays of horizontal field of view (in
+    degrees), size in pixels and projection. It's the angle to the corners,
+    which is the same however the image is rolled.
+    """
+    view, width, height, projection = [numpy.asarray(a, dtype=numpy.float64)
+                                       for a in (view, width, height, projection)]
+    half = view / 2 * numpy.pi / 180
+    aspect = height / width
+    with numpy.errstate(invalid='ignore'):
+        # rectilinear: the corner is at the diagonal's tangent
+        tangent = numpy.tan(numpy.minimum(half, numpy.pi / 2))
+        rectilinear = numpy.arctan(tangent * numpy.sqrt(1 + aspect * aspect))
+        rectilinear = numpy.where(half >= numpy.pi / 2, numpy.pi, rectilinear)
+        # the others: angles go with pixels
+        linear = half * numpy.sqrt(1 + aspect * aspect)
+    radius = numpy.where(projection == RECTILINEAR, rectilinear, linear)
+    return numpy.minimum(radius, numpy.pi)
+
+class footprint_index(object):
+    """
+    The footprints of a project's images on the sphere (a cap around each
+    image's centre, see footprint_radius), for finding the images a view
+    overlaps. The images are sorted by pitch: an image is only looked at if
+    its centre is near enough in pitch to the view's to overlap it at all, so
+    a query costs a binary search and a test of the images in a band of the
+    sphere. Images lacking any of y, p, v, w and h are never visible.
+    """
+
+    def __init__(self, yaw, pitch, view, width, height, projection=RECTILINEAR):
+        yaw, pitch = [numpy.asarray(a, dtype=numpy.float64) for a in (yaw, pitch)]
+        radius = footprint_radius(view, width, height, projection)
+        valid = numpy.isfinite(yaw) & numpy.isfinite(pitch) & numpy.isfinite(radius)
+        self.images = len(yaw)
+        images = numpy.flatnonzero(valid)
+        order = numpy.argsort(pitch[images], kind='mergesort')
+        self._images = images[order]
+        self._pitch = pitch[self._images] * numpy.pi / 180
+        self._directions = directions(yaw[self._images], pitch[self._images])
+        self._radius = radius[self._images]
+        self._widest = float(self._radius.max()) if len(self._radius) else 0.0
+
+    @classmethod
+    def from_images(cls, images):
+        """The footprint_index of an image_table (with back-references resolved)."""
+        projection = images.array('f')
+        return cls(images.array('y'), images.array('p'), images.array('v'),
+                   images.array('w'), images.array('h'),
+                   numpy.where(numpy.isnan(projection), RECTILINEAR, projection))
+
+    def visible(self, yaw, pitch, fov, aspect=1.0):
+        """
+        The numbers of the images, in ascending order, whose footprint overlaps
+        a view in direction yaw and pitch with a vertical field of view of fov
+        degrees and width / height aspect, as render() shows it.
+        """
+        half = fov / 2.0 * numpy.pi / 180
+        view = min(numpy.arctan(numpy.tan(min(half, numpy.pi / 2 - 1e-9)) *
+                                numpy.sqrt(1 + aspect * aspect)), numpy.pi)
+        reach = view + self._widest
+        centre = pitch * numpy.pi / 180
+        start = numpy.searchsorted(self._pitch, centre - reach, 'left')
+        end = numpy.searchsorted(self._pitch, centre + reach, 'right')
+        direction = directions(yaw, pitch)
+        cosines = self._directions[start:end].dot(direction)
+        angles = numpy.arccos(numpy.clip(cosines, -1, 1))
+        found = self._images[start:end][angles <= self._radius[start:end] + view]
+        found.sort()
+        return found
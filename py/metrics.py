@@ -0,0 +1,190 @@
+"""
+Counters and histograms for the server, served in the Prometheus text format
+by /metrics.
+
+A registry holds the metrics by name; every value is kept per set of labels,
+like the phase of a scan or the handler of a request. Callbacks added with
+add_callback see every value recorded, as (kind, name, value, labels), so the
+numbers can be forwarded to some other system as well.
+"""
+import bisect
+import threading
+import contextlib
+import timeit
+
+# upper bounds of the histogram buckets, in seconds: 1ms to 10s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+class histogram(object):
+    """Counts of observed values by bucket, with their sum and number."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # a bucket counts the values up to and including its bound
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(bound, number of values <= bound) for every bucket, up to +Inf."""
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+class registry(object):
+    """
+    Named counters and histograms. Metrics used without being described are
+    made on the fly, as counters or histograms with the default buckets; their
+    names get prefix in front. A registry which isn't enabled records nothing.
+    """
+
+    def __init__(self, prefix='', enabled=True):
+        self.prefix = prefix
+        self.enabled = enabled
+        self._metrics = {}      # name -> [kind, help, buckets, {labels: value}]
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help='', buckets=DEFAULT_BUCKETS):
+        """Declare a 'counter' or 'histogram', with its help text."""
+        with self._lock:
+            metric = self._metrics.setdefault(name, [kind, help, buckets, {}])
+            metric[1] = help
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def _values(self, name, kind):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics.setdefault(name, [kind, '', DEFAULT_BUCKETS, {}])
+        if metric[0] != kind:
+            raise ValueError('%s is a %s' % (name, metric[0]))
+        return metric
+
+    def inc(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values(name, 'counter')[3]
+            values[key] = values.get(key, 0) + amount
+        self._notify('counter', name, amount, labels)
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric = self._values(name, 'histogram')
+            values = metric[3].get(key)
+            if values is None:
+                values = metric[3][key] = histogram(metric[2])
+            values.observe(value)
+        self._notify('histogram', name, value, labels)
+
+    @contextlib.contextmanager
+    def time(self, name, **labels):
+        """Observe the seconds the with block takes in a histogram."""
+        if not self.enabled:
+            yield
+            return
+        started = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.observe(name, timeit.default_timer() - started, **labels)
+
+    def _notify(self, kind, name, value, labels):
+        for callback in self._callbacks:
+            try:
+                callback(kind, name, value, labels)
+            except Exception:
+                pass # a broken forwarder mustn't break the request it measures
+
+    def value(self, name, **labels):
+        """A counter's value, or a histogram, for these labels - None if there's none."""
+        metric = self._metrics.get(name)
+        if metric is None:
+            return None
+        return metric[3].get(tuple(sorted(labels.items())))
+
+    def clear(self):
+        with self._lock:
+            for metric in self._metrics.values():
+                metric[3].clear()
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            for name in sorted(self._metrics):
+                kind, help, buckets, values = self._metrics[name]
+                full = self.prefix + name
+                if help:
+                    lines.append('# HELP %s %s' % (full, _escape(help, False)))
+                lines.append('# TYPE %s %s' % (full, kind))
+                for key in sorted(values):
+                    value = values[key]
+                    if kind == 'counter':
+                        lines.append('%s%s %s' % (full, _labels(key), _number(value)))
+                        continue
+                    for bound, count in value.cumulative():
+                        lines.append('%s_bucket%s %d' % (
+                            full, _labels(key + (('le', _number(bound)),)), count))
+                    lines.append('%s_sum%s %s' % (full, _labels(key), _number(value.sum)))
+                    lines.append('%s_count%s %d' % (full, _labels(key), value.count))
+        return '\n'.join(lines) + '\n'
+
+def _escape(text, quotes=True):
+    text = str(text).replace('\\', r'\\').replace('\n', r'\n')
+    return text.replace('"', r'\"') if quotes else text
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in key)
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def scan_recorder(registry):
+    """
+    A parse_pto.scan_observer which records what the scans report in
+    registry: the seconds of each phase, and the lines, members and bytes.
+    """
+    def record(event, phases, counts):
+        registry.inc('pto_scans_total', event=event)
+        for phase, seconds in phases.items():
+            registry.observe('pto_scan_phase_seconds', seconds, phase=phase)
+        for header, lines in counts['lines'].items():
+            registry.inc('pto_scan_lines_total', lines, header=header)
+        registry.inc('pto_scan_members_total', counts['members'])
+        registry.inc('pto_scan_bytes_total', counts['bytes'])
+    return record
+
+def describe_scan_metrics(registry):
+    registry.describe('pto_scans_total', 'counter',
+                      'Scans of pto files, by where the scan came from')
+    registry.describe('pto_scan_phase_seconds', 'histogram',
+                      'Time spent in each phase of scanning pto files')
+    registry.describe('pto_scan_lines_total', 'counter',
+                      'Lines scanned, by line header')
+    registry.describe('pto_scan_members_total', 'counter', 'Line members scanned')
+    registry.describe('pto_scan_bytes_total', 'counter', 'Bytes read from pto files')
@@ -52,7 +52,30 @@ gpl = r"""
 import string
 import sys
 import re
+import gc
+import os
 import argparse
+import struct
+import marshal
+import mmap
+import hashlib
+import tempfile
+import difflib
+import array
+import stat
+import timeit
+import glob
+import json
+import multiprocessing
+import collections
+
+# numpy is only needed for the array exports of the scan, like
+# control_points_array() - the scanner itself does without.
+
+try :
+    import numpy
+except ImportError :
+    numpy = None
 
 # the following set of characters are what I reckon is the standard set
 # of accepted pto line headers. If you want to make the parser behave like in the
@@ -134,6 +157,203 @@ pto_member_re = re.compile ( r"""
     )                              # end of <member_text>
     """ , re.VERBOSE )
 
+# The RE above is nice to read, but slow to use: for every member, the scanner
+# has to ask the match object for up to six groups before it knows what it's got.
+# For the fast scanning engine (pass fast_scan=True to pto_scan) the same RE
+# is rewritten so that it has exactly one capturing group per alternative and
+# no nested ones. Then findall() can produce the whole line in one go, as a list
+# of tuples, and the single non-empty value group tells us the data type.
+# The alternatives and their order must be kept exactly as in pto_member_re,
+# otherwise the two engines will disagree - tests.py checks that they don't.
+
+fast_member_re = re.compile ( r"""
+    \s*
+    ( R[a-e] | V[a-dxym] | T[xyzrs][XYZ]* | E[rb] | Eev | [A-Za-z] ) # qualifier
+    (?:
+        ( [+-]? (?: \d+ [.] \d* | [.] \d+ ) )                    # float
+      | ( [+-]?\d+ , [+-]?\d+ , [+-]?\d+ , [+-]?\d+ )             # rectangle
+      | ( [+-]?\d+ )                                              # integer
+      | = ( \d+ )                                                 # back reference
+      | " ( (?: [^"] | \\ " )* ) "                                # string
+      | ( \S+ )                                                   # word
+    )
+    """ , re.VERBOSE )
+
+# If scan_observer is set to a function, every pto_scan reports to it what it
+# did and how long it took, once it's done, as
+#
+# scan_observer ( event , phases , counts )
+#
+# event is 'scan' for a scan of the pto file, 'sidecar' for one taken from
+# it's sidecar file and 'realize' for a call of realize(). phases maps the
+# phases of the work to the seconds they took: 'scan' (reading the file and
+# making the lines, which go hand in hand), 'member_access', 'sidecar_read'
+# and 'sidecar_write' - a mapped scan, which finds all the lines before it
+# makes any, has 'read' and 'classify' instead of 'scan'. counts has 'lines'
+# (a dict: line header -> number of lines), 'members' (the number of members
+# scanned) and 'bytes' (read from the pto file). Lines of a lazy scan which
+# are scanned one by one as they're used aren't reported.
+# An observed scan is made just like any other, so apart from counting the
+# lines and members once it's done, observing costs next to nothing; without
+# an observer, nothing at all.
+
+scan_observer = None
+
+_timer = timeit.default_timer
+
+# iter_pto is the streaming version of the scan: it reads a pto file line by line
+# and yields the pto_line objects, in order, as they are made, so you can walk
+# through a huge file without ever holding more than one line of it. pto_scan
+# (see below) simply collects what iter_pto yields.
+# pto_data can be a file name or an open file; if iter_pto opened the file,
+# it also closes it. If you pass headers, only lines with these headers are
+# yielded, and the others aren't even scanned. headers can be a string of line
+# header letters, like 'pi', or a collection of headers, like [ 'i' , '#-hugin' ].
+# The remaining arguments are those of pto_scan, see there.
+
+def iter_pto ( pto_data ,
+               headers = None ,
+               accepted_line_headers = string.letters ,
+               scan_extensions = True ,
+               fast_scan = False ,
+               keep_source = True ,
+               lazy = False ) :
+
+    if type ( pto_data ) == str :
+        ptofile = open ( pto_data , 'r' )
+    elif hasattr ( pto_data , '__iter__' ) : # a file, or any other source of lines
+        ptofile = pto_data
+    else :
+        raise NameError ( "no pto data found" )
+
+    if type ( headers ) == str :
+        headers = set ( headers )
+
+    try :
+        star = False
+        for lineno , line in enumerate ( ptofile ) :
+
+            if star :                   # everything past the star we ignore,
+                header , kind = '' , None # but we also record it
+            else :
+                header , kind = _classify_line ( line ,
+                                                 accepted_line_headers ,
+                                                 scan_extensions )
+                star = header == '*'
+
+            if headers is not None and header not in headers :
+                continue                # not wanted - so we don't scan it either
+
+            yield _make_line ( line , lineno , header , kind ,
+                               fast_scan , keep_source , lazy )
+
+    finally :
+        if ptofile is not pto_data :
+            ptofile.close()
+
+# _map_file maps a file for a mapped scan (see pto_scan). It returns None
+# for files which can't be mapped: pipes and other files which aren't regular
+# ones, files which have been read from already, and whatever mmap refuses. An
+# empty file can't be mapped either, but it's easy enough to scan.
+
+def _map_file ( ptofile ) :
+    try :
+        fileno = ptofile.fileno()
+        status = os.fstat ( fileno )
+        if not stat.S_ISREG ( status.st_mode ) or ptofile.tell() != 0 :
+            return None
+        if status.st_size == 0 :
+            return ''
+        return mmap.mmap ( fileno , 0 , access = mmap.ACCESS_READ )
+    except ( AttributeError , ValueError , EnvironmentError ) :
+        return None
+
+# _counting passes on the lines of ptofile, coming from lines, and counts
+# their bytes for an observer: a real file is simply measured, anything else
+# is counted on the way
+
+def _counting ( ptofile , lines , counts ) :
+    try :
+        counts [ 'bytes' ] = os.fstat ( ptofile.fileno() ).st_size - ptofile.tell()
+        return lines
+    except ( AttributeError , EnvironmentError , ValueError ) :
+        return _counted ( lines , counts )
+
+def _counted ( lines , counts ) :
+    for line in lines :
+        counts [ 'bytes' ] += len ( line )
+        yield line
+
+# _hashing passes on the lines it gets and records their hashes on the way
+
+def _hashing ( lines , hashes ) :
+    for line in lines :
+        hashes.append ( hash ( line ) )
+        yield line
+
+# _make_line makes the pto_line object for a line _classify_line has looked at
+
+def _make_line ( line , lineno , header , kind , fast_scan , keep_source , lazy ) :
+
+    if kind is pto_line :
+        # in a lazy scan, the line is only recorded with it's header
+        # for now. Lines with nothing after the header are trivial
+        # to scan, they are done right away.
+        ptoline = pto_line ( line , lineno , header , scan = True ,
+                             fast = fast_scan ,
+                             lazy = lazy and not line[1:].isspace() ,
+                             keep_source = keep_source )
+    elif kind is None :
+        ptoline = pto_line ( line , lineno , header , scan = False )
+    elif kind is hugin_option_line :
+        ptoline = hugin_option_line ( line , lineno )
+    else :
+        ptoline = kind ( line , lineno , header , fast = fast_scan )
+
+    if not keep_source and not ptoline.pending() and ptoline.members :
+        ptoline.sourcecode = None  # pto() and str() don't need it
+
+    return ptoline
+
+# _classify_line looks at the beginning of a line and decides what it is. It
+# returns the line's header and the class to scan it with - or None if the
+# line isn't going to be scanned at all.
+
+def _classify_line ( line , accepted_line_headers , scan_extensions ) :
+
+    # accepted_line_headers contains all letters that will be accepted
+    # as heading a valid pto line. Per default this will be any letter,
+    # but it can be limited to just the 'canonical' line headers by
+    # passing the appropriate string to pto_scan.
+
+    if line[0] in accepted_line_headers :
+        return line[0] , pto_line
+
+    if line[0] == '#' : # this is a comment, but might be an extension
+
+        if scan_extensions : # we look into the line to see if it's an extension
+
+            # the parade of the ugly ducklings...
+
+            if hugin_extension_re.match ( line ) :
+                return '#-hugin' , hugin_extension_line
+
+            m = hugin_option_re.match ( line )
+            if m :
+                return m.group ( 0 ) , hugin_option_line
+
+            if imgfile_extension_re.match ( line ) :
+                return '#-imgfile' , imgfile_extension_line
+
+        # just a plain old comment
+        return '#' , None
+
+    if line[0] == '*' : # a line starting with a star means: ignore the rest
+        return '*' , None
+
+    # this shouldn't be a pto line, don't parse, but record.
+    return '' , None
+
 # now for the data types for the result of the scan of the pto lines:
 
 # topmost is class pto_scan. This performs and contains the scan of a whole
@@ -158,6 +378,19 @@ pto_member_re = re.compile ( r"""
 # object by the name of s, access is by s.i (images), s.c (control points)
 # etc., and will yield a list of pto_line objects of that type, so simplified
 # access syntax along the lines of s.i[7] (the seventh i-line) is possible
+#
+# With mapped=True, the file isn't read at all: it's mapped into memory and the
+# lines are found there, and only the text of the lines that get scanned is ever
+# copied out of it (see _mapped_scan). A mapped scan is always lazy and uses the
+# fast engine; it needs a regular file, read from its start - with any other
+# input, or if the file can't be mapped, the file is read as usual.
+#
+# If you pass lazy=True, the pto lines are only classified by their header when
+# the scan is made; the scanning of their members is done the first time
+# they are used, be it line by line or for a whole group with realize().
+# If you only need the p- and i-lines of a project with thousands of c-lines,
+# that's much quicker. Note that in a lazy scan, s.c etc. will also contain
+# the odd line which turns out to have no members at all once it's scanned.
 
 class pto_scan :
 
@@ -165,7 +398,12 @@ class pto_scan :
                    pto_data ,
                    accepted_line_headers = string.letters ,
                    scan_extensions = True ,
-                   member_access = True ) : # KFJ 2010-01-03 now per default
+                   member_access = True ,   # KFJ 2010-01-03 now per default
+                   fast_scan = False ,      # use the findall-based scanning engine
+                   keep_source = True ,     # keep the text of lines with members
+                   lazy = False ,           # scan pto lines only when they're used
+                   sidecar = False ,        # use and keep a binary cache file
+                   mapped = False ) :       # read the file through mmap (lazy)
 
         # new KFJ 2010-12-27: allow open files as input
         if type ( pto_data ) == str :
@@ -178,72 +416,183 @@ class pto_scan :
             print ( pto_data )
             raise NameError ( "no pto data found" )
         
-        ptolines = ptofile.readlines()    # get the file's content
-        ptofile.close()                   # we're done with the file
+        fast_scan = fast_scan or mapped
+        lazy = lazy or mapped
 
         self.accepted_line_headers = accepted_line_headers # we store that, too
         self.scan_extensions = scan_extensions # and that
+        self.fast_scan = fast_scan        # and which engine did the scanning
+        self.keep_source = keep_source    # and whether we kept the text
+        self.lazy = lazy                  # and whether the scan is deferred
         self.sequential = []              # that's where our scan goes
 
-        lineiter = iter ( ptolines )      # make separate iter, so we can keep
-                                          # iterating after the loop terminates
-        lineno = -1                       # first increment will set it to start at 0
-
-        for line in lineiter :            # as long as there are lines
-            lineno += 1
-            # accepted_line_headers contains all letters that will be accepted
-            # as heading a valid pto line. Per default this will be any letter,
-            # but it can be limited to just the 'canonical' line headers by
-            # passing the appropriate string to __init__.
-
-            if line[0] in accepted_line_headers :
-                ptoline = pto_line ( line , lineno , line[0] , scan = True )
-
-            elif line[0] == '#' : # this is a comment, but might be an extension
-
-                if self.scan_extensions : # we look into the line to see if it's an extension
-
-                    # the parade of the ugly ducklings...
-
-                    if hugin_extension_re.match ( line ) :
-                        # it's a hugin extension
-                        ptoline = hugin_extension_line ( line , lineno , '#-hugin' )
-
-                    elif hugin_option_re.match ( line ) :
-                        # it's a hugin option
-                        ptoline = hugin_option_line ( line , lineno )
-
-                    elif imgfile_extension_re.match ( line ) :
-                        # it's an 'imgfile extension line'
-                        ptoline = imgfile_extension_line ( line , lineno , '#-imgfile' )
-
-                    else:
-                        # just a plain old comment
-                        ptoline = pto_line ( line , lineno, '#' , scan = False )
-
-                else : # scan_extensions is False
-                    
-                    # take this line as a comment
-                    ptoline = pto_line ( line , lineno, '#' , scan = False )
-
-            elif line[0] == '*' : # a line starting with a star means: ignore the rest
-                ptoline = pto_line ( line , lineno , '*' , scan = False )
-                self.sequential.append ( ptoline ) # since we break, we need to do this
-                break
-
-            else: # this shouldn't be a pto line, don't parse, but record. proceed.
-                ptoline = pto_line ( line , lineno , '' , scan = False )
-
-            self.sequential.append ( ptoline ) # append to sequential, loop
-
-        # everything past the star we ignore, but we also record it
-        for line in lineiter : # any trailing lines?
-            lineno += 1
-            ptoline = pto_line ( line , lineno , '' , scan = False )
-            self.sequential.append ( ptoline )
+        # with sidecar=True, we first look for a valid sidecar file (see
+        # write_sidecar below) and take the scan from there if we can.
+
+        observer = scan_observer
+        phases = counts = None
+        if observer is not None :
+            phases = {}
+            counts = { 'bytes' : 0 }
+
+        if sidecar and type ( pto_data ) == str :
+            self._source_stamp = _file_stamp ( pto_data )
+            if observer is not None :
+                started = _timer()
+            found = _read_sidecar ( self )
+            if observer is not None :
+                phases [ 'sidecar_read' ] = _timer() - started
+            if found :
+                ptofile.close()
+                if member_access is True :
+                    if observer is not None :
+                        started = _timer()
+                    self.make_member_access()
+                    if observer is not None :
+                        phases [ 'member_access' ] = _timer() - started
+                if observer is not None :
+                    self._observed ( observer , 'sidecar' , phases , counts )
+                return
+
+        # the scan creates lots of small objects, none of which can form reference
+        # cycles, so the cyclic garbage collector would just waste its time
+        # traversing them over and over. The fast engine switches it off meanwhile.
+
+        collecting = ( fast_scan or lazy ) and gc.isenabled()
+        if collecting :
+            gc.disable()
+
+        # without the source text, refresh() needs something else to tell
+        # whether a line has changed, so the hashes of the lines are kept.
+
+        if mapped :
+            buffer = _map_file ( ptofile )
+            mapped = buffer is not None
+
+        lines = ptofile
+        if not keep_source and not mapped :
+            self._line_hashes = array.array ( 'l' )
+            lines = _hashing ( ptofile , self._line_hashes )
+
+        if observer is not None and not mapped :
+            lines = _counting ( ptofile , lines , counts )
+            started = _timer()
+
+        try :
+            if mapped :
+                self._mapped_scan ( buffer , phases , counts )
+            else :
+                self.sequential.extend ( iter_pto ( lines ,
+                                                    None ,
+                                                    accepted_line_headers ,
+                                                    scan_extensions ,
+                                                    fast_scan ,
+                                                    keep_source ,
+                                                    lazy ) )
+        finally :
+            ptofile.close()               # we're done with the file
+            if collecting :
+                gc.enable()
+        if observer is not None and not mapped :
+            phases [ 'scan' ] = _timer() - started
 
         if member_access is True :    # this is the default now
+            if observer is not None :
+                started = _timer()
             self.make_member_access()
+            if observer is not None :
+                phases [ 'member_access' ] = _timer() - started
+
+        if sidecar and type ( pto_data ) == str :
+            if observer is not None :
+                started = _timer()
+            try :
+                write_sidecar ( self )
+            except EnvironmentError : # it's just a cache; never mind if we can't
+                pass
+            if observer is not None :
+                phases [ 'sidecar_write' ] = _timer() - started
+
+        if observer is not None :
+            self._observed ( observer , 'scan' , phases , counts )
+
+    # _mapped_scan is the scan with mapped=True. The file is mapped into memory
+    # and the line ends are found in the mapping, all at once if numpy is there.
+    # Then only the first character of a pto line is looked at: the line object
+    # just records where the line is in the mapping (see mapped_pto_line below),
+    # and the text is only copied out of it when the line is scanned. Comments
+    # and the other lines are made as usual, they're few.
+    # The mapping stays open as long as any of it's lines are around. Note that
+    # it shows the file as it is now: if the file is rewritten in place, rather
+    # than replaced by a new one (as most programs save files), the scan sees
+    # the new text - or, if the file got shorter, the program crashes when it
+    # reads past it's end. So use this for files which don't change underfoot.
+
+    def _mapped_scan ( self , buffer , phases , counts ) :
+
+        if phases is not None :
+            started = _timer()
+        size = len ( buffer )
+        if numpy is not None and size :
+            # a megabyte at a time, so the temporary arrays stay small
+            raw = numpy.frombuffer ( buffer , numpy.uint8 )
+            ends = []
+            for offset in range ( 0 , size , 1 << 20 ) :
+                newlines = numpy.flatnonzero ( raw [ offset : offset + ( 1 << 20 ) ] == 10 )
+                ends.extend ( ( newlines + ( offset + 1 ) ) .tolist() )
+            del raw
+        else :
+            ends = []
+            end = buffer.find ( '\n' )
+            while end >= 0 :
+                ends.append ( end + 1 )
+                end = buffer.find ( '\n' , end + 1 )
+        if size and ( not ends or ends [ -1 ] != size ) :
+            ends.append ( size ) # the last line has no newline
+        if phases is not None :
+            phases [ 'read' ] = _timer() - started
+            counts [ 'bytes' ] = size
+            started = _timer()
+
+        accepted = frozenset ( self.accepted_line_headers )
+        append = self.sequential.append
+        star = False
+        start = 0
+        for lineno , end in enumerate ( ends ) :
+            header = buffer [ start ]
+            # lines with nothing after the header are scanned right away, as in
+            # any lazy scan; only short lines can be like that
+            if ( not star and header in accepted and
+                 not ( end - start < 16 and buffer [ start + 1 : end ] .isspace() ) ) :
+                append ( mapped_pto_line ( buffer , start , lineno , header ) )
+            else :
+                line = buffer [ start : end ]
+                if star :
+                    header , kind = '' , None
+                else :
+                    header , kind = _classify_line ( line , accepted ,
+                                                     self.scan_extensions )
+                    star = header == '*'
+                append ( _make_line ( line , lineno , header , kind ,
+                                      True , self.keep_source , True ) )
+            start = end
+        if phases is not None :
+            phases [ 'classify' ] = _timer() - started
+
+    # _observed completes the counts and hands the report to the observer
+
+    def _observed ( self , observer , event , phases , counts , lines = None ) :
+
+        headers = {}
+        members = 0
+        for line in self.sequential if lines is None else lines :
+            headers [ line.header ] = headers.get ( line.header , 0 ) + 1
+            scanned = line._members
+            if type ( scanned ) is list :     # neither pending nor frozen
+                members += len ( scanned )
+        counts [ 'lines' ] = headers
+        counts [ 'members' ] = members
+        observer ( event , phases , counts )
             
     # make_member_access adds attributes to pto_scan and pto_line objects, so that
     # their content can be accessed by attribute notation. So, for example, to access
@@ -253,6 +602,9 @@ class pto_scan :
     # not provided. Calling make_member_access is the default; it provides a handy
     # way of getting to the data, but if you just need a few specific fields, you may
     # not want to call it, particularly if your script is quite large.
+    # Since pto_line objects have __slots__, the members are no longer copied onto
+    # the line as attributes; pto_line.__getattr__ looks them up instead, so
+    # scan.i[3].n works whether make_member_access was called or not.
 
     def make_member_access ( self ) :
 
@@ -271,8 +623,8 @@ class pto_scan :
                 # of the scan, accessible by the line header character
                 setattr ( self , line.header , [] )
                 
-            # now we add all the members as attributes of the pto_line object,
-            # accessible by their character combination. Note that the attribute's
+            # all the members are accessible as attributes of the pto_line object,
+            # by their character combination. Note that the attribute's
             # value will not be the member's value but the whole member object.
             # This may seem awkward - when just looking at the data, an additional
             # indirection is needed, like
@@ -281,11 +633,41 @@ class pto_scan :
             # member data as well:
             # scan.i[3].n.value = 'image_number_three.tif'
 
-            if line.members :
-                for m in line.members:
-                    setattr ( line , m.type , m )
+            # lines of a lazy scan which haven't been scanned yet are added
+            # without scanning them; they are scanned when they're used.
+
+            if line.pending() or line.members :
                 getattr ( self , line.header ) . append ( line )
 
+    # in a lazy scan, realize() scans all lines which haven't been scanned yet, or,
+    # if headers are passed, only the lines with one of these headers, so
+    # scan.realize ( 'c' ) scans all control points in one go.
+
+    def realize ( self , headers = None ) :
+
+        observer = scan_observer
+        if observer is not None :
+            started = _timer()
+            realized = []
+
+        collecting = gc.isenabled() # see __init__
+        if collecting :
+            gc.disable()
+        try :
+            for line in self.sequential :
+                if line.pending() and ( headers is None or line.header in headers ) :
+                    line.members
+                    if observer is not None :
+                        realized.append ( line )
+        finally :
+            if collecting :
+                gc.enable()
+
+        if observer is not None :
+            self._observed ( observer , 'realize' ,
+                             { 'scan' : _timer() - started } , { 'bytes' : 0 } ,
+                             realized )
+
     # to get a subset of lines with a specific header, the scan can be asked to filter
     # for them. This is a mere hint in the direction; the filtering could be much more
     # sophisticated...
@@ -293,7 +675,207 @@ class pto_scan :
     def get_lines_like ( self , header_filter ) :
 
         return [ l for l in self.sequential if l.header == header_filter ]
+
+    # the lines with a given header which have members - the same as the list
+    # make_member_access() provides, but also available if it wasn't called.
+
+    def lines_with_header ( self , header ) :
+
+        if hasattr ( self , '_member_access' ) :
+            return getattr ( self , header , [] )
+        return [ l for l in self.sequential
+                 if l.header == header and ( l.pending() or l.members ) ]
+
+    # the control points as a numpy array, see read_control_points() below for
+    # the layout. Where the c-lines haven't been scanned yet (in a lazy scan), they
+    # are converted straight from their text, without making pto_member objects.
+    # Lines which have been scanned may have been modified, so for these the values
+    # are taken from the members.
+
+    # Like the image table, the array is made once and kept; pass refresh=True
+    # if you have modified the c-lines since.
+
+    def control_points_array ( self , columns = False , refresh = False ) :
+
+        if refresh or getattr ( self , '_control_points' , None ) is None :
+            rows = []
+            for line in self.lines_with_header ( 'c' ) :
+                if line.pending() and line.sourcecode is not None :
+                    rows.append ( _control_point_row ( line.sourcecode ) )
+                else :
+                    rows.append ( [ line.extract ( f ) for f in control_point_fields ] )
+            self._control_points = _control_point_columns ( rows )
+        if columns :
+            return self._control_points
+        return _control_point_records ( self._control_points )
+
+    # the control_point_index (see below) of the control points, with cells of
+    # cell pixels. It is kept, and made anew when the control point array is.
+
+    def control_point_index ( self , cell = 64.0 , refresh = False ) :
+
+        columns = self.control_points_array ( columns = True , refresh = refresh )
+        index = getattr ( self , '_control_point_index' , None )
+        if index is None or index.columns is not columns or index.cell != cell :
+            index = self._control_point_index = control_point_index ( columns , cell )
+        return index
+
+    # the image_graph (see below) of the images, made from the control points.
+    # It is kept, and made anew when the control point array or the image
+    # table is.
+
+    def image_graph ( self , refresh = False ) :
+
+        columns = self.control_points_array ( columns = True , refresh = refresh )
+        images = len ( self.images ( refresh ) )
+        graph = getattr ( self , '_image_graph' , None )
+        if graph is None or graph.columns is not columns or graph.images < images :
+            graph = self._image_graph = image_graph ( columns , images )
+        return graph
+
+    # the image parameters of the i-lines as an image_table (see below), with
+    # back references resolved. The table is made once and kept; pass
+    # refresh=True if you have modified the i-lines since.
+
+    def images ( self , refresh = False ) :
+
+        if refresh or getattr ( self , '_images' , None ) is None :
+            self._images = image_table ( self.lines_with_header ( 'i' ) )
+        return self._images
     
+    # refresh() brings the scan up to date with the file after it has been
+    # edited, without scanning it all over again: the file's lines are
+    # compared with the text of the scan's lines, and only the lines which
+    # differ are scanned. The other pto_line objects are kept (with their
+    # line numbers updated), so a tweak to one image of a big project costs
+    # little more than reading the file. sequential and the member access
+    # lists (s.i, s.c ...) are patched in place, and the image table and
+    # control point array are dropped if their lines changed.
+    # pto_data is the file to read, the scan's own file by default. The
+    # lines are scanned with the options the scan was made with.
+    # refresh() returns a pto_changes object (see below) listing the lines
+    # that were removed and added. Note that the lines are compared by the
+    # text they were scanned from (or were given as their sourcecode), not by
+    # what they would write now: a line whose members were modified in the
+    # scan is kept, modifications and all, as long as the file still has the
+    # text it was scanned from.
+
+    def refresh ( self , pto_data = None ) :
+
+        if pto_data is None :
+            pto_data = self.filename
+        if type ( pto_data ) == str :
+            ptofile = open ( pto_data , 'r' )
+            self._source_stamp = _file_stamp ( pto_data )
+        elif hasattr ( pto_data , 'readlines' ) :
+            ptofile = pto_data
+        else :
+            raise NameError ( "no pto data found" )
+        try :
+            new = ptofile.readlines()
+        finally :
+            if ptofile is not pto_data :
+                ptofile.close()
+
+        old = self.sequential
+        hashes = getattr ( self , '_line_hashes' , None )
+        if hashes is not None and len ( hashes ) == len ( old ) :
+            texts = hashes
+            keys = [ hash ( line ) for line in new ]
+        else :
+            texts = [ line.source() for line in old ]
+            keys = new
+
+        # most edits leave the start and end of the file alone, so these are
+        # skipped before difflib gets to see the rest
+
+        start = 0
+        end = min ( len ( texts ) , len ( new ) )
+        while start < end and texts [ start ] == keys [ start ] :
+            start += 1
+        tail = 0
+        while tail < end - start and texts [ -1 - tail ] == keys [ -1 - tail ] :
+            tail += 1
+
+        matcher = difflib.SequenceMatcher ( None ,
+                                            texts [ start : len ( texts ) - tail ] ,
+                                            keys [ start : len ( keys ) - tail ] ,
+                                            autojunk = False )
+        opcodes = [ ( tag , i1 + start , i2 + start , j1 + start , j2 + start )
+                    for tag , i1 , i2 , j1 , j2 in matcher.get_opcodes() ]
+
+        # a '*' line switches off the scan of everything after it, so if one
+        # comes or goes, the whole file is scanned again
+
+        star = False
+        for tag , i1 , i2 , j1 , j2 in opcodes :
+            if tag != 'equal' and (
+                any ( line.header == '*' for line in old [ i1 : i2 ] ) or
+                any ( line [ : 1 ] == '*' for line in new [ j1 : j2 ] ) ) :
+                star = True
+                break
+        if star :
+            start = tail = 0
+            opcodes = [ ( 'replace' , 0 , len ( old ) , 0 , len ( new ) ) ]
+        elif not opcodes and start == len ( old ) == len ( new ) :
+            return pto_changes ( [] , [] ) # nothing to do
+
+        if not self.keep_source :
+            self._line_hashes = array.array ( 'l' , keys if keys is not new
+                                                  else [ hash ( line ) for line in new ] )
+
+        collecting = gc.isenabled() # see __init__
+        if collecting :
+            gc.disable()
+        try :
+            removed = []
+            added = []
+            sequential = old [ : start ]
+            ignoring = any ( line.header == '*' for line in sequential )
+            for tag , i1 , i2 , j1 , j2 in opcodes :
+                if tag == 'equal' :
+                    sequential.extend ( old [ i1 : i2 ] )
+                    ignoring = ignoring or any ( line.header == '*'
+                                                 for line in old [ i1 : i2 ] )
+                    continue
+                removed.extend ( old [ i1 : i2 ] )
+                for lineno in range ( j1 , j2 ) :
+                    line = new [ lineno ]
+                    if ignoring :
+                        header , kind = '' , None
+                    else :
+                        header , kind = _classify_line ( line ,
+                                                         self.accepted_line_headers ,
+                                                         self.scan_extensions )
+                        ignoring = header == '*'
+                    ptoline = _make_line ( line , lineno , header , kind ,
+                                           self.fast_scan , self.keep_source , self.lazy )
+                    sequential.append ( ptoline )
+                    added.append ( ptoline )
+            sequential.extend ( old [ len ( old ) - tail : ] )
+            for lineno , line in enumerate ( sequential ) :
+                line.lineno = lineno
+            old [ : ] = sequential # in place, for whoever holds on to the list
+        finally :
+            if collecting :
+                gc.enable()
+
+        changes = pto_changes ( removed , added )
+
+        if hasattr ( self , '_member_access' ) :
+            for header in changes.headers :
+                lines = [ l for l in old
+                          if l.header == header and ( l.pending() or l.members ) ]
+                if hasattr ( self , header ) :
+                    getattr ( self , header ) [ : ] = lines
+                elif lines :
+                    setattr ( self , header , lines )
+        if 'i' in changes.headers :
+            self._images = None
+        if 'c' in changes.headers :
+            self._control_points = None
+        return changes
+
     # the pto() routine will recreate a pto file from the data held
     # in the scan. The idea is, of course, that you have modified the data
     # in some form, and the generated pto will reflect these changes.
@@ -304,9 +886,16 @@ class pto_scan :
     # call pto() with with_aux=False. Then it will only output lines that
     # have been considered meaningful in the scan.
 
+    # The output is assembled in chunks of many lines and is the same, byte for
+    # byte, as what calling pto() for every pto_line would write - see
+    # write_pto_lines below, which does the work. pto_text() returns the
+    # whole file as a string instead.
+
     def pto ( self , target = sys.stdout , with_aux = True ) :
-        for line in self.sequential :
-            line.pto ( target , with_aux )
+        write_pto_lines ( self.sequential , target , with_aux )
+
+    def pto_text ( self , with_aux = True ) :
+        return ''.join ( _pto_texts ( self.sequential , with_aux ) )
 
     # output of the parsed pto lines, grouped by type. You won't usually need this
     # routine, it's more of a test tool to see if the scan did what was anticipated.
@@ -322,12 +911,105 @@ class pto_scan :
         for line in self.sequential :
             line.walk()
 
-    # just print all lines in order - yet another test procedure. It merely echoes
-    # the input.
+    # just print all lines in order - yet another test procedure. It echoes the
+    # input where the scan has kept it; lines whose text was dropped (see
+    # keep_source) are printed the way pto() writes them, normalized.
     
     def echo ( self ) :
         for line in self.sequential :
-            print ( line.sourcecode , end = '' )
+            print ( line.source() , end = '' )
+
+# The bulk writer. Line by line, pto_line.pto() makes a string of every member
+# and concatenates them, which is slow for big projects; write_pto_lines
+# formats the members with one join per line and writes many lines at a
+# time. Lines of a lazy scan which have never been scanned can't have been
+# modified, and if their text is in the form str() would produce anyway,
+# it's written as it is, without scanning the line at all.
+# What form is that? Members separated by single blanks, no trailing blanks,
+# and every value written the way pto_member.__str__ writes it: integers
+# without sign or leading zeros, floats as python's str() makes them - that
+# is, with at most 12 significant digits, no trailing zeros (but at least
+# one digit after the point) and not too small. The test is conservative;
+# lines it rejects just take the slower way.
+
+_canonical_int = r'(?:0|-?[1-9]\d*)'
+
+canonical_line_re = re.compile ( r"""
+    (?:
+        [ ]
+        (?= ( R[a-e] | V[a-dxym] | T[xyzrs][XYZ]* | E[rb] | Eev | [A-Za-z] ) ) \1
+        (?:
+            (?! -? 0 [.] 0000 ) -? (?: 0 | [1-9] \d{0,5} ) [.] (?: 0 | \d{0,5} [1-9] )
+          | %(int)s , %(int)s , %(int)s , %(int)s
+          | %(int)s
+          | = (?: 0 | [1-9] \d* )
+          | " [^"\n]* "
+          | [^\s\d+\-.="] \S*
+        )
+        (?= \s )
+    )+
+    \n \Z
+    """ % { 'int' : _canonical_int } , re.VERBOSE )
+
+def write_pto_lines ( lines , target , with_aux = True , chunk = 4096 ) :
+    parts = []
+    for text in _pto_texts ( lines , with_aux ) :
+        parts.append ( text )
+        if len ( parts ) >= chunk :
+            target.write ( ''.join ( parts ) )
+            parts = []
+    if parts :
+        target.write ( ''.join ( parts ) )
+
+def _pto_texts ( lines , with_aux ) :
+    match = canonical_line_re.match
+    for line in lines :
+        members = line._members
+        if members is _pending or members is _pending_drop :
+            text = line.sourcecode
+            if match ( text , len ( line.header ) ) :
+                yield text
+                continue
+            members = line.members
+        elif type ( members ) is tuple : # frozen members from a sidecar file
+            if members :
+                yield ' '.join ( [ line.header ] +
+                                 [ _member_text ( *m ) for m in members ] ) + '\n'
+            elif with_aux :
+                yield line.sourcecode
+            continue
+        if members :
+            yield ' '.join ( [ line.header ] +
+                             [ _member_text ( m.type , m.separator , m.text ,
+                                              m.value , m.datatype )
+                               for m in members ] ) + '\n'
+        elif with_aux :
+            yield line.sourcecode
+
+# the same as str ( pto_member ( type , separator , text , value , datatype ) )
+
+def _member_text ( type , separator , text , value , datatype ) :
+    if datatype == 's' :
+        return '%s%s"%s"' % ( type , separator , value )
+    elif datatype == 'r' :
+        return '%s%s%d,%d,%d,%d' % ( type , separator ,
+                                     value[0] , value[1] , value[2] , value[3] )
+    return '%s%s%s' % ( type , separator , str ( value ) )
+
+# pto_changes is what pto_scan.refresh() returns: the pto_line objects which
+# were taken out of the scan and those which were put in, and the set of
+# headers of these lines. It is true if anything changed at all.
+
+class pto_changes ( object ) :
+
+    def __init__ ( self , removed , added ) :
+        self.removed = removed
+        self.added = added
+        self.headers = set ( line.header for line in removed ) | \
+                       set ( line.header for line in added )
+
+    def __len__ ( self ) :
+        return len ( self.removed ) + len ( self.added )
 
 # this class, derived from pto_scan, will not scan arbitrary line headers.
 # This implements the 'orthodox' behaviour where lines with unknown headers
@@ -362,7 +1044,9 @@ class strict_pto_scan ( pto_scan ) :
 #
 # in a pto_line object, these members will be present:
 #
-# sourcecode - the text, as found in the original pto file
+# sourcecode - the text, as found in the original pto file. If the scan
+#              was made with keep_source=False, this is None for lines
+#              which have members - use source() to get the text back.
 # lineno     - the line number. empty lines are counted.
 # header     - usually the pto line code, like p, i, o, c, etc.
 #              if the line isn't a 'proper' pto line, header
@@ -373,10 +1057,33 @@ class strict_pto_scan ( pto_scan ) :
 #
 # members    - list of data fields in the line. These are of type
 #              pto_member, see below
+#
+# the markers for lines of a lazy scan which haven't been scanned yet, see
+# pto_line.members below, and the attributes a pto_line always has:
+
+_pending = object()
+_pending_drop = object()
+
+_line_attributes = ( 'sourcecode' , 'lineno' , 'header' , 'members' )
 
-class pto_line :
+# lines with at least this many members get an index for select(), see there
 
-    def __init__ ( self , line , lineno , header , scan = True ) :
+_indexed_lines = 12
+
+# pto_line and pto_member use __slots__ to keep the scan of large projects
+# small. With keep_source=False, a typical c-line
+# 'c n0 N1 x1523.64 y832.58 X241.93 Y817.32 t0' takes about 1100 bytes
+# (it used to take 4460 bytes with instance dictionaries and the members
+# copied onto the line), a hugin i-line with 34 members about 4.4k instead
+# of 18.8k. These figures are for 64 bit CPython 2.7 and include the pto_line,
+# its members list, the pto_member objects and their texts and values.
+
+class pto_line ( object ) :
+
+    __slots__ = ( 'sourcecode' , 'lineno' , 'header' , '_members' , '_index' )
+
+    def __init__ ( self , line , lineno , header , scan = True , fast = False ,
+                   lazy = False , keep_source = True ) :
 
         self.sourcecode = line      # bit of bookkeeping
         self.lineno = lineno        # in case meaningful messages are needed
@@ -386,6 +1093,14 @@ class pto_line :
             self.members = None     # at any rate, it wasn't recoginzed as pto line
             return
 
+        if lazy :                   # leave the scan for later, see members below
+            self._members = _pending if keep_source else _pending_drop
+            return
+
+        if fast :                   # the fast engine does it all in one go
+            self.members = fast_scan_members ( line , len ( header ) )
+            return
+
         self.members = []           # okay, scan it for 'members'
 
         # okay, here we go. Throw the line into our magic regular expression
@@ -395,7 +1110,7 @@ class pto_line :
 
         for m in members :    # all constructs matching our re for members
             pm = pto_member() # will produce a pto_member object
-            pm.type = m.group ( 'member_qualifier' ) # this is p,i,o,c etc.
+            pm.type = intern ( m.group ( 'member_qualifier' ) ) # this is p,i,o,c etc.
                                                      # (see pto_data_type above)
             pm.separator = ''                        # may be set to '=', see below
             pm.text = m.group ( 'member_text' )      # we record the original text
@@ -442,6 +1157,67 @@ class pto_line :
             raise SyntaxError ( "line %d:\n%s\nsomething went awfully wrong..." %
                                 ( self.lineno , self.sourcecode ) )
 
+    # the members list. In a lazy scan, lines are created without scanning them;
+    # then _members holds one of the markers _pending or _pending_drop, and
+    # the line is scanned (with the fast engine) the first time anyone asks for
+    # its members. _pending_drop means the scan was made with keep_source=False,
+    # so the source code is dropped once the members are there.
+    # Lines read from a sidecar file hold a tuple of member tuples instead, and
+    # the pto_member objects are made from it when they're first needed.
+    # Scans are shared between threads (the server caches them), so two
+    # threads may get here for the same line at once. Neither takes a lock:
+    # the members are published before the source is dropped, so a thread
+    # which finds the source gone finds the members there, and a thread which
+    # finds the members made while it was scanning uses those.
+
+    def _get_members ( self ) :
+        members = self._members
+        if members is _pending or members is _pending_drop :
+            source = self.sourcecode
+            if source is None : # another thread has just scanned the line
+                return self._members
+            scanned = fast_scan_members ( source , len ( self.header ) )
+            if self._members is members :
+                self._members = scanned
+                if members is _pending_drop and scanned :
+                    self.sourcecode = None
+            members = self._members
+        elif type ( members ) is tuple : # frozen members from a sidecar file
+            thawed = [ pto_member ( *m ) for m in members ]
+            if self._members is members :
+                self._members = thawed
+            members = self._members
+        return members
+
+    def _set_members ( self , members ) :
+        self._members = members
+
+    members = property ( _get_members , _set_members )
+
+    # True if this line still waits for its scan
+
+    def pending ( self ) :
+        members = self._members
+        return ( members is _pending or members is _pending_drop
+                 or type ( members ) is tuple )
+
+    # attribute access to members, like line.n - this is only called if there is
+    # no slot, method etc. by that name. Names starting with an underscore are
+    # never members, which also keeps copy and pickle from running in circles
+    # on objects whose slots aren't filled yet. If a line has a member twice,
+    # this gives the last one, as the attributes make_member_access used to set
+    # on the line did - unlike select, which gives the first.
+
+    def __getattr__ ( self , name ) :
+        if name.startswith ( '_' ) or name in _line_attributes :
+            raise AttributeError ( name )
+        members = self.members
+        if members :
+            for m in reversed ( members ) :
+                if m.type == name :
+                    return m
+        raise AttributeError ( name )
+
     # find a specific member of the pto line. This is what you use if the data
     # in the scan haven't been made accessible as members by calling make_member_access().
     # Let's assume you need a control point's first image's x coordinate, then you'd
@@ -449,12 +1225,26 @@ class pto_line :
     # the_x_member = my_c_line.select ( 'x' )
     # and access it's value like
     # the_x_coordinate = x_member.value
+    # Lines with many members, like i-lines, get a dictionary from member type to
+    # member the first time select is called, so further lookups don't have to
+    # go through the list. It is rebuilt if members are added or removed.
     
     def select ( self , member_tag ) :
-        for m in self.members:
-            if m.type == member_tag :
-                return m
-        return None
+        members = self.members
+        if members is None :
+            return None
+        if len ( members ) < _indexed_lines :
+            for m in members:
+                if m.type == member_tag :
+                    return m
+            return None
+        index = getattr ( self , '_index' , None )
+        if index is None or index[0] is not members or index[1] != len ( members ) :
+            lookup = {}
+            for m in reversed ( members ) : # so the first one of a type wins
+                lookup [ m.type ] = m
+            index = self._index = ( members , len ( members ) , lookup )
+        return index[2].get ( member_tag )
 
     # extract will pick a specific member of a pto line by calling select and then
     # return the member's value, rather than the pto_member object.
@@ -470,11 +1260,9 @@ class pto_line :
     # pto line from it.
 
     def __str__ ( self ) :
-        s = self.header
         if self.members :
-            for m in self.members :
-                s += ' ' + str ( m )
-        return s
+            return ' '.join ( [ self.header ] + [ str ( m ) for m in self.members ] )
+        return self.header
 
     # pto() will (hopefully) create valid pto code from the pto_line object.
     # if with_aux is passed as False, comments and such will be suppressed.
@@ -485,11 +1273,19 @@ class pto_line :
         elif with_aux :
             target.write ( self.sourcecode )
 
+    # the line's text. If the source code was dropped after the scan, this is
+    # recreated from the members, which is what pto() would write anyway.
+
+    def source ( self ) :
+        if self.sourcecode is None :
+            return str ( self ) + '\n'
+        return self.sourcecode
+
     # just to check if things went okay, see comment with pto_scan's walk()
 
     def walk ( self ) :
         print ( "line %04d header '%s' source:" % ( self.lineno , self.header ) )
-        print ( self.sourcecode  )
+        print ( self.source()  )
         if self.members :
             print ( "line contains %d member fields" % len ( self.members ) )
             for m in self.members :
@@ -497,6 +1293,39 @@ class pto_line :
                 m.walk()
         print()
 
+# the lines of a mapped scan (see pto_scan._mapped_scan) don't hold their text:
+# they refer to where it is in the mapped file, and sourcecode gives a copy of
+# it when it's asked for. If sourcecode is set, the line holds that text, like
+# any other line. The line is scanned (with the fast engine) when it's members
+# are first used.
+
+class mapped_pto_line ( pto_line ) :
+
+    __slots__ = ( '_buffer' , '_start' )
+
+    def __init__ ( self , buffer , start , lineno , header ) :
+
+        self._buffer = buffer
+        self._start = start         # the end is where the next newline is
+        self.lineno = lineno
+        self.header = header
+        self._members = _pending
+
+    def _get_source ( self ) :
+        buffer = self._buffer
+        if buffer is not None :
+            end = buffer.find ( '\n' , self._start )
+            return buffer [ self._start : len ( buffer ) if end < 0 else end + 1 ]
+        return _source_slot.__get__ ( self , mapped_pto_line )
+
+    def _set_source ( self , text ) :
+        self._buffer = None
+        _source_slot.__set__ ( self , text )
+
+    sourcecode = property ( _get_source , _set_source )
+
+_source_slot = pto_line.sourcecode
+
 # I wish I could have avoided the next section, but here it comes:
 # A bunch of special cases dealing with 'extensions' people have
 # thought out to make my life more difficult :-(
@@ -541,6 +1370,19 @@ hugin_key_value_re = re.compile ( r"""
     )                              # end of <member_text>
     """ , re.VERBOSE )
 
+# the fast engine's version of the same RE, see fast_member_re above
+
+fast_key_value_re = re.compile ( r"""
+    \s*
+    ( [^=\s]+ ) =                                                 # key
+    (?:
+        ( [+-]? (?: \d+ [.] \d* | [.] \d+ ) )                    # float
+      | ( [+-]?\d+ )                                              # integer
+      | " ( (?: [^"] | \\ " )* ) "                                # string
+      | ( \S+ )                                                   # word
+    )
+    """ , re.VERBOSE )
+
 # and this is the class derived from pto_line to contain the scan of such a line.
 # It is less complex than a pto line - for example, rectangles aren't recognized.
 # Since I couldn't find documentation on the precise syntax of this line type,
@@ -548,15 +1390,22 @@ hugin_key_value_re = re.compile ( r"""
 
 class hugin_extension_line ( pto_line ) :
 
-    def __init__ ( self , line , lineno , header ) :
+    __slots__ = ()
+
+    def __init__ ( self , line , lineno , header , fast = False ) :
 
         pto_line.__init__ ( self , line , lineno , header , scan = False )
+
+        if fast :
+            self.members = fast_scan_key_values ( line , len ( header ) )
+            return
+
         self.members = []
 
         members = hugin_key_value_re.finditer ( line , len ( header ) )
         for m in members :
             pm = pto_member()
-            pm.type = m.group ( 'member_qualifier' )
+            pm.type = intern ( m.group ( 'member_qualifier' ) )
             pm.separator = '='
             pm.text = m.group ( 'member_text' )
             self.members.append ( pm )
@@ -597,6 +1446,8 @@ class hugin_extension_line ( pto_line ) :
 
 class hugin_option_line ( pto_line ) :
 
+    __slots__ = ()
+
     def __init__ ( self , line , lineno ) :
 
         m = hugin_option_re.match ( line )
@@ -648,13 +1499,32 @@ imgfile_data_re = re.compile ( r"""
     )                              # end of <member_text>
     """ , re.VERBOSE )
 
+# and again the fast engine's version:
+
+fast_imgfile_data_re = re.compile ( r"""
+    \s*
+    (?:
+        ( [+-]? (?: \d+ [.] \d* | [.] \d+ ) )                    # float
+      | ( [+-]?\d+ )                                              # integer
+      | " ( (?: [^"] | \\ " )* ) "                                # string
+      | ( \S+ )                                                   # word
+    )
+    """ , re.VERBOSE )
+
 # now this type of line needs yet another scanning mechanism. Here it comes:
 
 class imgfile_extension_line ( pto_line ) :
 
-    def __init__ ( self , line , lineno , header ) :
+    __slots__ = ()
+
+    def __init__ ( self , line , lineno , header , fast = False ) :
 
         pto_line.__init__ ( self , line , lineno , header , scan = False )
+
+        if fast :
+            self.members = fast_scan_imgfile_data ( line , len ( header ) )
+            return
+
         self.members = []
 
         members = imgfile_data_re.finditer ( line , len ( header ) )
@@ -705,8 +1575,20 @@ class imgfile_extension_line ( pto_line ) :
 #
 # pto_member's construction is handled by the pto_line object,
 #this is why there are only the __str__-type methods here.
+# The member types are interned, so all the 'Ra's and 'TrX's of a scan share
+# a single string object.
     
-class pto_member :
+class pto_member ( object ) :
+
+    __slots__ = ( 'type' , 'separator' , 'text' , 'value' , 'datatype' )
+
+    def __init__ ( self , type = None , separator = '' ,
+                   text = None , value = None , datatype = None ) :
+        self.type = type
+        self.separator = separator
+        self.text = text
+        self.value = value
+        self.datatype = datatype
 
     # stringize. This should create valid pto code
     
@@ -743,11 +1625,792 @@ class pto_member :
                    pto_data_type [ self.datatype ] ,
                    content ) )
 
+# these are the workhorses of the fast scanning engine. Each of them turns
+# a line into the same list of pto_member objects the corresponding
+# regex-and-if-chain code in the classes above produces, but it gets all fields
+# of the line from a single findall() call. Only one of the value groups in
+# each tuple can be non-empty - except for the string group, which is empty for
+# an empty string "", so it comes last and catches what's left. The most
+# frequent types come first.
+
+def fast_scan_members ( line , start = 0 ) :
+    members = []
+    append = members.append
+    for q , f , r , i , b , s , w in fast_member_re.findall ( line , start ) :
+        q = intern ( q )
+        if f :
+            append ( pto_member ( q , '' , f , float ( f ) , 'f' ) )
+        elif i :
+            append ( pto_member ( q , '' , i , int ( i ) , 'i' ) )
+        elif w :
+            append ( pto_member ( q , '' , w , w , 'w' ) )
+        elif b :
+            append ( pto_member ( q , '=' , '=' + b , int ( b ) , 'b' ) )
+        elif r :
+            append ( pto_member ( q , '' , r ,
+                                  tuple ( [ int ( v ) for v in r.split ( ',' ) ] ) , 'r' ) )
+        else :
+            append ( pto_member ( q , '' , '"' + s + '"' , s , 's' ) )
+    return members
+
+def fast_scan_key_values ( line , start = 0 ) :
+    return [ _fast_member ( intern ( q ) , '=' , f , i , s , w )
+             for q , f , i , s , w in fast_key_value_re.findall ( line , start ) ]
+
+def fast_scan_imgfile_data ( line , start = 0 ) :
+    return [ _fast_member ( '' , '' , f , i , s , w )
+             for f , i , s , w in fast_imgfile_data_re.findall ( line , start ) ]
+
+# the extension lines have no rectangles and back references, so their
+# values are all handled by the same bit of code:
+
+def _fast_member ( q , separator , f , i , s , w ) :
+    if f :
+        return pto_member ( q , separator , f , float ( f ) , 'f' )
+    elif i :
+        return pto_member ( q , separator , i , int ( i ) , 'i' )
+    elif w :
+        return pto_member ( q , separator , w , w , 'w' )
+    return pto_member ( q , separator , '"' + s + '"' , s , 's' )
+
+# image_table holds the parameters of all images of a project, one column per
+# parameter, like
+#
+# table [ 'y' ] [ 3 ] - yaw of the fourth image
+# table.row ( 3 )     - all parameters of the fourth image, as a dictionary
+#
+# Back references are resolved: if image 3 has v=0, table [ 'v' ] [ 3 ] is
+# image 0's field of view, and table.backrefs [ 'v' ] [ 3 ] is 0 (it's None
+# where there was no back reference). If a parameter doesn't occur in an i-line,
+# the table has None there; if a back reference points nowhere, too.
+# Like select(), the table takes the first member of a type if there are several.
+
+class image_table ( object ) :
+
+    def __init__ ( self , lines = () ) :
+
+        self.columns = {}
+        self.backrefs = {}
+        self.size = size = len ( lines )
+
+        for k , line in enumerate ( lines ) :
+            for m in line.members :
+                column = self.columns.get ( m.type )
+                if column is None :
+                    column = self.columns [ m.type ] = [ None ] * size
+                    self.backrefs [ m.type ] = [ None ] * size
+                elif column [ k ] is not None or self.backrefs [ m.type ] [ k ] is not None :
+                    continue # we had that one already
+                if m.datatype == 'b' :
+                    self.backrefs [ m.type ] [ k ] = m.value
+                else :
+                    column [ k ] = m.value
+
+        # now fill in the back references. They may point to yet another back
+        # reference, so we follow the chain until we get to an image which has
+        # a value (or None) of it's own, or to one we've done already, and
+        # then set the whole chain. A chain which runs in circles, or out of the
+        # table, ends up with None.
+
+        for name , refs in self.backrefs.items() :
+            column = self.columns [ name ]
+            done = [ ref is None for ref in refs ]
+            for k in range ( size ) :
+                chain = []
+                j = k
+                while not done [ j ] :
+                    done [ j ] = True
+                    chain.append ( j )
+                    j = refs [ j ]
+                    if not 0 <= j < size :
+                        break
+                value = column [ j ] if 0 <= j < size else None
+                for j in chain :
+                    column [ j ] = value
+
+    def __len__ ( self ) :
+        return self.size
+
+    def __contains__ ( self , name ) :
+        return name in self.columns
+
+    def __getitem__ ( self , name ) :
+        return self.columns [ name ]
+
+    def names ( self ) :
+        return sorted ( self.columns )
+
+    # a column which may not be there - then it's all default values
+
+    def column ( self , name , default = None ) :
+        column = self.columns.get ( name )
+        if column is None :
+            return [ default ] * self.size
+        return column
+
+    def get ( self , image , name , default = None ) :
+        column = self.columns.get ( name )
+        if column is None or column [ image ] is None :
+            return default
+        return column [ image ]
+
+    def row ( self , image ) :
+        return dict ( ( name , column [ image ] )
+                      for name , column in self.columns.items() )
+
+    # a numeric column as a numpy array of floats, with NaN where it's None
+
+    def array ( self , name ) :
+        if numpy is None :
+            raise ImportError ( "numpy is needed for image table arrays" )
+        return numpy.array ( [ numpy.nan if v is None else v
+                               for v in self.column ( name ) ] ,
+                             dtype = numpy.float64 )
+
+# The control points can also be read straight from a pto file, without making
+# a scan. read_control_points reads through the file (pto_data can be a file name
+# or an open file), picks the c-lines and returns their content as a numpy array.
+# By default, this is a structured array with one record per control point and
+# the fields n, N, t (image numbers and type, as int32) and x, y, X, Y (as float64),
+# so a[ 'x' ] is the column of x coordinates and a[ 7 ] the eighth control point.
+# With columns=True, a dictionary of separate, contiguous arrays is returned
+# instead. Fields missing from a c-line come out as -1 or NaN, respectively.
+
+control_point_fields = ( 'n' , 'N' , 'x' , 'y' , 'X' , 'Y' , 't' )
+
+def read_control_points ( pto_data , columns = False ) :
+
+    if type ( pto_data ) == str :
+        ptofile = open ( pto_data , 'r' )
+    else :
+        ptofile = pto_data
+
+    rows = []
+    try :
+        for line in ptofile :
+            if line[0] == 'c' :
+                rows.append ( _control_point_row ( line ) )
+            elif line[0] == '*' : # the rest isn't pto, see pto_scan
+                break
+    finally :
+        if ptofile is not pto_data :
+            ptofile.close()
+
+    if columns :
+        return _control_point_columns ( rows )
+    return _control_point_records ( _control_point_columns ( rows ) )
+
+# hugin and most other CPGs write c-lines with the same fields in the same order,
+# so usually one match of this RE gets all the numbers from a line in one go.
+# The numbers are kept as strings; numpy converts them all at once later.
+# Anything more unusual is scanned like any other pto line.
+
+_number = r'[+-]?(?:\d+[.]?\d*|[.]\d+)'
+
+control_point_re = re.compile (
+    r'c\s+n([+-]?\d+)\s+N([+-]?\d+)\s+x(%s)\s+y(%s)\s+X(%s)\s+Y(%s)\s+t([+-]?\d+)\s*$'
+    % ( _number , _number , _number , _number ) )
+
+def _control_point_row ( line ) :
+    m = control_point_re.match ( line )
+    if m :
+        return m.groups()
+    scanned = pto_line ( line , 0 , 'c' , fast = True )
+    return [ scanned.extract ( f ) for f in control_point_fields ]
+
+def _control_point_columns ( rows ) :
+
+    if numpy is None :
+        raise ImportError ( "numpy is needed for control point arrays" )
+
+    # everything goes through one float64 array first; None (missing fields)
+    # becomes NaN there
+
+    table = numpy.array ( [ [ numpy.nan if v is None else v for v in row ]
+                            if None in row else row
+                            for row in rows ] ,
+                          dtype = numpy.float64 ) . reshape ( -1 , 7 )
+
+    result = {}
+    for k , field in enumerate ( control_point_fields ) :
+        column = table [ : , k ]
+        if field in 'nNt' :
+            column = numpy.where ( numpy.isnan ( column ) , -1 , column )
+            result [ field ] = column.astype ( numpy.int32 )
+        else :
+            result [ field ] = column.copy()
+    return result
+
+def _control_point_records ( columns ) :
+    array = numpy.empty ( len ( columns [ 'x' ] ) , dtype = control_point_dtype() )
+    for field in control_point_fields :
+        array [ field ] = columns [ field ]
+    return array
+
+def control_point_dtype () :
+    return numpy.dtype ( [ ( f , numpy.int32 if f in 'nNt' else numpy.float64 )
+                           for f in control_point_fields ] )
+
+# control_point_index answers questions about where the control points are,
+# without looking at all of them: which points of image 3 lie near pixel (x, y)
+# or in a rectangle, which points link images 3 and 7. It is made from the
+# columns of control_points_array() (pto_scan.control_point_index() makes it and
+# keeps it), and the answers are arrays of row numbers into these columns, in
+# ascending order - which are also the positions of the lines in scan.c.
+#
+# Every control point is two points, one in each of it's images. These are put
+# in a grid of square cells, cell pixels wide, per image: the points are sorted
+# by image, cell row and cell column, so the points of a run of cells in one row
+# are a contiguous slice which binary search finds. A query looks at the rows of
+# cells the rectangle (or the square around the circle) covers, and then checks
+# the points in them exactly. The pairs of images are sorted likewise, so the
+# points linking two images are one slice, too.
+
+class control_point_index ( object ) :
+
+    def __init__ ( self , columns , cell = 64.0 ) :
+
+        if numpy is None :
+            raise ImportError ( "numpy is needed for the control point index" )
+
+        self.columns = columns
+        self.cell = cell
+        n = columns [ 'n' ] .astype ( numpy.int64 )
+        N = columns [ 'N' ] .astype ( numpy.int64 )
+        count = len ( n )
+        rows = numpy.arange ( count )
+
+        image = numpy.concatenate ( ( n , N ) )
+        x = numpy.concatenate ( ( columns [ 'x' ] , columns [ 'X' ] ) )
+        y = numpy.concatenate ( ( columns [ 'y' ] , columns [ 'Y' ] ) )
+        point = numpy.concatenate ( ( rows , rows ) )
+        valid = ( image >= 0 ) & numpy.isfinite ( x ) & numpy.isfinite ( y )
+        image , x , y , point = image [ valid ] , x [ valid ] , y [ valid ] , point [ valid ]
+
+        self.images = int ( image.max() ) + 1 if len ( image ) else 0
+        cx = numpy.floor ( x / cell ) .astype ( numpy.int64 )
+        cy = numpy.floor ( y / cell ) .astype ( numpy.int64 )
+        self._origin = ( int ( cx.min() ) , int ( cy.min() ) ) if len ( cx ) else ( 0 , 0 )
+        cx -= self._origin [ 0 ]
+        cy -= self._origin [ 1 ]
+        self._shape = ( int ( cx.max() ) + 1 , int ( cy.max() ) + 1 ) if len ( cx ) else ( 1 , 1 )
+
+        keys = ( image * self._shape [ 1 ] + cy ) * self._shape [ 0 ] + cx
+        order = numpy.argsort ( keys , kind = 'mergesort' )
+        self._keys = keys [ order ]
+        self._x = x [ order ]
+        self._y = y [ order ]
+        self._point = point [ order ]
+
+        # the pairs, with the lower image number first, so 3-7 and 7-3 are the same
+
+        pairs = numpy.minimum ( n , N ) * max ( self.images , 1 ) + numpy.maximum ( n , N )
+        order = numpy.argsort ( pairs , kind = 'mergesort' )
+        self._pair_keys = pairs [ order ]
+        self._pair_points = order
+
+    def __len__ ( self ) :
+        return len ( self.columns [ 'n' ] )
+
+    # the control points linking images a and b
+
+    def between ( self , a , b ) :
+
+        if not ( 0 <= a < self.images and 0 <= b < self.images ) :
+            return numpy.zeros ( 0 , dtype = numpy.int64 )
+        key = min ( a , b ) * self.images + max ( a , b )
+        start = numpy.searchsorted ( self._pair_keys , key , 'left' )
+        end = numpy.searchsorted ( self._pair_keys , key , 'right' )
+        return self._pair_points [ start : end ] .astype ( numpy.int64 )
+
+    # the control points with a point in the rectangle x0 <= x <= x1, y0 <= y <= y1
+    # of image
+
+    def within ( self , image , x0 , y0 , x1 , y1 ) :
+
+        slots = self._candidates ( image , x0 , y0 , x1 , y1 )
+        x , y = self._x [ slots ] , self._y [ slots ]
+        inside = ( x >= x0 ) & ( x <= x1 ) & ( y >= y0 ) & ( y <= y1 )
+        return numpy.unique ( self._point [ slots [ inside ] ] )
+
+    # the control points with a point no further than radius from ( x , y ) in image
+
+    def near ( self , image , x , y , radius ) :
+
+        slots = self._candidates ( image , x - radius , y - radius ,
+                                   x + radius , y + radius )
+        dx , dy = self._x [ slots ] - x , self._y [ slots ] - y
+        inside = dx * dx + dy * dy <= radius * radius
+        return numpy.unique ( self._point [ slots [ inside ] ] )
+
+    # all control points of image
+
+    def of_image ( self , image ) :
+
+        if not 0 <= image < self.images :
+            return numpy.zeros ( 0 , dtype = numpy.int64 )
+        cells = self._shape [ 0 ] * self._shape [ 1 ]
+        start = numpy.searchsorted ( self._keys , image * cells , 'left' )
+        end = numpy.searchsorted ( self._keys , ( image + 1 ) * cells , 'left' )
+        return numpy.unique ( self._point [ start : end ] )
+
+    # the positions in the sorted points of those in the cells which the
+    # rectangle touches
+
+    def _candidates ( self , image , x0 , y0 , x1 , y1 ) :
+
+        nothing = numpy.zeros ( 0 , dtype = numpy.int64 )
+        if not 0 <= image < self.images or x1 < x0 or y1 < y0 :
+            return nothing
+        width , height = self._shape
+        cx0 = int ( numpy.floor ( x0 / self.cell ) ) - self._origin [ 0 ]
+        cx1 = int ( numpy.floor ( x1 / self.cell ) ) - self._origin [ 0 ]
+        cy0 = int ( numpy.floor ( y0 / self.cell ) ) - self._origin [ 1 ]
+        cy1 = int ( numpy.floor ( y1 / self.cell ) ) - self._origin [ 1 ]
+        if cx1 < 0 or cy1 < 0 or cx0 >= width or cy0 >= height :
+            return nothing
+        cx0 , cy0 = max ( cx0 , 0 ) , max ( cy0 , 0 )
+        cx1 , cy1 = min ( cx1 , width - 1 ) , min ( cy1 , height - 1 )
+
+        # one slice per row of cells; the slices are strung together without
+        # a python loop over them
+
+        rows = ( image * height + numpy.arange ( cy0 , cy1 + 1 ) ) * width
+        starts = numpy.searchsorted ( self._keys , rows + cx0 , 'left' )
+        ends = numpy.searchsorted ( self._keys , rows + cx1 , 'right' )
+        lengths = ends - starts
+        offsets = numpy.cumsum ( lengths ) - lengths
+        return ( numpy.arange ( lengths.sum() )
+                 - numpy.repeat ( offsets , lengths )
+                 + numpy.repeat ( starts , lengths ) )
+
+# image_graph tells which images are neighbours: there's an edge between two
+# images if control points link them, and it's weight is the number of control
+# points between them. It is made from the columns of control_points_array()
+# in one go; pto_scan.image_graph() makes it and keeps it. images is the number
+# of images of the project, so those without any control points are in the
+# graph, too.
+#
+# graph.edges()           - ( a , b , weight ) for every pair, a < b
+# graph.neighbours ( 3 )  - ( image , weight ) for the neighbours of image 3,
+#                           the best connected first
+# graph.load_order ( 3 )  - all images, breadth first from image 3, so an image
+#                           comes soon after the images it overlaps with
+
+class image_graph ( object ) :
+
+    def __init__ ( self , columns , images = None ) :
+
+        if numpy is None :
+            raise ImportError ( "numpy is needed for the image graph" )
+
+        self.columns = columns
+        n = columns [ 'n' ] .astype ( numpy.int64 )
+        N = columns [ 'N' ] .astype ( numpy.int64 )
+        linking = ( n >= 0 ) & ( N >= 0 ) & ( n != N )
+        a = numpy.minimum ( n , N ) [ linking ]
+        b = numpy.maximum ( n , N ) [ linking ]
+        size = int ( b.max() ) + 1 if len ( b ) else 0
+        self.images = size = max ( size , images or 0 )
+
+        pairs , weights = numpy.unique ( a * size + b , return_counts = True )
+        self._a = pairs // size if size else pairs
+        self._b = pairs % size if size else pairs
+        self._weights = weights
+
+        # the neighbours of all images in one array, both ways round, grouped
+        # by image and sorted by descending weight (and image number) in a group
+
+        source = numpy.concatenate ( ( self._a , self._b ) )
+        target = numpy.concatenate ( ( self._b , self._a ) )
+        weight = numpy.concatenate ( ( weights , weights ) )
+        order = numpy.lexsort ( ( target , - weight , source ) )
+        self._neighbours = target [ order ]
+        self._neighbour_weights = weight [ order ]
+        self._first = numpy.searchsorted ( source [ order ] , numpy.arange ( size + 1 ) )
+
+    def __len__ ( self ) :
+        return self.images
+
+    def edges ( self ) :
+        return list ( zip ( self._a.tolist() , self._b.tolist() , self._weights.tolist() ) )
+
+    def neighbours ( self , image ) :
+        start , end = self._first [ image ] , self._first [ image + 1 ]
+        return list ( zip ( self._neighbours [ start : end ] .tolist() ,
+                            self._neighbour_weights [ start : end ] .tolist() ) )
+
+    # images which aren't connected to start come after the others, each group
+    # of connected ones from it's lowest numbered image
+
+    def load_order ( self , start = 0 ) :
+
+        if not 0 <= start < self.images :
+            raise IndexError ( "no image %d in the graph" % start )
+        neighbours = self._neighbours.tolist()
+        first = self._first.tolist()
+        seen = [ False ] * self.images
+        order = []
+        for root in [ start ] + list ( range ( self.images ) ) :
+            if seen [ root ] :
+                continue
+            seen [ root ] = True
+            queue = collections.deque ( [ root ] )
+            while queue :
+                image = queue.popleft()
+                order.append ( image )
+                for neighbour in neighbours [ first [ image ] : first [ image + 1 ] ] :
+                    if not seen [ neighbour ] :
+                        seen [ neighbour ] = True
+                        queue.append ( neighbour )
+        return order
+
+# Parsing a big project from text takes a while, and a server process would do it
+# every time it starts. So pto_scan can keep a binary 'sidecar' file next to the pto
+# file (in a directory .ptocache), from which the scan can be restored much faster:
+# pass sidecar=True and the scan is taken from the sidecar if it is valid, or made
+# from the pto file and written to the sidecar if it isn't.
+# The sidecar is valid if the pto file has the size and mtime it had when the
+# sidecar was written, or, if only the mtime differs, the same SHA-1 digest - then
+# the sidecar is stamped with the new mtime, so the file isn't hashed again the
+# next time. It is written to a temporary file first and then renamed, so several
+# processes can share the same sidecars without ever seeing a half-written one.
+# marshal's format differs between python versions, so a sidecar is only used by
+# the version which wrote it; one which can't be read is ignored, like any
+# invalid sidecar, and the pto file is scanned.
+# The layout is:
+#
+# 64 bytes header  - magic 'PTOC', format version, flags, source mtime, size and
+#                    SHA-1, length of the structure block, number of control
+#                    points, python major and minor version
+# structure block  - marshalled tuple of the scan options, the lines (as tuples
+#                    of kind, header, line number, source and member tuples),
+#                    the image table and, for scans without the source text, the
+#                    hashes of the lines refresh() compares the file with (None
+#                    if there are none, or python randomizes it's string hashes)
+# control points   - if flags & 1: 7 float64 columns (n, N, x, y, X, Y, t) of the
+#                    control point table, aligned to 8 bytes
+#
+# The file is memory-mapped when it is read; the float columns of the control
+# points stay in the mapping (they're read-only arrays), and the lines get their
+# pto_member objects only when they're used, like in a lazy scan.
+
+sidecar_magic = 'PTOC'
+sidecar_version = 3
+
+_sidecar_header = struct.Struct ( '<4sHHdQ20sQQBB' )
+_sidecar_start = 64 # the header is padded to this
+
+def sidecar_path ( filename ) :
+    directory , name = os.path.split ( os.path.abspath ( filename ) )
+    return os.path.join ( directory , '.ptocache' , name + '.ptoc' )
+
+def write_sidecar ( scan , path = None ) :
+
+    filename = scan.filename
+    path = path or sidecar_path ( filename )
+
+    # if the file has changed since it was scanned, the scan is out of date
+
+    stamp = _file_stamp ( filename )
+    if getattr ( scan , '_source_stamp' , stamp ) != stamp :
+        return False
+
+    lines = []
+    for line in scan.sequential :
+        members = _frozen_members ( line )
+        source = line.sourcecode
+        if members and not scan.keep_source :
+            source = None
+        lines.append ( ( _line_kinds [ type ( line ) ] , line.header , line.lineno ,
+                         source , members ) )
+
+    images = scan.images()
+    hashes = _sidecar_hashes ( scan )
+    blob = marshal.dumps ( ( _sidecar_options ( scan ) , lines ,
+                             images.columns , images.backrefs , images.size ,
+                             None if hashes is None else hashes.tostring() ) , 2 )
+
+    flags , count , points = 0 , 0 , ''
+    if numpy is not None :
+        columns = scan.control_points_array ( columns = True )
+        count = len ( columns [ 'x' ] )
+        points = numpy.vstack ( [ columns [ f ] . astype ( numpy.float64 )
+                                  for f in control_point_fields ] ) . tostring()
+        flags |= 1
+
+    header = _sidecar_header.pack ( sidecar_magic , sidecar_version , flags ,
+                                    stamp [ 0 ] , stamp [ 1 ] ,
+                                    _source_digest ( filename ) ,
+                                    len ( blob ) , count , * sys.version_info [ : 2 ] )
+    padding = - ( _sidecar_start + len ( blob ) ) % 8
+
+    directory = os.path.dirname ( path )
+    if not os.path.isdir ( directory ) :
+        try :
+            os.makedirs ( directory )
+        except OSError : # another process may just have made it
+            if not os.path.isdir ( directory ) :
+                raise
+
+    fd , temporary = tempfile.mkstemp ( dir = directory , suffix = '.tmp' )
+    try :
+        f = os.fdopen ( fd , 'wb' )
+        try :
+            f.write ( header.ljust ( _sidecar_start , '\0' ) )
+            f.write ( blob )
+            f.write ( '\0' * padding )
+            f.write ( points )
+        finally :
+            f.close()
+        os.rename ( temporary , path )
+    except :
+        os.unlink ( temporary )
+        raise
+    return True
+
+# _read_sidecar fills in a pto_scan from it's sidecar file, if there is a valid
+# one. The scan must have it's filename and options set already.
+
+def _read_sidecar ( scan ) :
+
+    path = sidecar_path ( scan.filename )
+    try :
+        f = open ( path , 'rb' )
+    except IOError :
+        return False
+    try :
+        mapped = mmap.mmap ( f.fileno() , 0 , access = mmap.ACCESS_READ )
+    except ( ValueError , EnvironmentError ) : # an empty file can't be mapped
+        return False
+    finally :
+        f.close()
+
+    if len ( mapped ) < _sidecar_start :
+        return False
+    ( magic , version , flags , mtime , size , digest ,
+      length , count , major , minor ) = _sidecar_header.unpack_from ( mapped , 0 )
+    if ( magic != sidecar_magic or version != sidecar_version
+         or ( major , minor ) != sys.version_info [ : 2 ] ) :
+        return False
+    if size != scan._source_stamp [ 1 ] :
+        return False
+    restamp = mtime != scan._source_stamp [ 0 ]
+    if restamp and digest != _source_digest ( scan.filename ) :
+        return False
+
+    # a sidecar which is cut short or garbled can't be read; the file is
+    # scanned instead, and the sidecar written again
+
+    try :
+        ( options , lines , columns , backrefs , size , hashes ) = marshal.loads (
+            mapped [ _sidecar_start : _sidecar_start + length ] )
+        if options != _sidecar_options ( scan ) :
+            return False
+        if hashes is not None :
+            hashes = array.array ( 'l' , hashes )
+
+        sequential = []
+        for kind , header , lineno , source , members in lines :
+            cls = _line_classes [ kind ]
+            line = cls.__new__ ( cls )
+            line.sourcecode = source
+            line.lineno = lineno
+            line.header = header
+            line._members = members
+            sequential.append ( line )
+
+        points = None
+        if flags & 1 and numpy is not None :
+            offset = _sidecar_start + length + ( - ( _sidecar_start + length ) % 8 )
+            table = numpy.frombuffer ( mapped , numpy.float64 , 7 * count , offset )
+            table = table.reshape ( 7 , count )
+            points = {}
+            for k , field in enumerate ( control_point_fields ) :
+                if field in 'nNt' :
+                    points [ field ] = table [ k ] . astype ( numpy.int32 )
+                else :
+                    points [ field ] = table [ k ]
+    except ( ValueError , EOFError , TypeError , IndexError ) :
+        return False
+
+    scan.sequential.extend ( sequential )
+    images = image_table()
+    images.columns , images.backrefs , images.size = columns , backrefs , size
+    scan._images = images
+    if points is not None :
+        scan._control_points = points
+    if hashes is not None and len ( hashes ) == len ( sequential ) :
+        scan._line_hashes = hashes
+
+    if restamp :
+        try :
+            _restamp_sidecar ( mapped , path , scan._source_stamp [ 0 ] )
+        except EnvironmentError : # it's just a cache; never mind if we can't
+            pass
+    return True
+
+# _restamp_sidecar writes a copy of a sidecar with a new source mtime in place
+# of the old one - the same way write_sidecar writes it, so readers only ever
+# see the old or the new one.
+
+def _restamp_sidecar ( mapped , path , mtime ) :
+
+    fields = list ( _sidecar_header.unpack_from ( mapped , 0 ) )
+    fields [ 3 ] = mtime
+    fd , temporary = tempfile.mkstemp ( dir = os.path.dirname ( path ) , suffix = '.tmp' )
+    try :
+        f = os.fdopen ( fd , 'wb' )
+        try :
+            f.write ( _sidecar_header.pack ( * fields ) )
+            f.write ( mapped [ _sidecar_header.size : ] )
+        finally :
+            f.close()
+        os.rename ( temporary , path )
+    except :
+        os.unlink ( temporary )
+        raise
+
+# the line hashes of a scan without the source text, for it's sidecar: the ones
+# made by the scan, or, for a mapped scan, the hashes of the lines' text. They
+# are the same in the next process only if python doesn't randomize them.
+
+def _sidecar_hashes ( scan ) :
+    if scan.keep_source or sys.flags.hash_randomization :
+        return None
+    hashes = getattr ( scan , '_line_hashes' , None )
+    if hashes is not None and len ( hashes ) == len ( scan.sequential ) :
+        return hashes
+    sources = [ line.sourcecode for line in scan.sequential ]
+    if None in sources :
+        return None
+    return array.array ( 'l' , [ hash ( source ) for source in sources ] )
+
+def _sidecar_options ( scan ) :
+    return ( scan.accepted_line_headers , scan.scan_extensions , scan.keep_source )
+
+def _file_stamp ( filename ) :
+    st = os.stat ( filename )
+    return ( st.st_mtime , st.st_size )
+
+def _source_digest ( filename ) :
+    digest = hashlib.sha1()
+    f = open ( filename , 'rb' )
+    try :
+        for block in iter ( lambda : f.read ( 1 << 20 ) , '' ) :
+            digest.update ( block )
+    finally :
+        f.close()
+    return digest.digest()
+
+# the members of a line as they go into the sidecar: None for lines which aren't
+# scanned, otherwise a tuple of ( type , separator , text , value , datatype )
+# for each member - the arguments for pto_member(). Lines of a lazy scan which
+# haven't been scanned yet are scanned for this, but stay unscanned.
+
+def _frozen_members ( line ) :
+    members = line._members
+    if members is None or type ( members ) is tuple :
+        return members
+    if members is _pending or members is _pending_drop :
+        members = fast_scan_members ( line.sourcecode , len ( line.header ) )
+    if not members :
+        return []
+    return tuple ( [ ( m.type , m.separator , m.text , m.value , m.datatype )
+                     for m in members ] )
+
+_line_classes = ( pto_line , hugin_extension_line , hugin_option_line ,
+                  imgfile_extension_line )
+
+_line_kinds = dict ( ( cls , kind ) for kind , cls in enumerate ( _line_classes ) )
+_line_kinds [ mapped_pto_line ] = 0 # in a sidecar, it's a pto_line like any other
+
 # If this module is used as a stand-alone program, it needs a main
 # routine. For now this is mainly for testing. If parse_pto is imported,
 # main() will not be called.
     
-def main() :
+# batch mode: run_batch scans many pto files on a pool of worker processes and
+# writes one line of JSON per file, in the order the files were given, with
+# what was found in it or what went wrong:
+#
+# {"file": ..., "status": "ok", "seconds": ..., "lines": ..., "images": ...,
+#  "control_points": ..., "unscanned": ...}
+# {"file": ..., "status": "error", "seconds": ..., "error": "IOError: ..."}
+#
+# 'unscanned' counts the lines which are neither pto lines nor comments.
+# A file which can't be scanned doesn't stop the batch. inputs can be files,
+# directories (which are searched for .pto files) and glob patterns.
+# run_batch returns the number of files which failed.
+
+def batch_files ( inputs ) :
+
+    for item in inputs :
+        if os.path.isdir ( item ) :
+            for directory , subdirectories , filenames in os.walk ( item ) :
+                subdirectories.sort()
+                for filename in sorted ( filenames ) :
+                    if filename.lower().endswith ( '.pto' ) :
+                        yield os.path.join ( directory , filename )
+        elif os.path.exists ( item ) :
+            yield item
+        else :
+            matches = sorted ( glob.glob ( item ) )
+            if not matches :
+                yield item      # so that it's reported as missing
+            for match in matches :
+                if os.path.isdir ( match ) :
+                    for filename in batch_files ( [ match ] ) :
+                        yield filename
+                else :
+                    yield match
+
+def batch_record ( filename ) :
+
+    started = _timer()
+    record = { 'file' : filename }
+    try :
+        scan = pto_scan ( filename , fast_scan = True , keep_source = False ,
+                          member_access = False )
+        headers = {}
+        for line in scan.sequential :
+            headers [ line.header ] = headers.get ( line.header , 0 ) + 1
+        record.update ( status = 'ok' ,
+                        lines = len ( scan.sequential ) ,
+                        images = headers.get ( 'i' , 0 ) ,
+                        control_points = headers.get ( 'c' , 0 ) ,
+                        unscanned = headers.get ( '' , 0 ) )
+    except Exception as e :
+        record.update ( status = 'error' ,
+                        error = '%s: %s' % ( type ( e ) .__name__ , e ) )
+    record [ 'seconds' ] = round ( _timer() - started , 6 )
+    return record
+
+def run_batch ( inputs , workers = None , target = None , chunk = 8 ) :
+
+    if target is None :
+        target = sys.stdout
+    files = batch_files ( inputs )
+    if workers == 1 :
+        records = ( batch_record ( filename ) for filename in files )
+        pool = None
+    else :
+        pool = multiprocessing.Pool ( workers )
+        # imap hands out the files a chunk at a time and gives back the records
+        # in order, as soon as they're there
+        records = pool.imap ( batch_record , files , chunk )
+    failed = 0
+    try :
+        for record in records :
+            failed += record [ 'status' ] != 'ok'
+            target.write ( json.dumps ( record , sort_keys = True ) + '\n' )
+            target.flush()
+    finally :
+        if pool is not None :
+            pool.terminate()
+            pool.join()
+    return failed
+
+def main ( argv = None ) :
     
     # we create an argument parser
     
@@ -764,6 +2427,15 @@ def main() :
     If called with the -v option, the internal representation
     of the scan will be printed out, otherwise the internal
     representation will be reconverted into pto syntax and printed.
+    The latter is done line by line, so even huge files can be
+    processed with little memory. With -H, only lines with the
+    given headers are processed, like -H ic for i- and c-lines.
+
+    If pto files, directories or glob patterns are given as
+    arguments, they are all scanned, with -j worker processes,
+    and a line of JSON is printed for every file, telling what
+    was found in it or what went wrong. The exit status is 1
+    if any file failed.
 
     ''' )
     
@@ -776,19 +2448,41 @@ def main() :
                         action='store_true',
                         help='produce verbose output')
 
-    args = parser.parse_args( sys.argv[1:] )
+    parser.add_argument('-H', '--headers',
+                        metavar='<headers>',
+                        type=str,
+                        help='only process lines with these header letters')
+
+    parser.add_argument('-j', '--jobs',
+                        metavar='<workers>',
+                        type=int,
+                        help='number of worker processes in batch mode '
+                             '(default: one per CPU)')
+
+    parser.add_argument('inputs',
+                        metavar='<pto file, directory or glob>',
+                        nargs='*',
+                        help='files to scan in batch mode')
+
+    if argv is None :
+        argv = sys.argv[1:]
+    args = parser.parse_args( argv )
 
-    if len ( sys.argv ) < 2 :
+    if not argv :
         parser.print_help()
         return
 
-    scan = pto_scan ( args.pto )
-    scan.make_member_access()
+    if args.inputs :
+        return 1 if run_batch ( args.inputs , args.jobs ) else 0
 
     if args.verbose :
+        scan = pto_scan ( args.pto )
+        scan.make_member_access()
         scan.walk()
     else :
-        scan.pto()
+        write_pto_lines ( iter_pto ( args.pto , args.headers ,
+                                     fast_scan = True , lazy = True ) ,
+                          sys.stdout )
 
 # Usually, this script will be imported by another script. In the rare case
 # that it's called as a stand-alone script, it'll just scan the input file
@@ -797,6 +2491,6 @@ def main() :
 # are we main? if so, do the main thing...
 
 if __name__ == "__main__":
-    main()
+    sys.exit ( main() )
 
 # and that's it.
@@ -0,0 +1,130 @@
+"""
+What /load sends about a project's images.
+
+The fields a client can ask for with fields= are read from the image table
+(with back-references resolved) or computed from it. They go out either as
+records, one JSON object per image, or columnar, one array per field, which
+doesn't repeat the keys for every image. The atlas field tells where each
+image is in the project's texture atlas (see atlas.py). iter_json encodes a document in
+chunks, so a big response can start going out before all of it is encoded.
+"""
+import json
+import pyramid
+import geometry
+import atlas
+
+# fields read from i-line members, by the member(s) they come from
+MEMBER_FIELDS = {
+    'name': 'n',
+    'yaw': 'y',
+    'pitch': 'p',
+    'roll': 'r',
+    'view': 'v',
+    'width': 'w',
+    'height': 'h',
+    'projection': 'f',
+    'distortion': ('a', 'b', 'c'),
+    'shift': ('d', 'e'),
+    'shear': ('g', 't'),
+    'crop': 'S',
+    'exposure': 'Eev',
+}
+
+# fields computed from the others: the pyramid level URLs, the placement
+# of the image's plane in the viewer (see geometry.py) and the image's place
+# in the texture atlas
+COMPUTED_FIELDS = ('lod', 'transform', 'atlas')
+
+FIELDS = tuple(sorted(MEMBER_FIELDS)) + COMPUTED_FIELDS
+DEFAULT_FIELDS = ('name', 'yaw', 'pitch', 'roll', 'view', 'lod')
+FORMATS = ('records', 'columnar')
+
+# the size of the pieces iter_json produces
+CHUNK_SIZE = 16384
+
+def parse_fields(spec, transforms=False, atlas=False):
+    """
+    The fields asked for by a comma separated fields= value, in the order
+    given, the default ones for an empty value; with transforms, 'transform'
+    is added, with atlas, 'atlas'. Raises ValueError for a field there is no
+    such thing as.
+    """
+    fields = [f.strip() for f in spec.split(',') if f.strip()] or list(DEFAULT_FIELDS)
+    for field in fields:
+        if field not in FIELDS:
+            raise ValueError("No such field: %r" % field)
+    if transforms and 'transform' not in fields:
+        fields.append('transform')
+    if atlas and 'atlas' not in fields:
+        fields.append('atlas')
+    # a field asked for twice is sent once
+    return tuple(f for k, f in enumerate(fields) if f not in fields[:k])
+
+def image_columns(images, fields, project=None):
+    """
+    The values of the fields for all images of an image_table, as field ->
+    list; project is the project's file name, for the atlas page URLs.
+    """
+    columns = {}
+    for field in fields:
+        if field == 'lod':
+            columns[field] = [pyramid.lod_urls(name, largest=max(width, height))
+                              if name else []
+                              for name, width, height in zip(images.column('n'),
+                                                             images.column('w'),
+                                                             images.column('h'))]
+        elif field == 'transform':
+            columns[field] = geometry.image_transforms(images)
+        elif field == 'atlas':
+            columns[field] = atlas.image_entries(images, project)
+        else:
+            members = MEMBER_FIELDS[field]
+            if isinstance(members, tuple):
+                columns[field] = [list(values) for values in
+                                  zip(*[images.column(m) for m in members])]
+            else:
+                columns[field] = images.column(members)
+    return columns
+
+def build(images, fields=DEFAULT_FIELDS, format='records', project=None):
+    """
+    The /load document of an image_table: a list of one dict per image, or,
+    with format='columnar', a dict of one list per field.
+    """
+    columns = image_columns(images, fields, project)
+    if format == 'columnar':
+        return dict((field, columns[field]) for field in fields)
+    rows = zip(*[columns[field] for field in fields])
+    return [dict(zip(fields, row)) for row in rows]
+
+def iter_json(data, chunk=None):
+    """
+    json.dumps(data), in pieces of about chunk bytes. The items of a list or
+    dict are encoded one at a time, so the first piece is ready long before
+    the last item has been looked at.
+    """
+    chunk = chunk or CHUNK_SIZE
+    if isinstance(data, dict):
+        parts = ('%s: %s' % (json.dumps(key), json.dumps(value))
+                 for key, value in data.iteritems())
+        opening, closing = '{', '}'
+    elif isinstance(data, list):
+        parts = (json.dumps(item) for item in data)
+        opening, closing = '[', ']'
+    else:
+        yield json.dumps(data)
+        return
+    pending = [opening]
+    size = 1
+    separator = ''
+    for part in parts:
+        pending.append(separator)
+        pending.append(part)
+        size += len(part) + 2
+        separator = ', '
+        if size >= chunk:
+            yield ''.join(pending)
+            pending = []
+            size = 0
+    pending.append(closing)
+    yield ''.join(pending)
@@ -0,0 +1,88 @@
+import threading
+from multiprocessing.pool import Pool, ThreadPool
+
+class pool_full(Exception):
+    """Raised when a worker pool has no room left for another job."""
+
+class worker_pool(object):
+    """
+    Bounded pool for parse jobs.
+
+    ``workers`` threads (or processes, with ``processes=True``) run the jobs,
+    and at most ``queue_depth`` further jobs may wait for a free worker; any
+    more and ``submit()`` raises pool_full instead of letting requests pile up.
+    With ``workers=0`` jobs simply run in the calling thread.
+    In process mode, the job function and its arguments and result must be
+    picklable, so use module-level functions.
+    """
+
+    def __init__(self, workers, queue_depth, processes=False):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.processes = processes
+        self._slots = threading.BoundedSemaphore(max(workers, 1) + queue_depth)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Start ``fn(*args)`` and return a job whose ``get()`` gives the result."""
+        if not self._slots.acquire(False):
+            raise pool_full("%d jobs running or queued" % (max(self.workers, 1) + self.queue_depth))
+        if self.workers == 0:
+            try:
+                return _job(_call(fn, args))
+            finally:
+                self._slots.release()
+        try:
+            result = self._get_pool().apply_async(_call, (fn, args), callback=self._done)
+        except:
+            self._slots.release()
+            raise
+        return _job(result)
+
+    def map(self, fn, items):
+        """Run ``fn`` on all items in parallel and return the results in order."""
+        jobs = [self.submit(fn, item) for item in items]
+        return [job.get() for job in jobs]
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool.join()
+                self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                cls = Pool if self.processes else ThreadPool
+                self._pool = cls(self.workers)
+            return self._pool
+
+    def _done(self, outcome):
+        self._slots.release()
+
+class _job(object):
+
+    def __init__(self, outcome):
+        self._outcome = outcome
+
+    def ready(self):
+        return not hasattr(self._outcome, 'ready') or self._outcome.ready()
+
+    def get(self, timeout=None):
+        outcome = self._outcome
+        if hasattr(outcome, 'get'):
+            outcome = outcome.get(timeout)
+        failed, value = outcome
+        if failed:
+            raise value
+        return value
+
+def _call(fn, args):
+    # runs in the worker; exceptions are passed back as values, so the pool's
+    # callback (which frees the job's slot) is always called
+    try:
+        return (False, fn(*args))
+    except Exception as e:
+        return (True, e)
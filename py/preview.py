@@ -0,0 +1,336 @@
+"""
+Low resolution equirectangular previews of whole projects.
+
+A preview is the project's images remapped onto a 360x180 degree
+equirectangular image, from the yaw, pitch, roll, field of view, projection,
+radial distortion (a, b, c) and lens shift (d, e) of their i-lines, so the
+viewer has something to show while the real textures load. Each image is
+remapped on its own, on a process pool, by a vectorized coordinate transform
+over the part of the sphere its footprint (see geometry.py) can cover; the
+results are blended with weights falling off towards the image edges.
+
+Source pixels come from the images' pyramids (see pyramid.py). A preview is
+written to img/.preview/ under a name which includes a hash of the project
+file's and its images' stamps, so it is rendered again when any of them
+change.
+
+Run as a script to render the previews of some projects:
+
+    python preview.py [-j 4] [-w 1024] project.pto ...
+"""
+import os
+import sys
+import hashlib
+import argparse
+import tempfile
+import collections
+import multiprocessing
+import numpy
+import parse_pto
+import pyramid
+import geometry
+from cache import file_stamp
+from pool import worker_pool
+
+PREVIEW_WIDTH = 1024
+PREVIEW_DIR = '.preview'
+PREVIEW_VERSION = 1
+QUALITY = pyramid.QUALITY
+
+# the i-line projections (f) remap_image knows how to map to: rectilinear,
+# cylindrical, circular and full frame fisheye, equirectangular
+PROJECTIONS = (0, 1, 2, 3, 4)
+
+# the i-line members a remap needs, with their defaults
+IMAGE_MEMBERS = (('n', None), ('w', None), ('h', None), ('f', 0), ('v', None),
+                 ('y', 0.0), ('p', 0.0), ('r', 0.0), ('a', 0.0), ('b', 0.0),
+                 ('c', 0.0), ('d', 0.0), ('e', 0.0))
+
+def read_project(pto_path):
+    return parse_pto.pto_scan(pto_path, fast_scan=True, keep_source=False, lazy=True)
+
+def project_parameters(scan):
+    """
+    The parameters of a project's images, as one dict per image with back
+    references resolved.
+    """
+    images = scan.images()
+    return [dict((name, images.get(k, name, default)) for name, default in IMAGE_MEMBERS)
+            for k in range(len(images))]
+
+def preview_key(pto_path, width, stamps):
+    """
+    A hash of everything a preview depends on: its width, and the stamps of
+    the project file and its images (see pyramid.source_stamps).
+    """
+    key = repr((PREVIEW_VERSION, width, file_stamp(pto_path), stamps))
+    return hashlib.sha1(key).hexdigest()[:20]
+
+def preview_target(pto_path, img_dir, width, scan=None, stamps=None):
+    """
+    Where the project's preview for width goes, and its (width, height).
+    scan is the project's pto_scan, read from pto_path if not given, and
+    stamps its images' stamps, looked up if not given.
+    """
+    if scan is None:
+        scan = read_project(pto_path)
+    if stamps is None:
+        stamps = pyramid.source_stamps(img_dir, scan.images().column('n'))
+    panorama = scan.lines_with_header('p')
+    width, height = preview_size(width, panorama[0].extract('w') if panorama else None)
+    key = preview_key(pto_path, width, stamps)
+    return preview_path(img_dir, pto_path, width, key), (width, height)
+
+def preview_path(img_dir, pto_path, width, key):
+    return os.path.join(img_dir, PREVIEW_DIR, '%s-%d-%s.jpg' % (
+        os.path.basename(pto_path), width, key))
+
+def preview_size(width, panorama_width=None):
+    """The preview's (width, height): no wider than the panorama, and even."""
+    if panorama_width:
+        width = min(width, int(panorama_width))
+    width = max(2, width - width % 2)
+    return width, width // 2
+
+def sphere_directions(width, height, rows, columns):
+    """
+    Unit vectors (x right, y up, z ahead at yaw 0) of the centres of some
+    pixels of a width x height equirectangular image, yaw -180 at the left
+    and pitch 90 at the top.
+    """
+    yaw = numpy.radians(-180 + 360.0 * (columns + 0.5) / width)
+    pitch = numpy.radians(90 - 180.0 * (rows + 0.5) / height)
+    cos_pitch = numpy.cos(pitch)[:, None]
+    return (cos_pitch * numpy.sin(yaw)[None, :],
+            numpy.repeat(numpy.sin(pitch)[:, None], len(columns), axis=1),
+            cos_pitch * numpy.cos(yaw)[None, :])
+
+def covered_pixels(image, width, height):
+    """
+    The first and last row and the columns of a width x height equirectangular
+    image which the image's footprint can reach, or None if there's no telling.
+    """
+    radius = geometry.footprint_radius(image['v'], image['w'], image['h'], image['f'])
+    if not numpy.isfinite(radius):
+        return None
+    # distortion can push the edges out a little
+    radius = min(float(radius) * 1.1 + 2 * numpy.pi / width, numpy.pi)
+    pitch = numpy.radians(image['p'])
+    top = int(numpy.floor((numpy.pi / 2 - pitch - radius) / numpy.pi * height))
+    bottom = int(numpy.ceil((numpy.pi / 2 - pitch + radius) / numpy.pi * height))
+    top, bottom = max(top, 0), min(bottom, height - 1)
+    if abs(pitch) + radius >= numpy.pi / 2:
+        # around a pole, every yaw
+        return top, bottom, numpy.arange(width)
+    reach = numpy.arcsin(min(1.0, numpy.sin(radius) / numpy.cos(pitch)))
+    centre = (numpy.radians(image['y']) + numpy.pi) / (2 * numpy.pi) * width
+    span = reach / (2 * numpy.pi) * width
+    columns = numpy.arange(int(numpy.floor(centre - span)), int(numpy.ceil(centre + span)) + 1)
+    return top, bottom, numpy.unique(columns % width)
+
+def image_coordinates(image, x, y, z):
+    """
+    Where directions x, y, z (arrays, as from sphere_directions) show up in
+    the image: pixel columns and rows of the full size image, and which of
+    them are in front of it at all.
+    """
+    yaw, pitch, roll = [numpy.radians(image[m]) for m in 'ypr']
+    # turn the image's centre to straight ahead, then level it
+    x, z = x * numpy.cos(yaw) - z * numpy.sin(yaw), x * numpy.sin(yaw) + z * numpy.cos(yaw)
+    y, z = y * numpy.cos(pitch) - z * numpy.sin(pitch), y * numpy.sin(pitch) + z * numpy.cos(pitch)
+    x, y = x * numpy.cos(roll) - y * numpy.sin(roll), x * numpy.sin(roll) + y * numpy.cos(roll)
+
+    width, height, projection = float(image['w']), float(image['h']), image['f']
+    half = numpy.radians(image['v']) / 2
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        if projection == 0:
+            focal = width / 2 / numpy.tan(half)
+            valid = z > 1e-6
+            u, v = focal * x / z, focal * y / z
+        elif projection in (2, 3):
+            # equidistant fisheye: the distance from the centre goes with the angle
+            focal = width / 2 / half
+            angle = numpy.arccos(numpy.clip(z, -1, 1))
+            scale = focal * angle / numpy.hypot(x, y)
+            valid = angle < numpy.pi - 1e-6
+            u, v = numpy.nan_to_num(x * scale), numpy.nan_to_num(y * scale)
+        else:
+            focal = width / 2 / half
+            u = focal * numpy.arctan2(x, z)
+            valid = numpy.ones(x.shape, bool)
+            if projection == 1:
+                v = focal * y / numpy.hypot(x, z)
+            else:
+                v = focal * numpy.arctan2(y, numpy.hypot(x, z))
+
+        # the panotools radial distortion polynomial, in units of half the
+        # short side
+        a, b, c = image['a'], image['b'], image['c']
+        if a or b or c:
+            unit = min(width, height) / 2
+            r = numpy.hypot(u, v) / unit
+            scale = ((a * r + b) * r + c) * r + (1 - a - b - c)
+            u, v = u * scale, v * scale
+    columns = width / 2 + image['d'] + u - 0.5
+    rows = height / 2 + image['e'] - v - 0.5
+    valid &= numpy.isfinite(columns) & numpy.isfinite(rows)
+    return columns, rows, valid
+
+def sample(pixels, columns, rows):
+    """Bilinear interpolation of an (h, w, 3) array at fractional columns and rows."""
+    height, width = pixels.shape[:2]
+    columns = numpy.clip(columns, 0, width - 1)
+    rows = numpy.clip(rows, 0, height - 1)
+    left = numpy.minimum(columns.astype(int), width - 2 if width > 1 else 0)
+    top = numpy.minimum(rows.astype(int), height - 2 if height > 1 else 0)
+    right = numpy.minimum(left + 1, width - 1)
+    bottom = numpy.minimum(top + 1, height - 1)
+    fx = (columns - left)[..., None]
+    fy = (rows - top)[..., None]
+    upper = pixels[top, left] * (1 - fx) + pixels[top, right] * fx
+    lower = pixels[bottom, left] * (1 - fx) + pixels[bottom, right] * fx
+    return upper * (1 - fy) + lower * fy
+
+def remap_image(img_dir, image, width, height):
+    """
+    One image's part of a width x height preview: (top row, columns, weights,
+    weighted colours), the last two for the rows from top on and those
+    columns - or None if the image can't be shown.
+    """
+    if (image['n'] is None or None in (image['w'], image['h'], image['v']) or
+            image['f'] not in PROJECTIONS):
+        return None
+    covered = covered_pixels(image, width, height)
+    if covered is None:
+        return None
+    top, bottom, columns = covered
+    rows = numpy.arange(top, bottom + 1)
+    x, y, z = sphere_directions(width, height, rows, columns)
+    source_columns, source_rows, valid = image_coordinates(image, x, y, z)
+
+    # fully inside the image, falling to 0 at the edges
+    w, h = float(image['w']), float(image['h'])
+    edge = numpy.minimum(numpy.minimum(source_columns + 0.5, w - 0.5 - source_columns),
+                         numpy.minimum(source_rows + 0.5, h - 0.5 - source_rows))
+    weights = numpy.where(valid, numpy.clip(edge / (min(w, h) / 2), 0, 1), 0)
+    if not weights.any():
+        return None
+
+    # pixels from the pyramid level about as big as the image is in the preview
+    needed = int(width * image['v'] / 360.0 * max(w, h) / w) + 1
+    manifest = pyramid.build_pyramid(img_dir, image['n'])
+    level = pyramid.Image.open(pyramid.level_path(img_dir, image['n'], manifest, needed))
+    pixels = numpy.asarray(level.convert('RGB'), dtype=numpy.float32)
+    scale_x, scale_y = pixels.shape[1] / w, pixels.shape[0] / h
+    colours = sample(pixels, (source_columns + 0.5) * scale_x - 0.5,
+                     (source_rows + 0.5) * scale_y - 0.5)
+    weights = weights.astype(numpy.float32)
+    return top, columns, weights, colours * weights[..., None]
+
+def render_preview(pto_path, img_dir, width=PREVIEW_WIDTH, workers=None, pool=None,
+                   force=False, scan=None, stamps=None):
+    """
+    The path of the project's preview, rendered first unless there's a current
+    one. The images are remapped on pool, or on a pool of workers processes
+    (default: one per CPU). Images which can't be remapped are left out.
+    scan and stamps are as for preview_target.
+    """
+    if pyramid.Image is None:
+        raise RuntimeError("Pillow is needed to render previews")
+    if scan is None:
+        scan = read_project(pto_path)
+    path, (width, height) = preview_target(pto_path, img_dir, width, scan, stamps)
+    if not force and os.path.exists(path):
+        return path
+
+    parameters = project_parameters(scan)
+    own_pool = pool is None
+    if own_pool:
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(parameters)))
+        pool = worker_pool(workers, len(parameters), processes=workers > 1)
+    totals = numpy.zeros((height, width), numpy.float32)
+    colours = numpy.zeros((height, width, 3), numpy.float32)
+    def add(job):
+        try:
+            part = job.get()
+        except (EnvironmentError, ValueError):
+            return # a missing or unreadable image
+        if part is not None:
+            top, columns, weights, weighted = part
+            rows = slice(top, top + weights.shape[0])
+            totals[rows, columns] += weights
+            colours[rows, columns] += weighted
+    try:
+        # a few jobs at a time, so a big project doesn't fill a shared pool
+        window = max(pool.workers, 1) * 2
+        jobs = collections.deque()
+        for image in parameters:
+            if len(jobs) >= window:
+                add(jobs.popleft())
+            jobs.append(pool.submit(remap_image, img_dir, image, width, height))
+        while jobs:
+            add(jobs.popleft())
+    finally:
+        if own_pool:
+            pool.close()
+
+    covered = totals > 0
+    colours[covered] /= totals[covered][:, None]
+    picture = pyramid.Image.fromarray(numpy.clip(colours + 0.5, 0, 255).astype(numpy.uint8))
+    write_preview(picture, path)
+    return path
+
+def write_preview(picture, path):
+    """Save picture as path, in place of older previews of the same project."""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+    handle, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.jpg', dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            picture.save(f, 'JPEG', quality=QUALITY)
+        os.rename(tmp, path)
+    except:
+        os.unlink(tmp)
+        raise
+    # previews of the same project and width, that is
+    prefix = os.path.basename(path).rsplit('-', 1)[0]
+    for name in os.listdir(directory):
+        if name.rsplit('-', 1)[0] == prefix and name != os.path.basename(path):
+            try:
+                os.unlink(os.path.join(directory, name))
+            except OSError:
+                pass # someone else tidied up first
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render equirectangular previews of pto projects.')
+    parser.add_argument('pto', nargs='+', help='pto files to render previews of')
+    parser.add_argument('-i', '--img-dir', default=os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'img'),
+        help='directory with the source images (default: img/ in the project root)')
+    parser.add_argument('-w', '--width', type=int, default=PREVIEW_WIDTH,
+                        help='width of the previews in pixels (default: %d)' % PREVIEW_WIDTH)
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='render previews even if they are up to date')
+    args = parser.parse_args(argv)
+
+    failed = 0
+    for filename in args.pto:
+        try:
+            print('%s: %s' % (filename, render_preview(filename, args.img_dir, args.width,
+                                                       args.jobs, force=args.force)))
+        except (EnvironmentError, ValueError, RuntimeError) as e:
+            failed += 1
+            print('%s: %s' % (filename, e))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+"""
+Multi-resolution pyramids of the source images in img/.
+
+For each source image a set of downscaled JPEG levels (256, 512, 1024 and
+2048 pixels on the long side, capped at the size of the source) is written to
+img/.pyramid/<name>/, together with a pyramid.json manifest recording the
+source's mtime and size. A pyramid is rebuilt when the manifest no longer
+matches its source. Levels bigger than TILE_SIZE can also be cut into tiles,
+named <size>_<column>_<row>.jpg.
+
+Run as a script to build the pyramids of all images used by some projects:
+
+    python pyramid.py [-j 4] [--tiles] project.pto ...
+"""
+import os
+import sys
+import json
+import shutil
+import urllib
+import argparse
+import tempfile
+import multiprocessing
+import parse_pto
+from cache import file_stamp
+from pool import worker_pool
+
+# Pillow is only needed to actually build pyramids
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LEVEL_SIZES = (256, 512, 1024, 2048)
+TILE_SIZE = 256
+QUALITY = 85
+MANIFEST = 'pyramid.json'
+MANIFEST_VERSION = 1
+
+def image_key(name):
+    """The file name of a project's image in img/ (projects may use paths)."""
+    key = os.path.basename(name.replace('\\', '/'))
+    if not key or key.startswith('.'):
+        raise ValueError("Illegal image name %r" % name)
+    return str(key)
+
+def pyramid_dir(img_dir, name):
+    return os.path.join(img_dir, '.pyramid', image_key(name))
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (EnvironmentError, ValueError):
+        return None
+
+def current_manifest(img_dir, name, sizes=LEVEL_SIZES, tiles=False):
+    """The manifest of the image's pyramid, or None if it needs (re)building."""
+    manifest = read_manifest(pyramid_dir(img_dir, name))
+    if (manifest is None or manifest.get('version') != MANIFEST_VERSION or
+            manifest.get('sizes') != list(sizes) or tiles and not manifest.get('tiles')):
+        return None
+    if manifest.get('stamp') != list(file_stamp(os.path.join(img_dir, image_key(name)))):
+        return None
+    return manifest
+
+def build_pyramid(img_dir, name, sizes=LEVEL_SIZES, tiles=False, force=False):
+    """
+    Build the pyramid of one source image, unless it is up to date, and return
+    its manifest.
+    """
+    if not force:
+        manifest = current_manifest(img_dir, name, sizes, tiles)
+        if manifest is not None:
+            return manifest
+    if Image is None:
+        raise RuntimeError("Pillow is needed to build image pyramids")
+    source = os.path.join(img_dir, image_key(name))
+    stamp = file_stamp(source)
+    image = Image.open(source)
+    full_size = image.size
+    levels = level_sizes(sizes, max(full_size))
+    # let the JPEG decoder do the first, coarse part of the downscaling
+    image.draft('RGB', (levels[-1], levels[-1]))
+    image = image.convert('RGB')
+
+    target = pyramid_dir(img_dir, name)
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    # the levels are written to a fresh directory which then replaces the old
+    # pyramid, so readers never see a half-built one
+    tmp = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+    try:
+        written = []
+        for size in reversed(levels):
+            # each level is made from the next bigger one
+            image = fit(image, size, full_size)
+            image.save(os.path.join(tmp, '%d.jpg' % size), quality=QUALITY)
+            written.append({'size': size, 'width': image.size[0], 'height': image.size[1]})
+            if tiles:
+                save_tiles(image, tmp, size)
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'stamp': list(stamp),
+            'sizes': list(sizes),
+            'tiles': bool(tiles),
+            'tile_size': TILE_SIZE,
+            'levels': written[::-1],
+        }
+        with open(os.path.join(tmp, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+        # the old pyramid is moved aside rather than deleted first, so it is
+        # only gone for the moment between the two renames
+        aside = tmp + '.old'
+        try:
+            os.rename(target, aside)
+        except OSError:
+            aside = None # there was none, or someone else moved it
+        try:
+            os.rename(tmp, target)
+        except OSError:
+            # someone else built the same pyramid at the same time
+            shutil.rmtree(tmp, ignore_errors=True)
+        if aside is not None:
+            shutil.rmtree(aside, ignore_errors=True)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return manifest
+
+def level_sizes(sizes, largest):
+    """The sizes of the levels of an image largest pixels on its long side."""
+    return sorted(set(min(size, largest) for size in sizes))
+
+def fit(image, size, full_size):
+    """
+    image scaled down so that its long side is size pixels, keeping the aspect
+    ratio of the full size image (rounding errors would add up level by level).
+    """
+    width, height = full_size
+    scale = float(size) / max(width, height)
+    if scale >= 1:
+        return image
+    dimensions = (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+    if dimensions == image.size:
+        return image
+    return image.resize(dimensions, Image.ANTIALIAS)
+
+def save_tiles(image, directory, size):
+    width, height = image.size
+    if max(width, height) <= TILE_SIZE:
+        return
+    for top in range(0, height, TILE_SIZE):
+        for left in range(0, width, TILE_SIZE):
+            tile = image.crop((left, top, min(left + TILE_SIZE, width),
+                               min(top + TILE_SIZE, height)))
+            tile.save(os.path.join(directory, '%d_%d_%d.jpg' % (
+                size, left // TILE_SIZE, top // TILE_SIZE)), quality=QUALITY)
+
+def level_path(img_dir, name, manifest, size):
+    """
+    The file of the smallest level at least size pixels big (or the biggest
+    level there is).
+    """
+    levels = manifest['levels']
+    chosen = levels[-1]
+    for level in levels:
+        if level['size'] >= size:
+            chosen = level
+            break
+    return os.path.join(pyramid_dir(img_dir, name), '%d.jpg' % chosen['size'])
+
+def source_stamps(img_dir, names):
+    """The stamps of images in img_dir, None for those which aren't there (yet)."""
+    stamps = []
+    for name in names:
+        try:
+            stamps.append(file_stamp(os.path.join(img_dir, image_key(name))))
+        except (ValueError, AttributeError, EnvironmentError):
+            stamps.append(None)
+    return stamps
+
+def lod_urls(name, sizes=LEVEL_SIZES, largest=None):
+    """
+    The URLs of an image's levels of detail, smallest first. With the size
+    of the image's long side, only the levels its pyramid will have.
+    """
+    quoted = urllib.quote(image_key(name))
+    if largest:
+        sizes = level_sizes(sizes, largest)
+    return ['/pyramid/%s/%d.jpg' % (quoted, size) for size in sizes]
+
+def project_images(pto_filename):
+    """The names of the images a project uses, without duplicates."""
+    images = parse_pto.pto_scan(pto_filename, fast_scan=True, keep_source=False,
+                                lazy=True).images()
+    names = []
+    for name in images.column('n'):
+        if name and name not in names:
+            names.append(name)
+    return names
+
+def build_pyramids(img_dir, names, workers=None, sizes=LEVEL_SIZES, tiles=False, force=False):
+    """
+    Build the pyramids of all names on a process pool. Returns (name, manifest)
+    pairs, with the exception instead of the manifest for failed images.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    pool = worker_pool(min(workers, len(names)), len(names), processes=workers > 1)
+    try:
+        jobs = [(name, pool.submit(build_pyramid, img_dir, name, sizes, tiles, force))
+                for name in names]
+        results = []
+        for name, job in jobs:
+            try:
+                results.append((name, job.get()))
+            except Exception as e:
+                results.append((name, e))
+        return results
+    finally:
+        pool.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the image pyramids of pto projects.')
+    parser.add_argument('pto', nargs='+', help='pto files whose images to process')
+    parser.add_argument('-i', '--img-dir', default=os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'img'),
+        help='directory with the source images (default: img/ in the project root)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes (default: one per CPU)')
+    parser.add_argument('-t', '--tiles', action='store_true',
+                        help='also cut the levels into %dx%d tiles' % (TILE_SIZE, TILE_SIZE))
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rebuild pyramids even if they are up to date')
+    args = parser.parse_args(argv)
+
+    names = []
+    for filename in args.pto:
+        names.extend(name for name in project_images(filename) if name not in names)
+    failed = 0
+    for name, result in build_pyramids(args.img_dir, names, args.jobs,
+                                       tiles=args.tiles, force=args.force):
+        if isinstance(result, Exception):
+            failed += 1
+            print('%s: %s' % (name, result))
+        else:
+            print('%s: %s' % (name, ' '.join('%(width)dx%(height)d' % level
+                                             for level in result['levels'])))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,52 @@
+// the image nearest to where the camera looks (see render() in renderer.js)
+function imageInView(data) {
+	var best = 0, bestDistance = Infinity;
+	$.each(data, function(i, item) {
+		var dyaw = ((item['yaw'] - lon) % 360 + 540) % 360 - 180;
+		var distance = dyaw * dyaw + (item['pitch'] - lat) * (item['pitch'] - lat);
+		if (distance < bestDistance) {
+			best = i;
+			bestDistance = distance;
+		}
+	});
+	return best;
+}
+
+// the images in view get their bigger textures (see refineImage), once the
+// server has said which they are
+function refineInView(filename) {
+	var view = {
+		yaw: lon,
+		pitch: Math.max( - 85, Math.min( 85, lat ) ),
+		fov: Math.max( 1, Math.min( 179, fov ) ),
+		aspect: window.innerWidth / (window.innerHeight - 200)
+	};
+	$.getJSON("/visible/" + filename, view, function(visible) {
+		$.each(visible['images'], function(i, index) {
+			refineImage(index);
+		});
+	});
+}
+
 function loadPano(filename) {
-	$.getJSON("/load/" + filename, function(data) {
+	$.getJSON("/load/" + filename + "?transforms=1&atlas=1", function(data) {
 		console.log(data);
-		init(data);
-		animate();
+		// the images are added around the one in view first, so their
+		// textures load in that order; without the graph, in file order
+		var start = function(order) {
+			init(data, order);
+			addBackdrop("/preview/" + filename);
+			onViewChange = function() {
+				refineInView(filename);
+			};
+			refineInView(filename);
+			animate();
+		};
+		$.getJSON("/graph/" + filename + "?start=" + imageInView(data), function(graph) {
+			start(graph['order']);
+		}).error(function() {
+			start();
+		});
 //		var items = [];
 //		$.each(data, function(i, item) {
 //			//
@@ -9,13 +9,95 @@ lon = 90, onMouseDownLon = 0,
 lat = 0, onMouseDownLat = 0,
 phi = 0, theta = 0;
 var allmeshes = new Array();
+// the preview (see /preview) is drawn on a sphere around everything else,
+// inside the camera's far plane
+var backdropRadius = 9000, farPlane = 10000;
 //$(window).load(function() {
 //	init();
 //	animate();
 //});
 
-function addImage(filename, yaw, pitch, roll, view) {
-	mesh = new THREE.Mesh( new THREE.PlaneGeometry( imgsize, imgsize, 1, 1 ), new THREE.MeshBasicMaterial( { map: THREE.ImageUtils.loadTexture( filename ) } ) );
+// urls are the image's levels of detail, smallest first: the smallest one is
+// shown right away, the bigger ones replace it once the image is refined (see
+// refineImage), when it comes into view. With an atlas entry (see
+// /load?atlas=1), the smallest level is the image's part of an atlas page
+// instead, which it shares with other images. Returns what refines the image,
+// or null.
+function addImage(urls, yaw, pitch, roll, view, transform, atlas) {
+	if (!atlas) {
+		var material = new THREE.MeshBasicMaterial( { map: THREE.ImageUtils.loadTexture( urls[0] ) } );
+		mesh = imageMesh(material);
+		placeImage(mesh, yaw, pitch, roll, view, transform);
+		addMesh(mesh);
+		return urls.length < 2 ? null : function() {
+			refineTexture(material, urls, 1);
+		};
+	}
+	var first = imageMesh(new THREE.MeshBasicMaterial( { map: atlasTexture(atlas['url']) } ), atlas['uv']);
+	placeImage(first, yaw, pitch, roll, view, transform);
+	addMesh(first);
+	if (urls.length < 2) {
+		return null;
+	}
+	return function() {
+		// the image's own textures cover all of a plane, so they get a new one
+		var texture = THREE.ImageUtils.loadTexture( urls[1], undefined, function() {
+			var material = new THREE.MeshBasicMaterial( { map: texture } );
+			var own = imageMesh(material);
+			placeImage(own, yaw, pitch, roll, view, transform);
+			replaceMesh(first, own);
+			refineTexture(material, urls, 2);
+		});
+	};
+}
+
+// what refines each image which hasn't been refined yet, by its index
+var refinements = {};
+
+// start loading an image's bigger textures, unless they are on their way
+function refineImage(index) {
+	var refine = refinements[index];
+	if (refine) {
+		delete refinements[index];
+		refine();
+	}
+}
+
+// called, if set, once the view has moved and stays put for viewChangeDelay ms
+var onViewChange = null, viewChangeDelay = 250, viewChangeTimer = null;
+
+function viewChanged() {
+	if (!onViewChange) {
+		return;
+	}
+	clearTimeout(viewChangeTimer);
+	viewChangeTimer = setTimeout(function() {
+		viewChangeTimer = null;
+		onViewChange();
+	}, viewChangeDelay);
+}
+
+// a plane for an image, showing the rectangle uv ([left, top, right,
+// bottom]) of its texture, or all of it
+function imageMesh(material, uv) {
+	var geometry = new THREE.PlaneGeometry( imgsize, imgsize, 1, 1 );
+	if (uv) {
+		$.each(geometry.faceVertexUvs[0][0], function(i, corner) {
+			corner.u = uv[0] + (uv[2] - uv[0]) * corner.u;
+			corner.v = uv[1] + (uv[3] - uv[1]) * corner.v;
+		});
+	}
+	return new THREE.Mesh( geometry, material );
+}
+
+function placeImage(mesh, yaw, pitch, roll, view, transform) {
+	if (transform) {
+		// placed by the server (geometry.py), for a plane of imgsize
+		mesh.position.set(transform.position[0], transform.position[1], transform.position[2]);
+		mesh.quaternion.set(transform.quaternion[0], transform.quaternion[1], transform.quaternion[2], transform.quaternion[3]);
+		mesh.useQuaternion = true;
+		return;
+	}
 	distance = (imgsize / 2) / Math.cos((180-view)/2 * Math.PI / 180); 
 	mesh.rotation.y = 90-yaw * Math.PI / 180;
 	mesh.rotation.z = roll * Math.PI / 180;
@@ -25,20 +107,63 @@ function addImage(filename, yaw, pitch, roll, view) {
 	mesh.position.x = distance * Math.sin( phi ) * Math.cos( theta );
 	mesh.position.y = distance * Math.cos( phi );
 	mesh.position.z = distance * Math.sin( phi ) * Math.sin( theta );
+}
 
+// the atlas pages, each loaded (and uploaded) once for all its images
+var atlasTextures = {};
+
+function atlasTexture(url) {
+	if (!atlasTextures[url]) {
+		atlasTextures[url] = THREE.ImageUtils.loadTexture( url );
+	}
+	return atlasTextures[url];
+}
+
+function addMesh(mesh) {
 	scene.add( mesh );
 	mesh.flipsided = true;
 	mesh.scale.x = -1;
 	allmeshes.push(mesh);
 }
 
-function init(data) {
+// url is an equirectangular image of the whole panorama: yaw -180 to 180
+// from left to right, where addImage puts images at theta = yaw
+function addBackdrop(url) {
+	var material = new THREE.MeshBasicMaterial( { map: THREE.ImageUtils.loadTexture( url ) } );
+	var mesh = new THREE.Mesh( new THREE.SphereGeometry( backdropRadius, 64, 32 ), material );
+	// the sphere's u runs the other way round
+	mesh.scale.z = -1;
+	mesh.doubleSided = true;
+	scene.add( mesh );
+	return mesh;
+}
+
+function replaceMesh(old, mesh) {
+	scene.remove( old );
+	scene.add( mesh );
+	mesh.flipsided = true;
+	mesh.scale.x = -1;
+	allmeshes[allmeshes.indexOf(old)] = mesh;
+}
+
+function refineTexture(material, urls, level) {
+	if (level >= urls.length) {
+		return;
+	}
+	var texture = THREE.ImageUtils.loadTexture( urls[level], undefined, function() {
+		material.map = texture;
+		refineTexture(material, urls, level + 1);
+	});
+}
+
+// order, if given, is the order to add the images in (see /graph)
+function init(data, order) {
 
 	var container, mesh;
 
 	container = document.getElementById( 'renderercontainer' );
 
-	camera = new THREE.PerspectiveCamera( fov, window.innerWidth / window.innerHeight, 1, 10000 );
+	camera = new THREE.PerspectiveCamera( fov, window.innerWidth / window.innerHeight, 1, farPlane );
 
 	camera.target = new THREE.Vector3( 0, 0, 0 );
 
@@ -65,8 +190,11 @@ function init(data) {
 	theLine = new THREE.Line( geom, new THREE.LineBasicMaterial( { color: 0x0000ff, opacity: 1, linewidth: 7 } ) );
 	scene.add(theLine);
 	
-	$.each(data, function(index, item) {
-		addImage('/static/img/small/' + item['name'], item['yaw'], item['pitch'], item['roll'], data[0]['view']);
+	refinements = {};
+	$.each(order || $.map(data, function(item, index) { return index; }), function(i, index) {
+		var item = data[index];
+		var urls = item['lod'] && item['lod'].length ? item['lod'] : ['/static/img/small/' + item['name']];
+		refinements[index] = addImage(urls, item['yaw'], item['pitch'], item['roll'], item['view'], item['transform'], item['atlas']);
 	});
 
 	renderer = new THREE.WebGLRenderer();
@@ -109,6 +237,7 @@ function onDocumentMouseMove( event ) {
 function onDocumentMouseUp( event ) {
 
 	isUserInteracting = false;
+	viewChanged();
 
 }
 
@@ -134,8 +263,9 @@ function onDocumentMouseWheel( event ) {
 
 	}
 
-	camera.projectionMatrix = THREE.Matrix4.makePerspective( fov, window.innerWidth / window.innerHeight, 1, 1100 );
+	camera.projectionMatrix = THREE.Matrix4.makePerspective( fov, window.innerWidth / window.innerHeight, 1, farPlane );
 	render();
+	viewChanged();
 
 }
 
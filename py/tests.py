@@ -1,5 +1,88 @@
 import unittest
+import json
+import os
+import math
+import glob
+import random
+import shutil
+import tempfile
+import threading
+import zlib
+import numpy
+import sys
+from StringIO import StringIO
 import app
+import parse_pto
+from cache import lru_cache
+from pool import worker_pool, pool_full
+import pyramid
+import geometry
+import catalog
+import metrics
+import payload
+import preview
+import atlas
+
+SAMPLE_PTO = """\
+# hugin project file
+#hugin_ptoversion 2
+p f2 w3000 h1500 v360  E0 R0 n"TIFF_m c:LZW r:CROP"
+m g1 i0 f0 m2 p0.00784314
+
+# image lines
+#-hugin  cropFactor=1
+i w4000 h3000 f0 v50 Ra0 Rb0 Rc0 Rd0 Re0 Eev0 Er1 Eb1 r0 p0 y0 TrX0 TrY0 TrZ0 j0 a0 b-0.01 c0 d0 e0 g0 t0 Va1 Vb0 Vc0 Vd0 Vx0 Vy0  Vm5 n"img0.jpg"
+#-hugin  cropFactor=1
+i w4000 h3000 f0 v=0 Ra=0 Rb=0 Rc=0 Rd=0 Re=0 Eev0 Er1 Eb1 r1.5 p-2.25 y45.5 TrX0 TrY0 TrZ0 j0 a=0 b=0 c=0 d0 e0 g0 t0 Va=0 Vb=0 Vc=0 Vd=0 Vx=0 Vy=0  Vm5 n"img1.jpg"
+
+# specify variables that should be optimized
+v y1
+v p1
+v
+
+# control points
+c n0 N1 x100.5 y200.25 X300 Y400 t0
+c n0 N1 x1500 y800 X10.125 Y790.5 t0
+
+#hugin_optimizeReferenceImage 0
+#hugin_blender enblend
+#hugin_outputLDRBlended true
+"""
+
+def write_pto(directory, name, content=SAMPLE_PTO):
+    path = os.path.join(directory, name)
+    f = open(path, 'w')
+    f.write(content)
+    f.close()
+    return path
+
+# the caches the app keeps its projects and what it made from them in
+APP_CACHES = ('scan_cache', 'load_cache', 'encoded_cache', 'footprint_cache',
+              'source_cache', 'preview_cache', 'atlas_cache')
+
+class ServingMixin(object):
+    """
+    For the tests of the web app: serve() has the app serve the projects in a
+    directory (and the images in another), with empty caches, until the test
+    is over, and project_dir() makes a directory with a project in it.
+    """
+
+    def serve(self, pto_dir, img_dir=None):
+        saved = app.PTO_DIR, app.IMG_DIR
+        def restore():
+            app.PTO_DIR, app.IMG_DIR = saved
+        self.addCleanup(restore)
+        app.PTO_DIR = pto_dir
+        if img_dir is not None:
+            app.IMG_DIR = img_dir
+        for cache in APP_CACHES:
+            getattr(app, cache).clear()
+
+    def project_dir(self, content=SAMPLE_PTO, name='a.pto'):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        write_pto(tmpdir, name, content)
+        return tmpdir
 
 class TestPTOParser(unittest.TestCase):
 
@@ -9,4 +92,1430 @@ class TestPTOParser(unittest.TestCase):
     def test_load(self):
         pto = app.load_pto('../pto/PA030369-PA030374.pto')
         self.assertEqual(pto.i[0].n.value, 'PA030369.JPG', '''Image filename''')
-        
\ No newline at end of file
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        app.scan_cache.clear()
+        app.load_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lru_eviction(self):
+        cache = lru_cache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_cost_budget(self):
+        cache = lru_cache(max_entries=10, max_cost=100)
+        cache.put('a', 1, cost=60)
+        cache.put('b', 2, cost=60)
+        self.assertFalse('a' in cache)
+        self.assertEqual(cache.cost, 60)
+
+    def test_stale_stamp_is_a_miss(self):
+        cache = lru_cache()
+        cache.put('a', 1, stamp=(1, 10))
+        self.assertEqual(cache.get('a', (1, 10)), 1)
+        self.assertEqual(cache.get('a', (2, 10)), None)
+        self.assertFalse('a' in cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_load_pto_is_cached(self):
+        path = write_pto(self.tmpdir, 'sample.pto')
+        first = app.load_pto(path)
+        self.assertTrue(app.load_pto(path) is first)
+        write_pto(self.tmpdir, 'sample.pto', SAMPLE_PTO + 'c n0 N1 x1 y1 X1 Y1 t0\n')
+        second = app.load_pto(path)
+        self.assertFalse(second is first)
+        self.assertEqual(len(second.c), len(first.c) + 1)
+
+# a corpus of lines that should trip up any tokenizer taking shortcuts:
+# multi-letter qualifiers, qualifiers without a value, signs, half-floats,
+# rectangles, back references, strings with spaces and escaped quotes,
+# words glued to numbers, and extension lines.
+
+TRICKY_LINES = [
+    'i w4000 h3000 f0 v=0 Ra=0 Eev0.5 Er1 Eb1 TrXYZ1 Tpy-0.5 TrX+.5 n"a b c.jpg"\n',
+    'p f2 w3000 h1500 v360 E0 R0 S0,3000,0,1500 n"TIFF_m c:LZW r:CROP"\n',
+    'o x1.5abc y+3. z-.25 Ra Rf1 Vm Vz2 Eev E k"" s"say \\"hi\\"" q"open\n',
+    'c n0 N1 x100.5 y200.25 X300 Y400 t0\n',
+    'k i2 j1 m1,2,3 =4 123 x\n',
+    'v\n',
+    'v \n',
+    'z\t a1\tb2   \n',
+    '#-hugin  cropFactor=1.5 autoCenterCrop=1 name="x y" odd=+.5 bare= =3\n',
+    '#-imgfile 4000 3000 "img 0.jpg" 1.5 .5 word\n',
+    '#hugin_blender enblend\n',
+    '#hugin_outputLDRBlended\n',
+    '# a comment i w1\n',
+    '\n',
+    '* everything after this is ignored\n',
+    'i w1 h1 n"after the star"\n',
+]
+
+def synthetic_line(rnd):
+    qualifiers = ['a', 'n', 'x', 'Ra', 'Vx', 'TrX', 'TpyXZ', 'Er', 'Eev', 'E', 'R', 'V', 'T']
+    values = ['0', '-12', '+7', '1.5', '-0.25', '.5', '3.', '1,2,3,4', '-1,+2,3,-4',
+              '=2', '"str"', '"two words"', '""', 'word', '1.5e3', '12abc', '=', ',']
+    fields = [rnd.choice(qualifiers) + rnd.choice(values) for k in range(rnd.randint(0, 12))]
+    return rnd.choice('pimockvz') + ''.join(rnd.choice([' ', '  ', '\t']) + f for f in fields) + '\n'
+
+def scan_signature(scan):
+    return lines_signature(scan.sequential)
+
+def lines_signature(lines):
+    sig = []
+    for line in lines:
+        members = None
+        if line.members is not None:
+            members = [(m.type, m.separator, m.text, m.value, type(m.value), m.datatype)
+                       for m in line.members]
+        sig.append((line.__class__.__name__, line.lineno, line.header, members))
+    return sig
+
+class TestFastScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertEnginesAgree(self, path):
+        slow = parse_pto.pto_scan(path)
+        fast = parse_pto.pto_scan(path, fast_scan=True)
+        self.assertEqual(scan_signature(slow), scan_signature(fast), path)
+
+    def test_sample(self):
+        self.assertEnginesAgree(write_pto(self.tmpdir, 'sample.pto'))
+
+    def test_tricky_lines(self):
+        self.assertEnginesAgree(write_pto(self.tmpdir, 'tricky.pto', ''.join(TRICKY_LINES)))
+
+    def test_synthetic_lines(self):
+        rnd = random.Random(20111226)
+        content = ''.join(synthetic_line(rnd) for k in range(2000))
+        self.assertEnginesAgree(write_pto(self.tmpdir, 'synthetic.pto', content))
+
+    def test_real_projects(self):
+        for path in glob.glob(os.path.join(app.PTO_DIR, '*.pto')):
+            self.assertEnginesAgree(path)
+
+class TestCompactScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pto_text(self, scan):
+        out = StringIO()
+        scan.pto(out)
+        return out.getvalue()
+
+    def test_round_trip_without_source(self):
+        full = parse_pto.pto_scan(self.path)
+        lean = parse_pto.pto_scan(self.path, fast_scan=True, keep_source=False)
+        self.assertEqual(self.pto_text(full), self.pto_text(lean))
+        self.assertEqual(lean.c[0].sourcecode, None)
+        self.assertEqual(lean.c[0].source(), 'c n0 N1 x100.5 y200.25 X300 Y400 t0\n')
+        # lines without members keep their text
+        self.assertEqual(lean.sequential[0].sourcecode, '# hugin project file\n')
+
+    def test_slotted_objects(self):
+        scan = parse_pto.pto_scan(self.path, keep_source=False)
+        line = scan.i[1]
+        self.assertFalse(hasattr(line, '__dict__'))
+        self.assertFalse(hasattr(line.members[0], '__dict__'))
+        self.assertTrue(scan.i[0].TrX.type is line.TrX.type)
+
+    def test_member_access_without_make_member_access(self):
+        scan = parse_pto.pto_scan(self.path, member_access=False)
+        line = scan.get_lines_like('i')[1]
+        self.assertEqual(line.n.value, 'img1.jpg')
+        self.assertEqual(line.Eev.value, 0)
+        self.assertRaises(AttributeError, getattr, line, 'Q')
+        line.n.value = 'renamed.jpg'
+        self.assertEqual(line.extract('n'), 'renamed.jpg')
+
+    def test_duplicate_members(self):
+        line = parse_pto.pto_line('c n0 N1 x1 x2 t0\n', 0, 'c')
+        # the attribute is the last one, select gives the first
+        self.assertEqual(line.x.value, 2)
+        self.assertEqual(line.extract('x'), 1)
+
+class TestLazyScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lines_are_scanned_on_use(self):
+        scan = parse_pto.pto_scan(self.path, lazy=True)
+        self.assertTrue(all(line.pending() for line in scan.c))
+        self.assertEqual(scan.i[1].v.value, 0)
+        self.assertEqual(scan.i[1].v.separator, '=')
+        self.assertFalse(scan.i[1].pending())
+        self.assertTrue(scan.i[0].pending())
+        self.assertEqual(scan.c[1].extract('X'), 10.125)
+        self.assertTrue(scan.c[0].pending())
+
+    def test_realize_group(self):
+        scan = parse_pto.pto_scan(self.path, lazy=True, keep_source=False)
+        scan.realize('c')
+        self.assertFalse(any(line.pending() for line in scan.c))
+        self.assertTrue(scan.p[0].pending())
+        self.assertEqual(scan.c[0].sourcecode, None)
+        self.assertTrue(scan.p[0].sourcecode is not None)
+
+    def test_same_as_eager_scan(self):
+        eager = parse_pto.pto_scan(self.path)
+        lazy = parse_pto.pto_scan(self.path, lazy=True, keep_source=False)
+        self.assertEqual(scan_signature(eager), scan_signature(lazy))
+        self.assertEqual([len(getattr(lazy, h)) for h in 'pmivc'],
+                         [len(getattr(eager, h)) for h in 'pmivc'])
+
+    def test_scanned_by_several_threads(self):
+        from bench.generate import write_pto as generate
+        path = generate(os.path.join(self.tmpdir, 'big.pto'), images=20, control_points=3000)
+        errors = []
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1) # switch threads as often as possible
+        try:
+            for k in range(3):
+                scan = parse_pto.pto_scan(path, fast_scan=True, lazy=True, keep_source=False)
+                def use():
+                    try:
+                        for line in scan.c:
+                            line.members
+                    except Exception as e:
+                        errors.append(e)
+                threads = [threading.Thread(target=use) for t in range(4)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        finally:
+            sys.setcheckinterval(interval)
+        self.assertEqual(errors, [])
+        self.assertEqual(scan_signature(scan), scan_signature(parse_pto.pto_scan(path)))
+
+class TestIterPto(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto', SAMPLE_PTO + ''.join(TRICKY_LINES))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_lines_as_scan(self):
+        scan = parse_pto.pto_scan(self.path)
+        lines = list(parse_pto.iter_pto(self.path))
+        self.assertEqual(scan_signature(scan), lines_signature(lines))
+        self.assertEqual([l.sourcecode for l in lines], [l.sourcecode for l in scan.sequential])
+
+    def test_header_filter(self):
+        lines = list(parse_pto.iter_pto(StringIO(SAMPLE_PTO), 'ic'))
+        self.assertEqual([l.header for l in lines], ['i', 'i', 'c', 'c'])
+        self.assertEqual(lines[1].n.value, 'img1.jpg')
+        lines = list(parse_pto.iter_pto(self.path, ['#-hugin', '*']))
+        self.assertEqual([l.header for l in lines], ['#-hugin'] * 3 + ['*'])
+
+    def test_lines_after_star_are_not_scanned(self):
+        lines = list(parse_pto.iter_pto(self.path, fast_scan=True))
+        self.assertEqual(lines[-2].header, '*')
+        self.assertEqual((lines[-1].header, lines[-1].members), ('', None))
+
+class TestControlPointArray(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto', SAMPLE_PTO +
+                              'c N2 n1 x5 y6 X7 Y8 t1\n'    # unusual field order
+                              'c n3 N4 x1 y2\n')            # missing fields
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def expected(self):
+        scan = parse_pto.pto_scan(self.path)
+        return [tuple(l.extract(f) for f in parse_pto.control_point_fields) for l in scan.c]
+
+    def test_lazy_scan(self):
+        scan = parse_pto.pto_scan(self.path, lazy=True)
+        cp = scan.control_points_array()
+        self.assertTrue(all(l.pending() for l in scan.c))
+        self.assertEqual(cp.tolist()[:3], self.expected()[:3])
+        self.assertEqual(cp[3]['n'], 3)
+        self.assertEqual((cp[3]['t'], str(cp[3]['X'])), (-1, 'nan'))
+        self.assertEqual(cp['x'].mean(), (100.5 + 1500 + 5 + 1) / 4)
+
+    def test_modified_lines_use_members(self):
+        scan = parse_pto.pto_scan(self.path, lazy=True)
+        scan.c[0].x.value = 42.0
+        self.assertEqual(scan.control_points_array()['x'][0], 42.0)
+
+    def test_read_from_file(self):
+        cols = parse_pto.read_control_points(self.path, columns=True)
+        self.assertEqual(sorted(cols), sorted(parse_pto.control_point_fields))
+        self.assertTrue(cols['Y'].flags['C_CONTIGUOUS'])
+        self.assertEqual(cols['N'].tolist(), [1, 1, 2, 4])
+        self.assertEqual(parse_pto.pto_scan(self.path).control_points_array().tolist()[:3],
+                         self.expected()[:3])
+
+class TestImageTable(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_back_references_resolved(self):
+        images = parse_pto.pto_scan(self.path, lazy=True).images()
+        self.assertEqual(len(images), 2)
+        self.assertEqual(images['v'], [50, 50])
+        self.assertEqual(images.backrefs['v'], [None, 0])
+        self.assertEqual(images['b'], [-0.01, -0.01])
+        self.assertEqual(images['y'], [0, 45.5])
+        self.assertEqual(images.row(1)['n'], 'img1.jpg')
+        self.assertEqual(images.get(0, 'Q', 'none'), 'none')
+        self.assertEqual(images.array('p').tolist(), [0.0, -2.25])
+
+    def test_chained_and_dangling_references(self):
+        lines = [parse_pto.pto_line(l, k, 'i', fast=True) for k, l in enumerate(
+                 ['i v=1 a=5\n', 'i v=2\n', 'i v70\n'])]
+        images = parse_pto.image_table(lines)
+        self.assertEqual(images['v'], [70, 70, 70])
+        self.assertEqual(images['a'], [None, None, None])
+
+    def test_select_index_follows_changes(self):
+        line = parse_pto.pto_scan(self.path).i[0]
+        self.assertEqual(line.select('n').value, 'img0.jpg')
+        line.members.append(parse_pto.pto_member('Q', '', '1', 1, 'i'))
+        self.assertEqual(line.extract('Q'), 1)
+
+    def test_load_sends_resolved_view(self):
+        self.serve(self.tmpdir)
+        data = json.loads(app.app.request('/load/sample.pto').data)
+        self.assertEqual([d['view'] for d in data], [50, 50])
+        self.assertEqual(data[1]['name'], 'img1.jpg')
+
+class TestSidecar(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        made = parse_pto.pto_scan(self.path, lazy=True, sidecar=True)
+        self.assertTrue(os.path.exists(parse_pto.sidecar_path(self.path)))
+        restored = parse_pto.pto_scan(self.path, sidecar=True)
+        self.assertTrue(restored.c[0].pending())
+        self.assertEqual(restored.images()['v'], [50, 50])
+        self.assertEqual(restored.control_points_array().tolist(),
+                         made.control_points_array().tolist())
+        self.assertEqual(scan_signature(restored), scan_signature(parse_pto.pto_scan(self.path)))
+        self.assertEqual([l.sourcecode for l in restored.sequential],
+                         [l.sourcecode for l in made.sequential])
+
+    def test_dropped_source_stays_dropped(self):
+        parse_pto.pto_scan(self.path, lazy=True, keep_source=False, sidecar=True)
+        restored = parse_pto.pto_scan(self.path, keep_source=False, sidecar=True)
+        self.assertEqual(restored.i[0].sourcecode, None)
+        self.assertEqual(restored.i[0].n.value, 'img0.jpg')
+        # a scan with other options doesn't use that sidecar
+        self.assertEqual(parse_pto.pto_scan(self.path, sidecar=True).i[0].sourcecode[:2], 'i ')
+
+    def test_invalidation(self):
+        parse_pto.pto_scan(self.path, sidecar=True)
+        # same content, new mtime: the digest still matches
+        stamp = os.stat(self.path).st_mtime
+        os.utime(self.path, (stamp + 10, stamp + 10))
+        self.assertTrue(parse_pto.pto_scan(self.path, sidecar=True).c[0].pending())
+        # and the sidecar takes the new mtime, so the file isn't hashed again
+        digests = []
+        saved = parse_pto._source_digest
+        parse_pto._source_digest = lambda filename: digests.append(filename) or saved(filename)
+        try:
+            self.assertTrue(parse_pto.pto_scan(self.path, sidecar=True).c[0].pending())
+        finally:
+            parse_pto._source_digest = saved
+        self.assertEqual(digests, [])
+        write_pto(self.tmpdir, 'sample.pto', SAMPLE_PTO + 'c n1 N0 x1 y2 X3 Y4 t0\n')
+        scan = parse_pto.pto_scan(self.path, sidecar=True)
+        self.assertEqual(len(scan.c), 3)
+        self.assertFalse(scan.c[0].pending())
+        self.assertEqual(len(parse_pto.pto_scan(self.path, sidecar=True).control_points_array()), 3)
+
+    def test_damaged(self):
+        parse_pto.pto_scan(self.path, sidecar=True)
+        sidecar = parse_pto.sidecar_path(self.path)
+        with open(sidecar, 'rb') as f:
+            data = f.read()
+        # cut short, garbled, or from another python: the file is scanned
+        for damaged in (data[:80], data[:64] + 'x' * (len(data) - 64),
+                        data[:60] + '\x02\x06' + data[62:]):
+            with open(sidecar, 'wb') as f:
+                f.write(damaged)
+            scan = parse_pto.pto_scan(self.path, sidecar=True)
+            self.assertEqual(scan_signature(scan), scan_signature(parse_pto.pto_scan(self.path)))
+            self.assertFalse(scan.c[0].pending())
+        # and the sidecar is written again
+        self.assertTrue(parse_pto.pto_scan(self.path, sidecar=True).c[0].pending())
+
+    def test_unwritable_directory_is_ignored(self):
+        os.mkdir(os.path.join(self.tmpdir, '.ptocache'))
+        os.chmod(os.path.join(self.tmpdir, '.ptocache'), 0o500)
+        try:
+            scan = parse_pto.pto_scan(self.path, sidecar=True)
+        finally:
+            os.chmod(os.path.join(self.tmpdir, '.ptocache'), 0o700)
+        self.assertEqual(len(scan.i), 2)
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_inline(self):
+        pool = worker_pool(0, 0)
+        self.assertEqual(pool.map(abs, [-1, -2]), [1, 2])
+        self.assertRaises(ZeroDivisionError, pool.submit(divmod, 1, 0).get)
+
+    def test_queue_depth(self):
+        pool = worker_pool(1, 1)
+        gate = threading.Event()
+        try:
+            first = pool.submit(gate.wait, 5)
+            second = pool.submit(abs, -2)
+            self.assertRaises(pool_full, pool.submit, abs, -3)
+            gate.set()
+            first.get(5)
+            self.assertEqual(second.get(5), 2)
+            self.assertEqual(pool.submit(abs, -4).get(5), 4)
+        finally:
+            gate.set()
+            pool.close()
+
+    def test_processes(self):
+        pool = worker_pool(2, 2, processes=True)
+        try:
+            self.assertNotEqual(pool.submit(os.getpid).get(10), os.getpid())
+        finally:
+            pool.close()
+
+class TestLoadMany(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.project_dir()
+        write_pto(self.tmpdir, 'b.pto', SAMPLE_PTO.replace('img1.jpg', 'other.jpg'))
+        self.serve(self.tmpdir)
+        self.saved = app.parse_pool
+        app.parse_pool = worker_pool(2, 4)
+
+    def tearDown(self):
+        app.parse_pool.close()
+        app.parse_pool = self.saved
+
+    def test_load_many(self):
+        response = app.app.request('/load_many?files=a.pto,b.pto')
+        data = json.loads(response.data)
+        self.assertEqual(sorted(data), ['a.pto', 'b.pto'])
+        self.assertEqual(data['b.pto'][1]['name'], 'other.jpg')
+        single = app.app.request('/load/a.pto')
+        self.assertEqual(json.loads(single.data), data['a.pto'])
+
+    def test_process_pool(self):
+        app.parse_pool.close()
+        app.parse_pool = worker_pool(2, 4, processes=True)
+        data = json.loads(app.app.request('/load_many?files=a.pto,b.pto').data)
+        # the documents are cached here, the pool isn't asked again
+        app.parse_pool.submit = lambda *args: (_ for _ in ()).throw(pool_full())
+        again = app.app.request('/load_many?files=b.pto,a.pto')
+        self.assertTrue(again.status.startswith('200'))
+        self.assertEqual(json.loads(again.data), data)
+
+    def test_full_queue_is_503(self):
+        app.parse_pool = worker_pool(0, 0)
+        app.parse_pool.submit = lambda *args: (_ for _ in ()).throw(pool_full())
+        response = app.app.request('/load/a.pto')
+        self.assertTrue(response.status.startswith('503'))
+
+class TestConditionalGet(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.project_dir()
+        self.path = os.path.join(self.tmpdir, 'a.pto')
+        self.serve(self.tmpdir)
+
+    def test_etag(self):
+        first = app.app.request('/load/a.pto')
+        etag = first.headers['ETag']
+        again = app.app.request('/load/a.pto', headers={'If-None-Match': etag})
+        self.assertTrue(again.status.startswith('304'))
+        self.assertEqual(again.data, '')
+        self.assertEqual(again.headers['ETag'], etag)
+        write_pto(self.tmpdir, 'a.pto', SAMPLE_PTO + '\n')
+        changed = app.app.request('/load/a.pto', headers={'If-None-Match': etag})
+        self.assertTrue(changed.status.startswith('200'))
+        self.assertEqual(json.loads(changed.data), json.loads(first.data))
+
+    def test_last_modified(self):
+        first = app.app.request('/load/a.pto')
+        since = first.headers['Last-Modified']
+        again = app.app.request('/load/a.pto', headers={'If-Modified-Since': since})
+        self.assertTrue(again.status.startswith('304'))
+        os.utime(self.path, (os.stat(self.path).st_atime, os.stat(self.path).st_mtime + 10))
+        later = app.app.request('/load/a.pto', headers={'If-Modified-Since': since})
+        self.assertTrue(later.status.startswith('200'))
+
+    def test_list(self):
+        first = app.app.request('/list')
+        self.assertEqual(json.loads(first.data), ['a.pto'])
+        again = app.app.request('/list', headers={'If-None-Match': first.headers['ETag']})
+        self.assertTrue(again.status.startswith('304'))
+        write_pto(self.tmpdir, 'b.pto')
+        changed = app.app.request('/list', headers={'If-None-Match': first.headers['ETag']})
+        self.assertEqual(sorted(json.loads(changed.data)), ['a.pto', 'b.pto'])
+
+    def test_compression(self):
+        plain = app.app.request('/load_many?files=a.pto')
+        zipped = app.app.request('/load_many?files=a.pto',
+                                 headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(zipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(zipped.data, 31), plain.data)
+        self.assertNotEqual(zipped.headers['ETag'], plain.headers['ETag'])
+        deflated = app.app.request('/load_many?files=a.pto',
+                                   headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertEqual(deflated.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(deflated.data), plain.data)
+        again = app.app.request('/load_many?files=a.pto',
+                                headers={'Accept-Encoding': 'gzip',
+                                         'If-None-Match': zipped.headers['ETag']})
+        self.assertTrue(again.status.startswith('304'))
+
+def write_jpeg(directory, name, size):
+    from PIL import Image
+    path = os.path.join(directory, name)
+    Image.new('RGB', size, (200, 100, 50)).save(path)
+    return path
+
+@unittest.skipIf(pyramid.Image is None, "needs Pillow")
+class TestPyramid(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = write_jpeg(self.tmpdir, 'img0.jpg', (1500, 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_levels(self):
+        manifest = pyramid.build_pyramid(self.tmpdir, 'img0.jpg', tiles=True)
+        self.assertEqual([(l['size'], l['width'], l['height']) for l in manifest['levels']],
+                         [(256, 256, 171), (512, 512, 341), (1024, 1024, 683),
+                          (1500, 1500, 1000)])
+        directory = pyramid.pyramid_dir(self.tmpdir, 'img0.jpg')
+        files = os.listdir(directory)
+        self.assertTrue('1500_5_3.jpg' in files)
+        self.assertFalse('256_0_0.jpg' in files)
+        self.assertEqual(pyramid.level_path(self.tmpdir, 'img0.jpg', manifest, 300),
+                         os.path.join(directory, '512.jpg'))
+        self.assertEqual(pyramid.level_path(self.tmpdir, 'img0.jpg', manifest, 2048),
+                         os.path.join(directory, '1500.jpg'))
+
+    def test_rebuilt_when_stale(self):
+        pyramid.build_pyramid(self.tmpdir, 'sub/dir/img0.jpg')
+        self.assertTrue(pyramid.current_manifest(self.tmpdir, 'img0.jpg') is not None)
+        write_jpeg(self.tmpdir, 'img0.jpg', (300, 200))
+        self.assertTrue(pyramid.current_manifest(self.tmpdir, 'img0.jpg') is None)
+        results = pyramid.build_pyramids(self.tmpdir, ['img0.jpg', 'missing.jpg'], workers=2)
+        self.assertEqual([l['size'] for l in results[0][1]['levels']], [256, 300])
+        self.assertTrue(isinstance(results[1][1], EnvironmentError))
+        # the old pyramid was moved aside, then removed
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, '.pyramid')), ['img0.jpg'])
+        self.assertRaises(ValueError, pyramid.image_key, '../')
+
+    def test_lod_urls(self):
+        self.assertEqual(len(pyramid.lod_urls('img0.jpg')), len(pyramid.LEVEL_SIZES))
+        # no bigger levels than the image has
+        self.assertEqual(pyramid.lod_urls('sub/img0.jpg', largest=300),
+                         ['/pyramid/img0.jpg/256.jpg', '/pyramid/img0.jpg/300.jpg'])
+
+    def test_served(self):
+        from PIL import Image
+        pto_dir = os.path.join(self.tmpdir, 'pto')
+        os.mkdir(pto_dir)
+        write_pto(pto_dir, 'a.pto', SAMPLE_PTO.replace('img1.jpg', 'img0.jpg'))
+        self.serve(pto_dir, self.tmpdir)
+        data = json.loads(app.app.request('/load/a.pto').data)
+        self.assertEqual(data[1]['lod'][0], '/pyramid/img0.jpg/256.jpg')
+        response = app.app.request(data[1]['lod'][1])
+        self.assertEqual(response.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(Image.open(StringIO(response.data)).size, (512, 341))
+        again = app.app.request(data[1]['lod'][1],
+                                headers={'If-None-Match': response.headers['ETag']})
+        self.assertTrue(again.status.startswith('304'))
+        self.assertTrue(app.app.request('/pyramid/nope.jpg/256.jpg').status.startswith('404'))
+
+def quaternion_matrix(q):
+    # three.js's Matrix4.setRotationFromQuaternion
+    x, y, z, w = q
+    return [[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+            [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+            [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]]
+
+class TestGeometry(ServingMixin, unittest.TestCase):
+
+    def test_matches_renderer(self):
+        import math
+        rnd = random.Random(12)
+        angles = [(rnd.uniform(-180, 180), rnd.uniform(-90, 90), rnd.uniform(-30, 30),
+                   rnd.uniform(10, 120)) for k in range(20)]
+        result = geometry.placement(*zip(*angles))
+        for k, (yaw, pitch, roll, view) in enumerate(angles):
+            # addImage() in renderer.js
+            distance = 400 / math.cos((180 - view) / 2 * math.pi / 180)
+            phi = (90 - pitch) * math.pi / 180
+            theta = yaw * math.pi / 180
+            position = [distance * math.sin(phi) * math.cos(theta),
+                        distance * math.cos(phi),
+                        distance * math.sin(phi) * math.sin(theta)]
+            rotation = [pitch * math.pi / 180, 90 - yaw * math.pi / 180, roll * math.pi / 180]
+            self.assertAlmostEqual(result['distance'][k], distance)
+            for a, b in zip(result['position'][k], position):
+                self.assertAlmostEqual(a, b)
+            for a, b in zip(result['rotation'][k], rotation):
+                self.assertAlmostEqual(a, b)
+            expected = geometry.euler_matrix(rotation)
+            got = quaternion_matrix(result['quaternion'][k])
+            for i in range(3):
+                for j in range(3):
+                    self.assertAlmostEqual(got[i][j], expected[i][j])
+
+    def test_load_transforms(self):
+        self.serve(self.project_dir(SAMPLE_PTO.replace('v=0 ', '', 1)))
+        plain = json.loads(app.app.request('/load/a.pto').data)
+        placed = json.loads(app.app.request('/load/a.pto?transforms=1').data)
+        self.assertFalse('transform' in plain[0])
+        self.assertEqual(len(placed[0]['transform']['position']), 3)
+        self.assertEqual(len(placed[0]['transform']['quaternion']), 4)
+        # the second image has no v of its own any more
+        self.assertEqual(placed[1]['transform'], None)
+
+class TestCatalog(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        write_pto(self.tmpdir, 'b.pto')
+        write_pto(self.tmpdir, 'a.pto', SAMPLE_PTO + 'c n0 N1 x1 y1 X1 Y1 t0\n')
+        write_pto(self.tmpdir, 'notes.txt', 'not a project')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_summarize(self):
+        entry = catalog.summarize(os.path.join(self.tmpdir, 'a.pto'))
+        self.assertEqual((entry['images'], entry['control_points']), (2, 3))
+        self.assertEqual((entry['width'], entry['height'], entry['fov']), (3000, 1500, 360))
+        self.assertEqual(entry['projection'], 'equirectangular')
+        self.assertEqual(entry['size'], len(SAMPLE_PTO) + 23)
+
+    def test_listing(self):
+        projects = catalog.project_catalog(self.tmpdir, interval=0)
+        page, total = projects.listing()
+        self.assertEqual(([e['name'] for e in page], total), (['a.pto', 'b.pto'], 2))
+        page, total = projects.listing('control_points', reverse=True, limit=1)
+        self.assertEqual(([e['name'] for e in page], total), (['a.pto'], 2))
+        page, total = projects.listing('size', offset=1)
+        self.assertEqual([e['name'] for e in page], ['a.pto'])
+        self.assertRaises(ValueError, projects.listing, 'colour')
+
+    def test_changes(self):
+        projects = catalog.project_catalog(self.tmpdir, interval=0)
+        self.assertEqual(len(projects), 2)
+        version, signature = projects.version, projects.signature
+        projects.update()
+        self.assertEqual((projects.version, projects.signature), (version, signature))
+        write_pto(self.tmpdir, 'b.pto', SAMPLE_PTO.replace('img1.jpg', 'image1.jpg'))
+        self.assertEqual(projects.get('b.pto')['size'], len(SAMPLE_PTO) + 2)
+        self.assertNotEqual(projects.signature, signature)
+        os.remove(os.path.join(self.tmpdir, 'a.pto'))
+        write_pto(self.tmpdir, 'C.PTO')
+        self.assertEqual([e['name'] for e in projects.listing()[0]], ['C.PTO', 'b.pto'])
+        # changes are only looked for once the interval has passed
+        slow = catalog.project_catalog(self.tmpdir, interval=3600)
+        self.assertEqual(len(slow), 2)
+        write_pto(self.tmpdir, 'd.pto')
+        self.assertEqual(len(slow), 2)
+        slow.update(force=True)
+        self.assertEqual(len(slow), 3)
+
+    def test_list(self):
+        self.serve(self.tmpdir)
+        names = app.app.request('/list')
+        details = app.app.request('/list?details=1&sort=images&order=desc&limit=1')
+        bad = app.app.request('/list?sort=colour')
+        self.assertEqual(json.loads(names.data), ['a.pto', 'b.pto'])
+        self.assertEqual(details.headers['X-Total-Count'], '2')
+        self.assertEqual([e['name'] for e in json.loads(details.data)], ['b.pto'])
+        self.assertNotEqual(details.headers['ETag'], names.headers['ETag'])
+        self.assertTrue(bad.status.startswith('400'))
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'sample.pto')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def edit(self, content):
+        write_pto(self.tmpdir, 'sample.pto', content)
+
+    def check(self, **options):
+        scan = parse_pto.pto_scan(self.path, **options)
+        i_lines, c_lines = scan.i, scan.c
+        first_i = scan.i[0]
+        self.assertEqual(scan.images().column('y'), [0, 45.5])
+        edited = SAMPLE_PTO.replace('y45.5', 'y46').replace(
+            '# hugin project file\n', '') + 'c n1 N0 x5 y6 X7 Y8 t0\n'
+        self.edit(edited)
+        changes = scan.refresh()
+        self.assertEqual(len(changes.removed), 2)
+        self.assertEqual(len(changes.added), 2)
+        self.assertEqual(changes.headers, set(['#', 'i', 'c']))
+        self.assertTrue(scan.i is i_lines and scan.c is c_lines)
+        self.assertTrue(scan.i[0] is first_i)
+        self.assertEqual(len(scan.c), 3)
+        self.assertEqual(scan.images().column('y'), [0, 46])
+        fresh = parse_pto.pto_scan(self.path, **options)
+        scan.realize()
+        fresh.realize()
+        self.assertEqual(scan_signature(scan), scan_signature(fresh))
+        self.assertFalse(scan.refresh())
+
+    def test_refresh(self):
+        self.assertTrue(SAMPLE_PTO.startswith('# hugin project file\n'))
+        self.check()
+
+    def test_refresh_without_source(self):
+        self.check(fast_scan=True, keep_source=False)
+
+    def test_refresh_lazy(self):
+        self.check(fast_scan=True, keep_source=False, lazy=True)
+
+    def test_refresh_from_sidecar(self):
+        # the scan comes from the sidecar, which has the line hashes
+        parse_pto.pto_scan(self.path, fast_scan=True, keep_source=False, lazy=True, sidecar=True)
+        self.check(fast_scan=True, keep_source=False, lazy=True, sidecar=True)
+        # a mapped scan's sidecar has them, too
+        parse_pto.pto_scan(self.path, mapped=True, keep_source=False, sidecar=True)
+        scan = parse_pto.pto_scan(self.path, mapped=True, keep_source=False, sidecar=True)
+        self.assertEqual(len(scan._line_hashes), len(scan.sequential))
+
+    def test_modified_lines_are_kept(self):
+        scan = parse_pto.pto_scan(self.path, fast_scan=True, keep_source=False)
+        scan.i[0].y.value = 12.5
+        self.edit(SAMPLE_PTO.replace('y45.5', 'y46'))
+        changes = scan.refresh()
+        self.assertEqual(len(changes.added), 1)
+        self.assertEqual(scan.images(True).column('y'), [12.5, 46])
+
+    def test_star(self):
+        scan = parse_pto.pto_scan(self.path)
+        self.edit(SAMPLE_PTO.replace('\nv', '\n*\nv', 1))
+        changes = scan.refresh()
+        self.assertEqual(len(changes.removed), len(SAMPLE_PTO.splitlines()))
+        self.assertEqual(scan.lines_with_header('v'), [])
+        self.assertEqual(scan_signature(scan), scan_signature(parse_pto.pto_scan(self.path)))
+
+def numeric_line(rnd):
+    values = []
+    for k in range(rnd.randint(1, 8)):
+        x = rnd.choice([rnd.uniform(-5000, 5000), rnd.uniform(-1, 1) * 10 ** rnd.randint(-7, 8),
+                        rnd.randint(-3, 3), 0.0])
+        text = rnd.choice(['%d', '%.1f', '%.2f', '%.6f', '%.9f', '%s', '%r', '%g',
+                           '%+d', '%03d']) % x
+        values.append(rnd.choice(['x', 'y', 'Ra', 'TrX', 'Eev', 'v=']) + text)
+    return rnd.choice('ci') + ' ' + ' '.join(values) + rnd.choice(['\n', '\n', ' \n'])
+
+class TestWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rnd = random.Random(42)
+        content = (SAMPLE_PTO + ''.join(synthetic_line(rnd) for k in range(300)) +
+                   ''.join(numeric_line(rnd) for k in range(300)) + ''.join(TRICKY_LINES))
+        self.path = write_pto(self.tmpdir, 'mixed.pto', content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def line_by_line(self, scan):
+        out = StringIO()
+        for line in scan.sequential:
+            line.pto(out)
+        return out.getvalue()
+
+    def test_same_as_line_writer(self):
+        for options in [{}, {'fast_scan': True, 'keep_source': False},
+                        {'fast_scan': True, 'lazy': True},
+                        {'fast_scan': True, 'lazy': True, 'keep_source': False}]:
+            expected = self.line_by_line(parse_pto.pto_scan(self.path, **options))
+            scan = parse_pto.pto_scan(self.path, **options)
+            self.assertEqual(scan.pto_text(), expected)
+            out = StringIO()
+            parse_pto.pto_scan(self.path, **options).pto(out, with_aux=False)
+            self.assertEqual(out.getvalue(), self.line_by_line_without_aux(options))
+
+    def line_by_line_without_aux(self, options):
+        out = StringIO()
+        for line in parse_pto.pto_scan(self.path, **options).sequential:
+            line.pto(out, False)
+        return out.getvalue()
+
+    def test_modified_lines(self):
+        scan = parse_pto.pto_scan(self.path, fast_scan=True, lazy=True)
+        scan.i[0].y.value = 12.5
+        self.assertTrue('y12.5 ' in scan.pto_text().splitlines()[7])
+
+    def test_canonical_lines(self):
+        rnd = random.Random(7)
+        accepted = 0
+        for k in range(3000):
+            line = numeric_line(rnd)
+            if parse_pto.canonical_line_re.match(line, 1):
+                accepted += 1
+                scanned = parse_pto.pto_line(line, 0, line[0], fast=True)
+                self.assertEqual(str(scanned) + '\n', line)
+        self.assertTrue(100 < accepted < 2900)
+        for line in SAMPLE_PTO.splitlines(True):
+            if line.startswith('c '):
+                self.assertTrue(parse_pto.canonical_line_re.match(line, 1))
+
+class TestBench(unittest.TestCase):
+
+    def test_generated_project(self):
+        from bench.generate import generate_pto
+        text = generate_pto(images=12, control_points=300, seed=3)
+        self.assertEqual(text, generate_pto(images=12, control_points=300, seed=3))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        scan = parse_pto.pto_scan(write_pto(tmpdir, 'generated.pto', text))
+        self.assertEqual(len(scan.i), 12)
+        self.assertEqual(len(scan.c), 300)
+        self.assertEqual(len(scan.k), 1)
+        self.assertEqual(scan.i[0].v.value, 50.0)
+        # hugin's double spaces don't survive a rewrite, the lines do
+        self.assertEqual(scan.pto_text().split(), text.split())
+
+    def test_results(self):
+        from bench.run import run_benchmarks
+        document = run_benchmarks(images=4, control_points=50, repeat=2, only='^scan$|load_304')
+        self.assertEqual([r['name'] for r in document['results']], ['scan', 'load_304'])
+        for result in document['results']:
+            self.assertEqual(len(result['times']), 2)
+            self.assertTrue(result['min'] <= result['median'])
+        self.assertEqual(document['params']['control_points'], 50)
+
+    def test_failed(self):
+        from bench import run
+        run.BENCHMARKS.extend([('exits', lambda: os._exit(3)),
+                               ('hangs', lambda: threading.Event().wait(60))])
+        try:
+            exited = run.run_benchmark('exits', '', 1)
+            hung = run.run_benchmark('hangs', '', 1, timeout=0.5)
+        finally:
+            del run.BENCHMARKS[-2:]
+        self.assertEqual(exited['error'], 'process exited with code 3')
+        self.assertEqual(hung['error'], 'timed out after 0.5s')
+
+class TestMetrics(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'a.pto')
+        self.reports = []
+        parse_pto.scan_observer = lambda *report: self.reports.append(report)
+
+    def tearDown(self):
+        parse_pto.scan_observer = None
+        shutil.rmtree(self.tmpdir)
+
+    def test_observed_scan(self):
+        for options in ({}, {'fast_scan': True, 'lazy': True, 'keep_source': False}):
+            observed = parse_pto.pto_scan(self.path, **options)
+            parse_pto.scan_observer = None
+            plain = parse_pto.pto_scan(self.path, **options)
+            parse_pto.scan_observer = lambda *report: self.reports.append(report)
+            self.assertEqual(scan_signature(observed), scan_signature(plain))
+        event, phases, counts = self.reports[0]
+        self.assertEqual(event, 'scan')
+        self.assertEqual(set(phases), set(['scan', 'member_access']))
+        self.assertEqual(counts['bytes'], len(SAMPLE_PTO))
+        self.assertEqual(counts['lines']['c'], len(plain.c))
+        self.assertEqual(counts['lines']['i'], len(plain.i))
+        self.assertEqual(counts['members'], sum(len(line.members) for line in plain.sequential
+                                                if line.members))
+        # the lazy scan's members are reported when they're scanned
+        self.assertTrue(self.reports[1][2]['members'] < counts['members'])
+        lazy = parse_pto.pto_scan(self.path, fast_scan=True, lazy=True)
+        lazy.realize('c')
+        event, phases, counts = self.reports[-1]
+        self.assertEqual((event, list(phases)), ('realize', ['scan']))
+        self.assertEqual(counts['lines'], {'c': len(plain.c)})
+
+    def test_sidecar_scan(self):
+        parse_pto.pto_scan(self.path, sidecar=True)
+        parse_pto.pto_scan(self.path, sidecar=True)
+        self.assertEqual([report[0] for report in self.reports], ['scan', 'sidecar'])
+        self.assertTrue('sidecar_write' in self.reports[0][1])
+        self.assertTrue('sidecar_read' in self.reports[1][1])
+
+    def test_render(self):
+        stats = metrics.registry('test_')
+        forwarded = []
+        stats.add_callback(lambda *value: forwarded.append(value))
+        stats.describe('requests_total', 'counter', 'Requests "served"')
+        stats.inc('requests_total', handler='load')
+        stats.inc('requests_total', 2, handler='load')
+        for seconds in (0.001, 0.003, 20):
+            stats.observe('seconds', seconds, phase='a\nb"')
+        self.assertEqual(stats.value('requests_total', handler='load'), 3)
+        self.assertEqual(len(forwarded), 5)
+        self.assertEqual(forwarded[0], ('counter', 'requests_total', 1, {'handler': 'load'}))
+        text = stats.render()
+        self.assertTrue('# HELP test_requests_total Requests "served"\n' in text)
+        self.assertTrue('test_requests_total{handler="load"} 3\n' in text)
+        self.assertTrue('test_seconds_bucket{phase="a\\nb\\"",le="0.001"} 1\n' in text)
+        self.assertTrue('test_seconds_bucket{phase="a\\nb\\"",le="0.005"} 2\n' in text)
+        self.assertTrue('test_seconds_bucket{phase="a\\nb\\"",le="+Inf"} 3\n' in text)
+        self.assertTrue('test_seconds_count{phase="a\\nb\\""} 3\n' in text)
+        self.assertRaises(ValueError, stats.observe, 'requests_total', 1)
+        stats.enabled = False
+        stats.inc('requests_total', handler='load')
+        self.assertEqual(stats.value('requests_total', handler='load'), 3)
+
+    def test_endpoint(self):
+        self.serve(self.tmpdir)
+        app.enable_metrics()
+        self.addCleanup(app.enable_metrics, False)
+        app.stats.clear()
+        app.app.request('/load/a.pto')
+        app.app.request('/list?sort=colour')
+        response = app.app.request('/metrics')
+        self.assertTrue(response.status.startswith('200'))
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+        text = response.data
+        self.assertTrue('webglpto_http_request_seconds_count{handler="load",status="200"} 1\n'
+                        in text)
+        self.assertTrue('webglpto_http_request_seconds_count{handler="list",status="400"} 1\n'
+                        in text)
+        self.assertTrue('webglpto_load_phase_seconds_count{phase="json"} 1\n' in text)
+        self.assertTrue('webglpto_pto_scans_total{event="scan"} 1\n' in text)
+        self.assertTrue('webglpto_pto_scan_lines_total{header="i"} 2\n' in text)
+        self.assertTrue('webglpto_pto_scan_bytes_total %d\n' % len(SAMPLE_PTO) in text)
+        self.assertTrue('webglpto_pto_scan_phase_seconds_count{phase="scan"} 1\n' in text)
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, 'archive'))
+        for name in ('b.pto', 'a.pto', 'notes.txt'):
+            write_pto(os.path.join(self.tmpdir, 'archive'), name)
+        self.single = write_pto(self.tmpdir, 'single.pto', 'i w1 n"x.jpg"\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_batch(self, inputs, workers):
+        out = StringIO()
+        failed = parse_pto.run_batch(inputs, workers, out)
+        return failed, [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_batch(self):
+        inputs = [os.path.join(self.tmpdir, 'archive'), self.single,
+                  os.path.join(self.tmpdir, 'missing.pto'),
+                  os.path.join(self.tmpdir, 'arch*', '*.pto')]
+        failed, records = self.run_batch(inputs, 2)
+        self.assertEqual(failed, 1)
+        self.assertEqual([os.path.basename(r['file']) for r in records],
+                         ['a.pto', 'b.pto', 'single.pto', 'missing.pto', 'a.pto', 'b.pto'])
+        scan = parse_pto.pto_scan(os.path.join(self.tmpdir, 'archive', 'a.pto'))
+        first = records[0]
+        self.assertEqual(first['status'], 'ok')
+        self.assertEqual(first['lines'], len(scan.sequential))
+        self.assertEqual(first['images'], len(scan.i))
+        self.assertEqual(first['control_points'], len(scan.c))
+        self.assertEqual(records[2]['images'], 1)
+        self.assertEqual(records[3]['status'], 'error')
+        self.assertTrue(records[3]['error'].startswith('IOError'))
+        # in this process, the same records
+        for record in records:
+            del record['seconds']
+        failed, serial = self.run_batch(inputs, 1)
+        for record in serial:
+            del record['seconds']
+        self.assertEqual((failed, serial), (1, records))
+
+    def test_main(self):
+        out = StringIO()
+        saved, sys.stdout = sys.stdout, out
+        try:
+            status = parse_pto.main(['-j', '1', self.single])
+        finally:
+            sys.stdout = saved
+        self.assertEqual(status, 0)
+        self.assertEqual(json.loads(out.getvalue())['status'], 'ok')
+
+class TestPayload(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.project_dir()
+        self.serve(self.tmpdir)
+
+    def test_fields(self):
+        data = json.loads(app.app.request('/load/a.pto?fields=name,width,distortion,crop,view').data)
+        self.assertEqual(data[1], {'name': 'img1.jpg', 'width': 4000, 'view': 50,
+                                   'distortion': [0, -0.01, 0], 'crop': None})
+        default = json.loads(app.app.request('/load/a.pto').data)
+        self.assertEqual(sorted(default[0]), sorted(payload.DEFAULT_FIELDS))
+        self.assertEqual(payload.parse_fields('yaw,name,yaw', True),
+                         ('yaw', 'name', 'transform'))
+        for query in ('fields=name,colour', 'format=xml'):
+            self.assertTrue(app.app.request('/load/a.pto?' + query).status.startswith('400'))
+
+    def test_columnar(self):
+        records = json.loads(app.app.request('/load/a.pto?transforms=1').data)
+        columns = json.loads(app.app.request('/load/a.pto?format=columnar&transforms=1').data)
+        self.assertEqual(sorted(columns), sorted(payload.DEFAULT_FIELDS + ('transform',)))
+        for field, column in columns.items():
+            self.assertEqual(column, [record[field] for record in records])
+        many = json.loads(app.app.request('/load_many?files=a.pto&format=columnar&fields=yaw').data)
+        self.assertEqual(many, {'a.pto': {'yaw': [0, 45.5]}})
+
+    def test_streaming(self):
+        for data in ([{'x': 'y' * 50}] * 100, dict((str(k), [k]) for k in range(100))):
+            chunks = list(payload.iter_json(data, chunk=100))
+            self.assertTrue(len(chunks) > 5)
+            self.assertEqual(''.join(chunks), json.dumps(data))
+        for value in ([], {}, [1], 'x', 3.5):
+            self.assertEqual(''.join(payload.iter_json(value)), json.dumps(value))
+        saved = payload.CHUNK_SIZE
+        payload.CHUNK_SIZE = 64
+        try:
+            plain = app.app.request('/load/a.pto').data
+            app.load_cache.clear()
+            app.encoded_cache.clear()
+            zipped = app.app.request('/load/a.pto', headers={'Accept-Encoding': 'gzip'})
+        finally:
+            payload.CHUNK_SIZE = saved
+        self.assertEqual(zlib.decompress(zipped.data, 31), plain)
+        # what was streamed is cached whole
+        again = app.app.request('/load/a.pto', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(again.data, zipped.data)
+
+class TestControlPointIndex(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        from bench.generate import generate_pto
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = write_pto(self.tmpdir, 'a.pto',
+                              generate_pto(images=6, control_points=2000, seed=5,
+                                           width=1000, height=800))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_queries(self):
+        scan = parse_pto.pto_scan(self.path, fast_scan=True, lazy=True)
+        index = scan.control_point_index(cell=50)
+        c = scan.control_points_array(columns=True)
+        def brute(image, test):
+            return numpy.flatnonzero(((c['n'] == image) & test(c['x'], c['y'])) |
+                                     ((c['N'] == image) & test(c['X'], c['Y'])))
+        rnd = random.Random(3)
+        for k in range(100):
+            image = rnd.randrange(7)
+            x, y, r = rnd.uniform(-50, 1050), rnd.uniform(-50, 850), rnd.uniform(0, 300)
+            self.assertEqual(index.near(image, x, y, r).tolist(), brute(
+                image, lambda X, Y: (X - x) ** 2 + (Y - y) ** 2 <= r * r).tolist())
+            x0, x1 = sorted([rnd.uniform(-50, 1050), rnd.uniform(-50, 1050)])
+            y0, y1 = sorted([rnd.uniform(-50, 850), rnd.uniform(-50, 850)])
+            self.assertEqual(index.within(image, x0, y0, x1, y1).tolist(), brute(
+                image, lambda X, Y: (X >= x0) & (X <= x1) & (Y >= y0) & (Y <= y1)).tolist())
+            other = rnd.randrange(7)
+            self.assertEqual(index.between(image, other).tolist(), numpy.flatnonzero(
+                ((c['n'] == image) & (c['N'] == other)) |
+                ((c['n'] == other) & (c['N'] == image))).tolist())
+        self.assertEqual(index.of_image(2).tolist(),
+                         numpy.flatnonzero((c['n'] == 2) | (c['N'] == 2)).tolist())
+        self.assertTrue(scan.control_point_index(cell=50) is index)
+        scan.c[0].x.value = 1e6
+        moved = scan.control_point_index(cell=50, refresh=True)
+        self.assertFalse(moved is index)
+        self.assertEqual(moved.near(scan.c[0].n.value, 1e6, scan.c[0].y.value, 1).tolist(), [0])
+
+    def test_endpoint(self):
+        self.serve(self.tmpdir)
+        found = json.loads(app.app.request('/points/a.pto?image=1&x=500&y=400&radius=100').data)
+        pair = json.loads(app.app.request('/points/a.pto?image=2&other=1').data)
+        bad = app.app.request('/points/a.pto?image=1&radius=x')
+        infinite = [app.app.request('/points/a.pto?image=1&' + query).status
+                    for query in ('x=nan&y=400&radius=100', 'x=500&y=400&radius=inf',
+                                  'x0=0&y0=0&x1=-inf&y1=5')]
+        scan = parse_pto.pto_scan(self.path)
+        self.assertTrue(found['index'])
+        for k, row in enumerate(found['index']):
+            line = scan.c[row]
+            self.assertEqual(found['x'][k], line.x.value)
+            self.assertTrue(1 in (line.n.value, line.N.value))
+        self.assertTrue(all(set([n, N]) == set([1, 2]) for n, N in zip(pair['n'], pair['N'])))
+        self.assertTrue(bad.status.startswith('400'))
+        self.assertEqual([status[:3] for status in infinite], ['400'] * 3)
+
+class TestImageGraph(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # 0-1 and 1-2 linked, 3 on it's own, 4-5 apart from the rest
+        points = [(0, 1)] * 3 + [(1, 2)] * 5 + [(2, 1), (2, 2), (5, 4), (0, 2)]
+        content = SAMPLE_PTO.split('# control points')[0] + ''.join(
+            'i w10 h10 f0 v50 r0 p0 y%d n"x%d.jpg"\n' % (k, k) for k in range(4)) + ''.join(
+            'c n%d N%d x1 y2 X3 Y4 t0\n' % pair for pair in points)
+        self.path = write_pto(self.tmpdir, 'a.pto', content)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_graph(self):
+        scan = parse_pto.pto_scan(self.path, fast_scan=True, lazy=True)
+        graph = scan.image_graph()
+        self.assertTrue(scan.image_graph() is graph)
+        self.assertEqual(len(graph), 6)
+        self.assertEqual(graph.edges(), [(0, 1, 3), (0, 2, 1), (1, 2, 6), (4, 5, 1)])
+        self.assertEqual(graph.neighbours(1), [(2, 6), (0, 3)])
+        self.assertEqual(graph.neighbours(3), [])
+        self.assertEqual(graph.load_order(0), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(graph.load_order(2), [2, 1, 0, 3, 4, 5])
+        self.assertEqual(graph.load_order(5), [5, 4, 0, 1, 2, 3])
+        self.assertRaises(IndexError, graph.load_order, 6)
+
+    def test_endpoint(self):
+        self.serve(self.tmpdir)
+        result = json.loads(app.app.request('/graph/a.pto?start=2').data)
+        bad = app.app.request('/graph/a.pto?start=9', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(result['order'], [2, 1, 0, 3, 4, 5])
+        self.assertEqual(result['edges'][2], [1, 2, 6])
+        self.assertTrue(bad.status.startswith('400'))
+        self.assertFalse('Content-Encoding' in bad.headers or 'ETag' in bad.headers)
+
+def mapped_signature(scan):
+    # a mapped scan's lines are pto_lines, too
+    return [('pto_line' if line[0] == 'mapped_pto_line' else line[0],) + line[1:]
+            for line in scan_signature(scan)]
+
+class TestMappedScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameScan(self, content):
+        path = write_pto(self.tmpdir, 'a.pto', content)
+        lazy = parse_pto.pto_scan(path, fast_scan=True, lazy=True)
+        mapped = parse_pto.pto_scan(path, mapped=True)
+        self.assertTrue(mapped.lazy and mapped.fast_scan)
+        for header in 'ivc':
+            self.assertEqual(len(getattr(mapped, header, [])), len(getattr(lazy, header, [])))
+        self.assertEqual(mapped.pto_text(), lazy.pto_text())
+        self.assertEqual(mapped_signature(mapped), scan_signature(lazy))
+        return mapped
+
+    def test_same_scan(self):
+        mapped = self.assertSameScan(SAMPLE_PTO)
+        self.assertEqual(type(mapped.c[0]).__name__, 'mapped_pto_line')
+        self.assertSameScan(''.join(TRICKY_LINES))
+        self.assertSameScan(SAMPLE_PTO + 'c n0 N1 x1 y2 X3 Y4 t0') # no newline at the end
+        self.assertSameScan(SAMPLE_PTO + '*\nc n0 N1 x1 y2 X3 Y4 t0\n')
+        self.assertSameScan('')
+
+    def test_source(self):
+        path = write_pto(self.tmpdir, 'a.pto')
+        scan = parse_pto.pto_scan(path, mapped=True, keep_source=False)
+        line = scan.c[1]
+        self.assertEqual(line.sourcecode, SAMPLE_PTO.splitlines(True)[line.lineno])
+        line.x.value = 7.5
+        self.assertTrue(' x7.5 ' in scan.pto_text())
+        line.sourcecode = 'c n0 N1 x1 y2 X3 Y4 t0\n'
+        self.assertEqual(line.source(), 'c n0 N1 x1 y2 X3 Y4 t0\n')
+        # an open file is mapped, too
+        opened = parse_pto.pto_scan(open(path), mapped=True)
+        self.assertEqual(type(opened.c[0]).__name__, 'mapped_pto_line')
+
+    def test_unmappable(self):
+        # a pipe can't be mapped, it's read the usual way
+        read, write = os.pipe()
+        os.write(write, SAMPLE_PTO)
+        os.close(write)
+        piped = parse_pto.pto_scan(os.fdopen(read), mapped=True)
+        path = write_pto(self.tmpdir, 'a.pto')
+        usual = parse_pto.pto_scan(path, fast_scan=True, lazy=True)
+        self.assertEqual(piped.pto_text(), usual.pto_text())
+        self.assertEqual(scan_signature(piped), scan_signature(usual))
+        # and so is a file which has been read from already
+        started = open(path)
+        started.readline()
+        rest = write_pto(self.tmpdir, 'rest.pto', ''.join(SAMPLE_PTO.splitlines(True)[1:]))
+        self.assertEqual(parse_pto.pto_scan(started, mapped=True).pto_text(),
+                         parse_pto.pto_scan(rest, fast_scan=True, lazy=True).pto_text())
+        # an empty file can't be mapped either, but it's empty
+        empty = write_pto(self.tmpdir, 'empty.pto', '')
+        self.assertEqual(parse_pto.pto_scan(empty, mapped=True).pto_text(), '')
+
+    def test_sidecar_and_refresh(self):
+        path = write_pto(self.tmpdir, 'a.pto')
+        scan = parse_pto.pto_scan(path, mapped=True, sidecar=True)
+        cached = parse_pto.pto_scan(path, mapped=True, sidecar=True)
+        self.assertEqual(scan_signature(cached), mapped_signature(scan))
+        # saved the way editors do, as a new file
+        replacement = write_pto(self.tmpdir, 'new.pto', SAMPLE_PTO.replace('y45.5', 'y46'))
+        os.rename(replacement, path)
+        changes = scan.refresh()
+        self.assertEqual(len(changes), 2)
+        self.assertEqual(scan.i[1].y.value, 46)
+        self.assertEqual(mapped_signature(scan), scan_signature(
+            parse_pto.pto_scan(path, fast_scan=True, lazy=True)))
+
+class TestFootprints(ServingMixin, unittest.TestCase):
+
+    def test_radius(self):
+        # a square rectilinear image of 90 degrees reaches atan(sqrt(2)) to its corners
+        radius = geometry.footprint_radius([90, 90, 180, 40], [10, 10, 10, 20], [10, 10, 10, 10],
+                                           [0, 2, 0, 4])
+        numpy.testing.assert_allclose(radius * 180 / numpy.pi,
+                                      [54.7356103, 45 * math.sqrt(2), 180, 20 * math.sqrt(1.25)])
+
+    def test_visible(self):
+        rnd = numpy.random.RandomState(3)
+        n = 500
+        yaw, pitch = rnd.uniform(-180, 180, n), rnd.uniform(-90, 90, n)
+        view, width = rnd.uniform(10, 120, n), rnd.randint(100, 400, n)
+        view[7] = numpy.nan
+        index = geometry.footprint_index(yaw, pitch, view, width, width * 3 // 4)
+        radius = geometry.footprint_radius(view, width, width * 3 // 4)
+        centres = geometry.directions(yaw, pitch)
+        for k in range(50):
+            y, p, fov = rnd.uniform(-180, 180), rnd.uniform(-90, 90), rnd.uniform(10, 100)
+            found = index.visible(y, p, fov, 1.5)
+            # everything, the slow way
+            half = math.atan(math.tan(math.radians(fov) / 2) * math.sqrt(1 + 1.5 ** 2))
+            angles = numpy.arccos(numpy.clip(centres.dot(geometry.directions(y, p)), -1, 1))
+            expected = numpy.flatnonzero(angles <= radius + half)
+            self.assertEqual(found.tolist(), expected.tolist())
+            self.assertFalse(7 in found)
+
+    def test_endpoint(self):
+        tmpdir = self.project_dir(SAMPLE_PTO.split('# control points')[0] + ''.join(
+            'i w40 h30 f0 v30 r0 p0 y%d n"x%d.jpg"\n' % (k * 90, k) for k in range(4)))
+        self.serve(tmpdir)
+        images = len(parse_pto.pto_scan(os.path.join(tmpdir, 'a.pto')).i)
+        result = json.loads(app.app.request('/visible/a.pto?yaw=90&pitch=0&fov=20').data)
+        behind = json.loads(app.app.request('/visible/a.pto?yaw=135&pitch=0&fov=20').data)
+        bad = [app.app.request('/visible/a.pto?yaw=0&pitch=%s&fov=%s' % query).status
+               for query in (('0', '180'), ('91', '30'), ('0', 'x'), ('nan', '30'))]
+        missing = app.app.request('/visible/b.pto?yaw=0&pitch=0&fov=30').status
+        self.assertEqual(result['images'], [images - 3])
+        self.assertEqual(behind['images'], [])
+        self.assertEqual([status[:3] for status in bad], ['400'] * 4)
+        self.assertTrue(missing.startswith('404'))
+
+PREVIEW_PTO = """\
+p f2 w3000 h1500 v360 n"TIFF_m"
+i w400 h300 f0 v90 r0 p0 y0 a0 b0 c0 d0 e0 n"red.jpg"
+i w400 h300 f0 v=0 r0 p0 y180 a=0 b=0 c=0 d0 e0 n"blue.jpg"
+i w400 h300 f2 v120 r0 p80 y90 a=0 b=0 c=0 d0 e0 n"green.jpg"
+i w400 h300 f0 v=0 r0 p0 y-90 a=0 b=0 c=0 d0 e0 n"missing.jpg"
+"""
+
+@unittest.skipIf(pyramid.Image is None, "needs Pillow")
+class TestPreview(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image
+        self.tmpdir = tempfile.mkdtemp()
+        for name, colour in (('red.jpg', (255, 0, 0)), ('blue.jpg', (0, 0, 255)),
+                             ('green.jpg', (0, 255, 0))):
+            Image.new('RGB', (400, 300), colour).save(os.path.join(self.tmpdir, name))
+        self.path = write_pto(self.tmpdir, 'a.pto', PREVIEW_PTO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def pixels(self, path):
+        from PIL import Image
+        return numpy.asarray(Image.open(path)).astype(int)
+
+    def test_rendered(self):
+        path = preview.render_preview(self.path, self.tmpdir, 128, workers=2)
+        pixels = self.pixels(path)
+        self.assertEqual(pixels.shape, (64, 128, 3))
+        # yaw 0 is in the middle, 180 at the edges, the fisheye covers the top
+        for (row, column), colour in [((32, 64), (255, 0, 0)), ((32, 0), (0, 0, 255)),
+                                      ((32, 127), (0, 0, 255)), ((2, 90), (0, 255, 0)),
+                                      ((2, 10), (0, 255, 0)), ((60, 64), (0, 0, 0)),
+                                      ((32, 32), (0, 0, 0))]:
+            self.assertTrue(abs(pixels[row, column] - colour).max() < 16, (row, column))
+        # a 90 degree wide image reaches 45 degrees either way at the horizon
+        red = numpy.flatnonzero(pixels[32, :, 0] > 128)
+        self.assertEqual((red[0], red[-1]), (48, 79))
+
+    def test_distortion(self):
+        # with barrel distortion, a direction inside the image is further out in it
+        plain = preview.image_coordinates(dict(preview.IMAGE_MEMBERS, w=400, h=300, v=90,
+                                               f=0, y=0.0), *numpy.array([[[0.5]], [[0]], [[0.866]]]))
+        barrel = preview.image_coordinates(dict(preview.IMAGE_MEMBERS, w=400, h=300, v=90, f=0,
+                                                y=0.0, b=-0.05), *numpy.array([[[0.5]], [[0]], [[0.866]]]))
+        self.assertTrue(plain[0][0, 0] < barrel[0][0, 0] < 400)
+        self.assertEqual(barrel[1][0, 0], plain[1][0, 0])
+
+    def test_cached(self):
+        path = preview.render_preview(self.path, self.tmpdir, 64, workers=1)
+        mtime = os.path.getmtime(path)
+        self.assertEqual(preview.render_preview(self.path, self.tmpdir, 64, workers=1), path)
+        self.assertEqual(os.path.getmtime(path), mtime)
+        # the panorama is 3000 wide, no preview is wider
+        wide = preview.render_preview(self.path, self.tmpdir, 5000, workers=1)
+        self.assertEqual(self.pixels(wide).shape[1], 3000)
+        # a changed image means a new preview, in place of the old one
+        os.utime(os.path.join(self.tmpdir, 'red.jpg'), (1, 1))
+        again = preview.render_preview(self.path, self.tmpdir, 64, workers=1)
+        self.assertNotEqual(again, path)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         sorted([os.path.basename(again), os.path.basename(wide)]))
+
+    def test_served(self):
+        self.serve(self.tmpdir, self.tmpdir)
+        response = app.app.request('/preview/a.pto?width=64')
+        # a client with the current preview gets a 304 without any rendering
+        shutil.rmtree(os.path.join(self.tmpdir, preview.PREVIEW_DIR))
+        again = app.app.request('/preview/a.pto?width=64',
+                                headers={'If-None-Match': response.headers['ETag']})
+        rendered = os.path.exists(os.path.join(self.tmpdir, preview.PREVIEW_DIR))
+        os.utime(os.path.join(self.tmpdir, 'red.jpg'), (1, 1))
+        changed = app.app.request('/preview/a.pto?width=64',
+                                  headers={'If-None-Match': response.headers['ETag']})
+        bad = app.app.request('/preview/a.pto?width=x').status
+        missing = app.app.request('/preview/b.pto').status
+        self.assertEqual(response.headers['Content-Type'], 'image/jpeg')
+        self.assertEqual(self.pixels(StringIO(response.data)).shape, (32, 64, 3))
+        self.assertTrue(again.status.startswith('304'))
+        self.assertFalse(rendered)
+        self.assertTrue(changed.status.startswith('200'))
+        self.assertNotEqual(changed.headers['ETag'], response.headers['ETag'])
+        self.assertTrue(bad.startswith('400'))
+        self.assertTrue(missing.startswith('404'))
+
+@unittest.skipIf(pyramid.Image is None, "needs Pillow")
+class TestAtlas(ServingMixin, unittest.TestCase):
+
+    def setUp(self):
+        from PIL import Image
+        self.tmpdir = tempfile.mkdtemp()
+        # img2 is there twice, and the last image has no size
+        self.sizes = [(400, 300), (300, 400), (1000, 100), (400, 300), (200, 100)]
+        lines = []
+        for k, (width, height) in enumerate(self.sizes[:4]):
+            Image.new('RGB', (width, height), (60 * k, 255 - 60 * k, 100)).save(
+                os.path.join(self.tmpdir, 'img%d.jpg' % k))
+            lines.append('i w%d h%d f0 v50 r0 p0 y%d n"img%d.jpg"' % (width, height, k * 40, k))
+        lines[3] = lines[3].replace('img3', 'img0')
+        lines.append('i f0 v50 r0 p0 y0 n"img4.jpg"')
+        self.path = write_pto(self.tmpdir, 'a.pto', 'p f2 w3000 h1500 v360\n' + '\n'.join(lines) + '\n')
+        self.images = parse_pto.pto_scan(self.path).images()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_layout(self):
+        layout = atlas.atlas_layout(self.images)
+        self.assertEqual([slot and slot[3:] for slot in layout.slots],
+                         [(256, 192), (192, 256), (256, 26), (256, 192), None])
+        self.assertEqual(layout.slots[3], layout.slots[0])
+        self.assertEqual(layout.pages, [(1024, 512)])
+        # tallest first, with the padding around each
+        self.assertEqual(layout.slots[1][1:3], (2, 2))
+        self.assertEqual(layout.uv(1), [2 / 1024.0, 2 / 512.0, 194 / 1024.0, 258 / 512.0])
+        # small pages fill up and more are made
+        small = atlas.atlas_layout(self.images, page_size=300)
+        self.assertEqual([slot and slot[0] for slot in small.slots], [1, 0, 0, 1, None])
+        self.assertRaises(ValueError, atlas.atlas_layout, self.images, page_size=200)
+
+    def test_pages(self):
+        from PIL import Image
+        manifest = atlas.build_atlas(self.path, self.tmpdir, workers=2)
+        page = numpy.asarray(Image.open(atlas.page_path(manifest, 0))).astype(int)
+        self.assertEqual(page.shape, (512, 1024, 3))
+        layout = atlas.atlas_layout(self.images)
+        for k in range(3):
+            number, x, y, width, height = layout.slots[k]
+            colour = (60 * k, 255 - 60 * k, 100)
+            self.assertTrue(abs(page[y + height // 2, x + width // 2] - colour).max() < 16)
+        self.assertEqual(atlas.build_atlas(self.path, self.tmpdir, workers=1), manifest)
+        os.utime(os.path.join(self.tmpdir, 'img1.jpg'), (1, 1))
+        rebuilt = atlas.build_atlas(self.path, self.tmpdir, workers=1)
+        self.assertNotEqual(rebuilt['key'], manifest['key'])
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, atlas.ATLAS_DIR)),
+                         [os.path.basename(rebuilt['directory'])])
+
+    def test_padding(self):
+        from PIL import Image
+        page = Image.new('RGB', (10, 10))
+        tile = Image.new('RGB', (4, 3), (255, 0, 0))
+        tile.putpixel((0, 0), (0, 255, 0))
+        atlas.paste(page, tile, 3, 4, padding=2)
+        pixels = numpy.asarray(page)
+        # the edges are repeated out to the corners, and no further
+        painted = pixels.any(axis=2)
+        self.assertTrue(painted[2:9, 1:9].all())
+        self.assertEqual(painted.sum(), 7 * 8)
+        self.assertEqual(pixels[2:5, 1:4, 1].tolist(), [[255] * 3] * 3)
+
+    def test_served(self):
+        self.serve(self.tmpdir, self.tmpdir)
+        data = json.loads(app.app.request('/load/a.pto?atlas=1').data)
+        response = app.app.request(data[0]['atlas']['url'])
+        # a client with the current page gets a 304 without any building
+        shutil.rmtree(os.path.join(self.tmpdir, atlas.ATLAS_DIR))
+        again = app.app.request(data[0]['atlas']['url'],
+                                headers={'If-None-Match': response.headers['ETag']})
+        built = os.path.exists(os.path.join(self.tmpdir, atlas.ATLAS_DIR))
+        missing = app.app.request('/atlas/a.pto/1.jpg').status
+        self.assertFalse(built)
+        self.assertEqual(data[1]['atlas'], {'page': 0, 'url': '/atlas/a.pto/0.jpg',
+                                            'uv': atlas.atlas_layout(self.images).uv(1)})
+        self.assertEqual(data[4]['atlas'], None)
+        self.assertEqual(response.headers['Content-Type'], 'image/jpeg')
+        self.assertTrue(again.status.startswith('304'))
+        self.assertTrue(missing.startswith('404'))